@@ -0,0 +1,483 @@
+# Google Takeout 元数据恢复工具的性能基准
+# 生成合成的 Takeout 目录树, 用可以设置延迟的 exiftool 替身依次运行各阶段, 把耗时、吞吐和峰值内存写成 JSON, 便于前后对比
+#
+# 示例:
+#   python benchmark_metafix.py --files 20000 --albums 40 --executor thread asyncio --output before.json
+#   python benchmark_metafix.py --files 20000 --albums 40 --executor thread asyncio --output after.json --compare before.json
+import os
+import sys
+import argparse
+import json
+import random
+import shutil
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from contextlib import redirect_stdout, nullcontext
+from datetime import datetime, timezone
+from pathlib import Path
+
+import google_takeout_metafix_v2_mt as metafix
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# --- 合成目录树 ---
+# 各类文件的比例 (按媒体文件数计), 可以用 --shape 名称=比例 修改
+default_shape = {
+    "video": 0.15,         # 视频 (.mp4 + .mp4.json)
+    "plain_json": 0.15,    # JSON 名不含媒体扩展名 (IMG_0001.json)
+    "supplemental": 0.10,  # 新版 Takeout 的 .jpg.supplemental-metadata.json
+    "long": 0.05,          # 文件名超过 45 个字符, JSON 名被截断
+    "dup": 0.05,           # 重名文件的 (n) 去重编号 (IMG_0001(1).jpg + IMG_0001.jpg(1).json)
+    "live": 0.05,          # Live Photo (.heic + .heic.json + 没有 JSON 的同名 .mp4)
+    "wrong_ext": 0.05,     # 扩展名与内容不符 (PNG 内容的 .jpg)
+    "orphan": 0.01,        # 没有 JSON 的媒体文件, 以及没有媒体文件的 JSON
+}
+
+# 各类文件的文件头, 其余部分用 0 填充到 --media-size
+media_headers = {
+    ".jpg": b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00",
+    ".png": b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR",
+    ".heic": b"\x00\x00\x00\x18ftypheic\x00\x00\x00\x00mif1heic",
+    ".mp4": b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom",
+}
+
+# 本工具生成的目录中的标记文件; 只有带标记 (或使用 --force) 的已有目录才会被删除重建
+benchmark_marker = ".metafix_benchmark"
+
+# 超过 45 个字符的文件名, 序号放在前 45 个字符之内, 保证截断后的 JSON 名互不相同
+long_name_patterns = ("Screenshot_{index:06d}_2021-03-04-10-11-12-123_com.example.android.gallery",
+                      "PXL_{index:06d}_183512345.PORTRAIT.ORIGINAL_from_shared_album",
+                      "WhatsApp Image {index:06d} at 12.34.56 forwarded from family group")
+
+
+def sidecar_json(title, timestamp, rng):
+    # Takeout JSON 的常用字段, 约一半带 GPS
+    lat, lng = (round(rng.uniform(-60, 60), 6), round(rng.uniform(-180, 180), 6)) if rng.random() < 0.5 else (0.0, 0.0)
+    return json.dumps({
+        "title": title,
+        "description": "",
+        "creationTime": {"timestamp": str(timestamp + 3600)},
+        "photoTakenTime": {"timestamp": str(timestamp)},
+        "geoData": {"latitude": lat, "longitude": lng, "altitude": round(rng.uniform(0, 500), 1) if lat else 0.0,
+                    "latitudeSpan": 0.0, "longitudeSpan": 0.0},
+    })
+
+
+def prepare_benchmark_dir(path, force=False):
+    '''
+    prepare_benchmark_dir 的 Docstring
+    清空并重建 path, 写入标记文件; path 是已有的非空目录且不是本工具生成的 (没有标记文件) 时拒绝删除, 除非 force=True
+    '''
+    path = Path(path)
+    if path.exists():
+        if not force and not (path / benchmark_marker).exists() and (not path.is_dir() or any(path.iterdir())):
+            raise FileExistsError(f"{path} 已存在且不是基准测试生成的目录, 不会删除; 请换一个 --workdir 或使用 --force")
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+    path.mkdir(parents=True)
+    (path / benchmark_marker).write_text("metafix benchmark\n", encoding="utf-8")
+    return path
+
+
+def generate_takeout_tree(root, files=2000, albums=10, media_size=4096, shape=None, seed=0, force=False):
+    '''
+    generate_takeout_tree 的 Docstring
+    在 root 下生成合成的 Takeout 目录树, 包含 45 字符截断、(n) 去重编号、.jpg.json 与 .json 两种 JSON 命名、
+    Live Photo 和扩展名错误的文件; 相同的参数和 seed 生成完全相同的目录树
+    root 已存在时只删除本工具生成的目录 (见 prepare_benchmark_dir)
+    返回 {"media": 媒体文件数, "json": JSON 文件数, "pairs": 应匹配的对数, "bytes": 媒体文件总字节数, ...各类文件数}
+    '''
+    shape = {**default_shape, **(shape or {})}
+    rng = random.Random(seed)
+    root = prepare_benchmark_dir(root, force)
+    padding = {ext: header + b"\0" * max(0, media_size - len(header)) for ext, header in media_headers.items()}
+    summary = {"media": 0, "json": 0, "pairs": 0, "bytes": 0, **{kind: 0 for kind in shape}}
+
+    def write_media(folder, name, ext):
+        data = padding[ext]
+        (folder / name).write_bytes(data)
+        summary["media"] += 1
+        summary["bytes"] += len(data)
+
+    def write_json(folder, name, title, timestamp):
+        (folder / name).write_text(sidecar_json(title, timestamp, rng), encoding="utf-8")
+        summary["json"] += 1
+
+    kinds = list(shape)
+    weights = [shape[kind] for kind in kinds]
+    normal_weight = max(0.0, 1.0 - sum(weights))
+    folders = [root / (f"Photos from {2010 + i}" if i % 2 == 0 else f"Album {i:03d}") for i in range(albums)]
+    for folder in folders:
+        folder.mkdir(parents=True)
+        (folder / "metadata.json").write_text(json.dumps({"title": folder.name}), encoding="utf-8")
+        summary["json"] += 1
+
+    for index in range(files):
+        folder = folders[index % len(folders)]
+        timestamp = 1262304000 + rng.randrange(400000000)
+        stem = f"IMG_{datetime.fromtimestamp(timestamp, timezone.utc):%Y%m%d_%H%M%S}_{index:06d}"
+        kind = rng.choices(kinds + ["normal"], weights + [normal_weight])[0]
+        summary[kind] = summary.get(kind, 0) + 1
+        if kind == "video":
+            write_media(folder, f"VID{stem[3:]}.mp4", ".mp4")
+            write_json(folder, f"VID{stem[3:]}.mp4.json", f"VID{stem[3:]}.mp4", timestamp)
+        elif kind == "plain_json":
+            write_media(folder, f"{stem}.jpg", ".jpg")
+            write_json(folder, f"{stem}.json", f"{stem}.jpg", timestamp)
+        elif kind == "supplemental":
+            write_media(folder, f"{stem}.jpg", ".jpg")
+            write_json(folder, metafix.get_file_name_cut(f"{stem}.jpg.supplemental-metadata", 46) + ".json",
+                       f"{stem}.jpg", timestamp)
+        elif kind == "long":
+            name = rng.choice(long_name_patterns).format(index=index) + ".jpg"
+            write_media(folder, name, ".jpg")
+            write_json(folder, metafix.get_file_name_cut(name) + ".json", name, timestamp)
+        elif kind == "dup":
+            # 原文件和带 (1) 编号的重名文件各有一个 JSON
+            write_media(folder, f"{stem}.jpg", ".jpg")
+            write_json(folder, f"{stem}.jpg.json", f"{stem}.jpg", timestamp)
+            write_media(folder, f"{stem}(1).jpg", ".jpg")
+            write_json(folder, f"{stem}.jpg(1).json", f"{stem}.jpg", timestamp + 1)
+            summary["pairs"] += 1
+        elif kind == "live":
+            # 视频没有自己的 JSON, 匹配阶段复制 (或引用) 图片的 JSON
+            write_media(folder, f"{stem}.HEIC", ".heic")
+            write_json(folder, f"{stem}.HEIC.json", f"{stem}.HEIC", timestamp)
+            write_media(folder, f"{stem}.MP4", ".mp4")
+            summary["pairs"] += 1
+        elif kind == "wrong_ext":
+            write_media(folder, f"{stem}.jpg", ".png")
+            write_json(folder, f"{stem}.jpg.json", f"{stem}.jpg", timestamp)
+        elif kind == "orphan":
+            write_media(folder, f"{stem}.jpg", ".jpg")
+            write_json(folder, f"DELETED{stem[3:]}.jpg.json", f"DELETED{stem[3:]}.jpg", timestamp)
+            continue
+        else:
+            write_media(folder, f"{stem}.jpg", ".jpg")
+            write_json(folder, f"{stem}.jpg.json", f"{stem}.jpg", timestamp)
+        summary["pairs"] += 1
+    return summary
+
+
+# --- exiftool 替身 ---
+# 不读写元数据, 只按设置的延迟等待, 并给出与 exiftool 相同格式的输出 ({readyN}、-echo4、"N image files updated")
+# 支持 -o <输出文件> <源文件或 - (标准输入)>, 与 exiftool 一样拒绝覆盖已有的输出文件
+stub_exiftool_source = r'''#!__PYTHON__
+import json
+import os
+import sys
+import time
+
+startup = float(os.environ.get("METAFIX_STUB_STARTUP_MS", "0")) / 1000
+latency = float(os.environ.get("METAFIX_STUB_LATENCY_MS", "0")) / 1000
+file_latency = float(os.environ.get("METAFIX_STUB_FILE_LATENCY_MS", "0")) / 1000
+rewrite = os.environ.get("METAFIX_STUB_REWRITE") == "1"
+
+
+def write_copy(args):
+    # -o <输出文件>: 把源文件 (或 "-" 表示的标准输入) 复制为输出文件; --archives 模式每个成员都这样写出一次
+    i = args.index("-o")
+    target, args = args[i + 1], args[:i] + args[i + 2:]
+    sources = [arg for arg in args if arg == "-" or (not arg.startswith("-") and os.path.isfile(arg))]
+    # 与 exiftool 一样先读完标准输入再处理, 延迟不会让发送成员内容的一方阻塞在管道上
+    data = sys.stdin.buffer.read() if "-" in sources else None
+    time.sleep(latency + file_latency)
+    if len(sources) != 1 or os.path.exists(target):
+        sys.stderr.write(f"Error: Error creating {target}\n")
+        return "    0 image files updated\n    1 files weren't updated due to errors\n"
+    if data is None:
+        with open(sources[0], "rb") as src:
+            data = src.read()
+    with open(target, "wb") as dst:
+        dst.write(data)
+    return "    1 image files updated\n"
+
+
+def run(args):
+    if "-o" in args:
+        return write_copy(args)
+    files = [arg for arg in args if not arg.startswith("-") and os.path.isfile(arg)]
+    time.sleep(latency + file_latency * len(files))
+    if "-json" in args:
+        return json.dumps([{"SourceFile": file} for file in files]) + "\n"
+    if rewrite:
+        # 与 exiftool 一样把整个文件重写一遍
+        for file in files:
+            with open(file, "rb") as src:
+                data = src.read()
+            with open(file, "wb") as dst:
+                dst.write(data)
+    return f"    {len(files)} image files updated\n"
+
+
+def main():
+    time.sleep(startup)
+    args = sys.argv[1:]
+    if "-stay_open" not in args:
+        output = run(args)
+        sys.stdout.write(output)
+        sys.exit(1 if "weren't updated" in output else 0)
+    pending = []
+    for line in sys.stdin:
+        line = line.rstrip("\r\n")
+        if line.startswith("-execute"):
+            echo = None
+            if "-echo4" in pending:
+                i = pending.index("-echo4")
+                echo = pending[i + 1]
+                del pending[i:i + 2]
+            sys.stdout.write(run(pending) + "{ready%s}\n" % line[len("-execute"):])
+            sys.stdout.flush()
+            if echo:
+                sys.stderr.write(echo + "\n")
+                sys.stderr.flush()
+            pending = []
+        elif line == "False" and pending[-1:] == ["-stay_open"]:
+            return
+        else:
+            pending.append(line)
+
+
+main()
+'''
+
+
+def install_stub_exiftool(bin_dir, startup_ms=0, latency_ms=0, file_latency_ms=0, rewrite=False):
+    '''
+    install_stub_exiftool 的 Docstring
+    在 bin_dir 中写入名为 exiftool 的替身并放到 PATH 最前面, 延迟通过环境变量传给替身
+    替身是带 #! 的 Python 脚本, 只能在 Linux/macOS 上运行
+    '''
+    if os.name == "nt":
+        raise SystemExit("exiftool 替身只能在 Linux/macOS 上运行")
+    bin_dir = Path(bin_dir)
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    stub = bin_dir / "exiftool"
+    stub.write_text(stub_exiftool_source.replace("__PYTHON__", sys.executable), encoding="utf-8")
+    stub.chmod(0o755)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+    os.environ["METAFIX_STUB_STARTUP_MS"] = str(startup_ms)
+    os.environ["METAFIX_STUB_LATENCY_MS"] = str(latency_ms)
+    os.environ["METAFIX_STUB_FILE_LATENCY_MS"] = str(file_latency_ms)
+    os.environ["METAFIX_STUB_REWRITE"] = "1" if rewrite else "0"
+    return stub
+
+
+# --- 运行各阶段 ---
+def max_rss_bytes():
+    # 本进程的峰值常驻内存 (不含 exiftool 子进程), Linux 上 ru_maxrss 以 KB 为单位, macOS 上以字节为单位
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def legacy_match_inputs(root):
+    # 与原来的扫描结果相同: 整棵树的 (图片在前、视频在后的媒体文件列表, JSON 文件列表), 不计入 legacy_match 的耗时
+    catalog = metafix.scan_catalog(root)
+    media_files = [catalog.path(i) for i in catalog.indices(metafix.FileCatalog.IMAGE)]
+    media_files += [catalog.path(i) for i in catalog.indices(metafix.FileCatalog.VIDEO)]
+    return media_files, [catalog.path(i) for i in catalog.indices(metafix.FileCatalog.JSON)]
+
+
+def legacy_match(media_files, json_files):
+    # 与原来的 find_matching_pairs 相同: 每个媒体文件遍历整棵树剩余的全部 JSON (find_matching_json), 匹配到的 JSON 从列表中移除
+    # 耗时随 媒体文件数 × JSON 文件数 增长; 返回匹配到的数量, 用于与 JsonMatchIndex 对比
+    json_files = list(json_files)
+    matched = 0
+    for media_file in media_files:
+        json_file = metafix.find_matching_json(media_file, json_files)
+        if json_file:
+            json_files.remove(json_file)
+            matched += 1
+    return matched
+
+
+def build_takeout_archive(root, archive):
+    # 把目录树打包为 Takeout 格式的 zip (成员名以 Takeout/ 开头, 不压缩), 不计入耗时
+    root = Path(root)
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_STORED) as zf:
+        for folder, _, names in os.walk(root):
+            for name in sorted(names):
+                if name != benchmark_marker:
+                    path = Path(folder) / name
+                    zf.write(path, "Takeout/" + path.relative_to(root).as_posix())
+    return archive
+
+
+def run_benchmark(root, tree, mode="batch", executor="thread", max_workers=None, batch_size=1, skip_correct=False,
+                  scan_workers=None, trace_memory=False, verbose=False, durability="none", force=False):
+    '''
+    run_benchmark 的 Docstring
+    在已生成的目录树上用 TakeoutRepairer 依次运行各阶段, 返回每个阶段的耗时、吞吐和峰值内存
+    mode 为 batch (scan/match/ext/write 四个阶段分别计时)、stream (流式模式作为一个阶段)、
+    legacy_match (只测全局遍历的 find_matching_json) 或 archives (把目录树打包为 zip, 测 --archives 从压缩包直接写出到 root 旁的 Output 目录)
+    '''
+    # 统计和 JSON 缓存属于每个 TakeoutRepairer, 每次运行都从空白开始
+    config = metafix.RepairConfig(batch_size=batch_size, skip_correct=skip_correct, quiet=not verbose,
+                                  executor=executor, max_workers=max_workers, scan_workers=scan_workers,
+                                  durability=durability)
+    # 各阶段处理的文件数, 用于计算吞吐
+    stage_files = {"scan": tree["media"] + tree["json"], "match": tree["media"], "ext": tree["pairs"],
+                   "write": tree["pairs"], "stream": tree["media"] + tree["json"], "legacy_match": tree["media"],
+                   "archives": tree["media"] + tree["json"]}
+    stages = {}
+    target = root
+    if mode == "archives":
+        archive = build_takeout_archive(root, prepare_benchmark_dir(Path(root).parent / "Archives", force) / "Takeout.zip")
+        target = prepare_benchmark_dir(Path(root).parent / "Output", force)
+    with open(os.devnull, "w", encoding="utf-8") as devnull, \
+            (nullcontext() if verbose else redirect_stdout(devnull)), \
+            metafix.TakeoutRepairer(target, config) as repairer:
+        if mode == "stream":
+            steps = [("stream", repairer.stream)]
+        elif mode == "legacy_match":
+            media_files, json_files = legacy_match_inputs(root)
+            steps = [("legacy_match", lambda: legacy_match(media_files, json_files))]
+        elif mode == "archives":
+            steps = [("archives", lambda: repairer.repair_archives([archive]))]
+        else:
+            steps = [("scan", repairer.scan), ("match", repairer.match),
+                     ("ext", repairer.correct_extensions), ("write", repairer.write_metadata)]
+        for name, step in steps:
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            step()
+            seconds = time.perf_counter() - start
+            result = {"seconds": round(seconds, 4),
+                      "files": stage_files[name],
+                      "files_per_second": round(stage_files[name] / seconds, 1) if seconds else None}
+            if name in ("write", "stream", "archives"):
+                result["mb_per_second"] = round(tree["bytes"] / seconds / 1e6, 2) if seconds else None
+            if trace_memory:
+                result["peak_python_bytes"] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            result["max_rss_bytes"] = max_rss_bytes()
+            stages[name] = result
+    return {
+        "mode": mode,
+        "executor": executor,
+        "durability": durability,
+        "stages": stages,
+        "total_seconds": round(sum(stage["seconds"] for stage in stages.values()), 4),
+        "sidecar_cache": {"hits": repairer.context.sidecar_cache.hits, "misses": repairer.context.sidecar_cache.misses},
+        "run_stats": repairer.run_stats.report(),
+    }
+
+
+def git_commit():
+    # 当前代码的提交号, 不在 git 仓库中时返回 None
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(current, previous):
+    # 按 (模式, 执行后端, 持久化级别, 重复序号, 阶段) 对比两次结果的耗时, 打印倍数 (>1 表示变慢)
+    old = {(run["mode"], run["executor"], run.get("durability", "none"), run["repeat"], name): stage
+           for run in previous["runs"] for name, stage in run["stages"].items()}
+    print(f"--- 与 {previous.get('commit') or '上次结果'} 对比 (耗时倍数, >1 表示变慢) ---")
+    compared = 0
+    for run in current["runs"]:
+        for name, stage in run["stages"].items():
+            before = old.get((run["mode"], run["executor"], run["durability"], run["repeat"], name))
+            if before and before["seconds"]:
+                compared += 1
+                print(f"{run['mode']}/{run['executor']}/{run['durability']}#{run['repeat']} {name}: "
+                      f"{before['seconds']:.3f} s -> {stage['seconds']:.3f} s ({stage['seconds'] / before['seconds']:.2f}x)")
+    if not compared:
+        print("没有相同模式、执行后端、持久化级别和重复序号的运行可以对比")
+
+
+def parse_shape(items):
+    shape = {}
+    for item in items or ():
+        name, _, value = item.partition("=")
+        if name not in default_shape or not value:
+            raise argparse.ArgumentTypeError(f"--shape 应为 名称=比例, 名称可选 {', '.join(default_shape)}")
+        shape[name] = float(value)
+    return shape
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="生成合成的 Takeout 目录树并测量各阶段的耗时、吞吐和峰值内存")
+    parser.add_argument("--files", type=int, default=2000, help="媒体文件数 (不含 Live Photo 的视频和重名文件)")
+    parser.add_argument("--albums", type=int, default=10, help="目录数")
+    parser.add_argument("--media-size", type=int, default=4096, help="每个媒体文件的字节数")
+    parser.add_argument("--shape", nargs="+", metavar="名称=比例", help=f"修改各类文件的比例, 默认 {default_shape}")
+    parser.add_argument("--seed", type=int, default=0, help="随机数种子, 相同参数和种子生成相同的目录树")
+    parser.add_argument("--mode", nargs="+", default=["batch"], choices=("batch", "stream", "legacy_match", "archives"),
+                        help="batch: 四个阶段分别计时; stream: 流式模式; legacy_match: 全局逐个遍历的 find_matching_json; "
+                             "archives: 从 zip 压缩包直接写出 (--archives)")
+    parser.add_argument("--executor", nargs="+", default=["thread"], choices=metafix.stage4_executors, help="阶段 4 的执行后端")
+    parser.add_argument("--max-workers", type=int, default=None, help="阶段 4 的最大并发数")
+    parser.add_argument("--batch-size", type=int, default=1, help="阶段 4 每批写入的文件数")
+    parser.add_argument("--skip-correct", action="store_true", help="写入前预检查已有元数据")
+    parser.add_argument("--scan-workers", type=int, default=None, help="并行扫描目录的线程数")
+    parser.add_argument("--durability", nargs="+", default=["none"], choices=metafix.durability_levels, help="写入的持久化级别")
+    parser.add_argument("--repeat", type=int, default=1, help="每种组合重复运行的次数")
+    parser.add_argument("--startup-ms", type=float, default=50, help="exiftool 替身的启动延迟 (毫秒)")
+    parser.add_argument("--latency-ms", type=float, default=5, help="exiftool 替身每条命令的延迟 (毫秒)")
+    parser.add_argument("--file-latency-ms", type=float, default=2, help="exiftool 替身每个文件的延迟 (毫秒)")
+    parser.add_argument("--rewrite", action="store_true", help="exiftool 替身像真正的 exiftool 一样重写每个文件")
+    parser.add_argument("--trace-memory", action="store_true", help="用 tracemalloc 记录每个阶段的 Python 内存峰值 (会拖慢运行)")
+    parser.add_argument("--workdir", default=None, help="生成目录树的位置, 默认为临时目录, 结束后删除")
+    parser.add_argument("--force", action="store_true", help="--workdir 中已有不是本工具生成的 Takeout/Archives/Output 目录时也删除重建")
+    parser.add_argument("--output", default="metafix_benchmark.json", help="结果 (JSON) 的保存路径")
+    parser.add_argument("--compare", default=None, help="与之前保存的结果对比")
+    parser.add_argument("--verbose", action="store_true", help="显示各阶段的原始输出")
+    args = parser.parse_args()
+    try:
+        shape = parse_shape(args.shape)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix="metafix_benchmark_"))
+    install_stub_exiftool(workdir / "bin", args.startup_ms, args.latency_ms, args.file_latency_ms, args.rewrite)
+    root = workdir / "Takeout"
+    runs = []
+    tree = None
+    try:
+        for mode in args.mode:
+            for executor in args.executor:
+                for level in args.durability:
+                    for repeat in range(args.repeat):
+                        # 阶段 3 会改名、阶段 2 会移动未匹配的文件, 每次运行都重新生成目录树 (不计入耗时)
+                        tree = generate_takeout_tree(root, args.files, args.albums, args.media_size, shape, args.seed, args.force)
+                        result = run_benchmark(root, tree, mode, executor, args.max_workers, args.batch_size, args.skip_correct,
+                                               args.scan_workers, args.trace_memory, args.verbose, level, args.force)
+                        result["repeat"] = repeat
+                        runs.append(result)
+                        print(f"{mode}/{executor}/{level}#{repeat}: " + " | ".join(
+                            f"{name} {stage['seconds']:.3f} s ({stage['files_per_second']} 个/s)" for name, stage in result["stages"].items()))
+    except FileExistsError as e:
+        parser.error(str(e))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "created": datetime.now().astimezone().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count()},
+        "config": {**vars(args), "shape": {**default_shape, **shape}},
+        "tree": tree,
+        "runs": runs,
+    }
+    Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"结果已保存到 {args.output}")
+    if args.compare:
+        compare_results(report, json.loads(Path(args.compare).read_text(encoding="utf-8")))
@@ -5,12 +5,27 @@ import re
 import json
 import logging
 import shutil
+import sqlite3
+import tarfile
+import zipfile
+import hashlib
 import filetype
 import subprocess
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
-import pprint
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import math
+import asyncio
+import contextvars
+import functools
+import queue
+import threading
+import time
+from array import array
+from collections import Counter, OrderedDict, namedtuple
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 # --- 全局变量 ---
 # 设置本地时区
@@ -24,12 +39,334 @@ video_extensions = {'.mp4', '.avi', '.mov', '.mkv', '.wmv', '.flv', '.webm',
 media_extensions = image_extensions | video_extensions
 json_extensions = {'.json'}
 
+# 关闭逐文件的输出 (--quiet), 大量文件时 print 本身也很耗时
+quiet = False
+# 逐文件耗时分布的区间上限 (毫秒)
+latency_buckets_ms = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+# --- 每个 TakeoutRepairer 的运行环境 ---
+# 当前所在 TakeoutRepairer 的 RepairContext; 不在任何 TakeoutRepairer 中时为 None, 使用模块中的设置
+_repair_context = contextvars.ContextVar("repair_context", default=None)
+
+
+def setting(name):
+    # 当前 TakeoutRepairer 的设置 (见 RepairConfig.settings), 不在 TakeoutRepairer 中时取模块中的同名变量 (命令行在 __main__ 中赋值)
+    context = _repair_context.get()
+    return globals()[name] if context is None else context.settings[name]
+
+
+class ContextBound:
+    '''
+    ContextBound 的 Docstring
+    模块级的 run_stats、durable_writes 和 sidecar_cache: 把属性访问转发给当前 TakeoutRepairer 自己的实例,
+    不在 TakeoutRepairer 中时转发给 default (命令行和直接调用模块函数时使用)
+    '''
+    def __init__(self, name, default):
+        self._name = name
+        self._default = default
+
+    def __getattr__(self, attr):
+        context = _repair_context.get()
+        return getattr(self._default if context is None else getattr(context, self._name), attr)
+
+
+class ContextThreadPoolExecutor(ThreadPoolExecutor):
+    # 任务在提交时的 contextvars 环境中执行, 各阶段的工作线程沿用所属 TakeoutRepairer 的设置和统计
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+# --- 运行统计 ---
+def print_file(*args):
+    # 逐文件的输出, --quiet 时关闭; 阶段标题、汇总和错误信息照常输出
+    if not setting("quiet"):
+        print(*args)
+
+
+def print_progress(text):
+    # 阶段 4 的周期性进度, --quiet 时只写入日志文件
+    if setting("quiet"):
+        logging.info(text)
+    else:
+        print(text)
+
+
+class RunStats:
+    '''
+    RunStats 的 Docstring
+    线程安全的运行统计: 各阶段的墙钟时间, 各类逐文件操作的耗时分布, 以及各种计数 (如各匹配规则的命中数)
+    运行结束时写入 JSON 报告并打印简要汇总
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}     # {阶段名: 秒}
+        self.latencies = {}  # {操作名: [文件数, 总秒数, 单个文件最大秒数, 各区间的文件数]}
+        self.counters = {}   # {计数名: 次数}
+
+    @contextmanager
+    def stage(self, name):
+        # 记录一个阶段的墙钟时间
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name, seconds):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, name, files=1):
+        # 记录一次操作的耗时; 一次操作处理多个文件 (批量写入) 时按平均值计入每个文件
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, files)
+
+    def observe(self, name, seconds, files=1):
+        if files <= 0:
+            return
+        per_file = seconds / files
+        index = bisect_left(latency_buckets_ms, per_file * 1000)
+        with self.lock:
+            entry = self.latencies.get(name)
+            if entry is None:
+                entry = self.latencies[name] = [0, 0.0, 0.0, [0] * (len(latency_buckets_ms) + 1)]
+            entry[0] += files
+            entry[1] += seconds
+            entry[2] = max(entry[2], per_file)
+            entry[3][index] += files
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self):
+        '''
+        report 的 Docstring
+        返回可以直接写成 JSON 的统计结果
+        '''
+        labels = [f"<={bound}ms" for bound in latency_buckets_ms] + [f">{latency_buckets_ms[-1]}ms"]
+        with self.lock:
+            return {
+                "finished": datetime.now(setting("local_timezone")).isoformat(timespec="seconds"),
+                "stages_seconds": {name: round(seconds, 3) for name, seconds in self.stages.items()},
+                "latencies": {name: {"files": files,
+                                     "total_seconds": round(total, 3),
+                                     "mean_ms": round(total / files * 1000, 3),
+                                     "max_ms": round(longest * 1000, 3),
+                                     "histogram": dict(zip(labels, buckets))}
+                              for name, (files, total, longest, buckets) in self.latencies.items()},
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def write_report(self, path):
+        try:
+            Path(path).write_text(json.dumps(self.report(), ensure_ascii=False, indent=2), encoding="utf-8")
+            print(f"运行报告: {path}")
+        except OSError as e:
+            logging.error(f"写入运行报告 {path} 时出错: {e}")
+
+    def print_summary(self):
+        report = self.report()
+        print(f"--- 运行统计 ---")
+        print("阶段耗时: " + " | ".join(f"{name} {seconds:.2f} s" for name, seconds in report["stages_seconds"].items()))
+        matches = {name[len("match."):]: n for name, n in report["counters"].items() if name.startswith("match.")}
+        if matches:
+            print("匹配规则: " + " | ".join(f"{rule} {n}" for rule, n in matches.items()))
+        for name, item in report["latencies"].items():
+            print(f"逐文件耗时 {name}: {item['files']} 个, 平均 {item['mean_ms']:.2f} ms, 最大 {item['max_ms']:.2f} ms")
+        others = {name: n for name, n in report["counters"].items() if not name.startswith("match.")}
+        if others:
+            print("计数: " + " | ".join(f"{name} {n}" for name, n in others.items()))
+
+
+# 本次运行的统计, 每个 TakeoutRepairer 各有一份
+run_stats = ContextBound("run_stats", RunStats())
+
 # --- 辅助函数 ---
 # 获取输入的前45个字符
 def get_file_name_cut(any_str, length=45):
     return any_str[:length]  # 返回文件的前45个字符，包括扩展名
 
 
+# --- 原子写入与持久化 ---
+# 写入的持久化级别 (--durability):
+#   none  只保证原子替换: 先写同目录的临时文件再改名, 断电后文件是旧内容或新内容, 不会只写了一半
+#   batch 同一目录攒够 durable_batch_size 个文件 (以及进度日志、增量缓存提交前和每个阶段结束时) 一起 fsync
+#   file  每个文件写完立即 fsync 文件和所在目录
+durability_levels = ("none", "batch", "file")
+durability = "none"
+durable_batch_size = 256
+
+
+def temp_path_for(path):
+    # 与目标在同一目录的临时文件 (扩展名为 .tmp, 扫描时不会被当作媒体或 JSON), 保证改名是同一文件系统内的原子操作
+    path = Path(path)
+    return path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+
+
+def fsync_path(path, directory=False):
+    # 把文件 (或目录条目) 同步到磁盘; Windows 不能打开目录, 目录的同步由文件系统负责
+    if directory and os.name == "nt":
+        return
+    if directory:
+        flags = os.O_RDONLY | getattr(os, "O_DIRECTORY", 0)
+    else:
+        flags = os.O_RDWR if os.name == "nt" else os.O_RDONLY
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class DurableWrites:
+    '''
+    DurableWrites 的 Docstring
+    所有原地修改都先写临时文件, 再用 os.replace 原子替换; 按持久化级别 level (默认为 durability) 决定何时 fsync
+    batch 级别下记录每个目录中改动过的文件, 攒够一组后并发 fsync (同时发出的 fsync 会合并到同一次文件系统日志提交), 目录只同步一次
+    进度日志和增量缓存提交前先调用 flush, 保证记录为已完成的写入都已落盘
+    '''
+    def __init__(self, level=None):
+        self.level = level
+        self.lock = threading.Lock()
+        self.pending = {}  # {目录: {待同步的文件}}, 只有改名时集合为空, 只同步目录
+
+    def write_text(self, path, text):
+        tmp = temp_path_for(path)
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(text)
+        except BaseException:
+            self._discard(tmp)
+            raise
+        self.replace(tmp, path)
+
+    def copy(self, src, dst, overwrite=True):
+        tmp = temp_path_for(dst)
+        try:
+            shutil.copy2(src, tmp)
+        except BaseException:
+            self._discard(tmp)
+            raise
+        self.replace(tmp, dst, overwrite)
+
+    def move(self, src, dst):
+        '''
+        move 的 Docstring
+        把 src 移动为 dst, 不覆盖已有文件 (抛出 FileExistsError); dst 所在目录必须已经存在
+        同一文件系统内直接 os.rename (原子操作, 不复制数据); 跨文件系统时先复制为临时文件再改名, 最后删除 src, 中断时不会在目标位置留下不完整的文件
+        '''
+        if os.path.lexists(dst):
+            raise FileExistsError(f"目标文件已存在: {dst}")
+        if os.stat(src).st_dev == os.stat(os.path.dirname(os.path.abspath(dst))).st_dev:
+            os.rename(src, dst)
+            self.moved(src, dst)
+        else:
+            self.copy(src, dst, overwrite=False)
+            os.remove(src)
+            self.changed(src, data=False)
+
+    def replace(self, tmp, path, overwrite=True):
+        '''
+        replace 的 Docstring
+        把已经写完的临时文件 tmp 原子地改名为 path; overwrite 为 False 时不覆盖已有文件 (抛出 FileExistsError, 删除 tmp)
+        覆盖已有文件时保留原文件的权限位 (临时文件按 umask 新建)
+        '''
+        try:
+            if not overwrite and os.path.lexists(path):
+                raise FileExistsError(f"目标文件已存在: {path}")
+            if overwrite:
+                try:
+                    shutil.copymode(path, tmp)
+                except FileNotFoundError:
+                    pass
+            if self._level() == "file":
+                fsync_path(tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            self._discard(tmp)
+            raise
+        self.changed(path, data=self._level() != "file")
+
+    def _level(self):
+        return self.level or durability
+
+    def _discard(self, tmp):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+    def changed(self, path, data=True):
+        # path 的内容 (data=True) 或所在目录的条目 (改名、移动) 发生了变化
+        level = self._level()
+        if level == "none":
+            return
+        path = os.path.abspath(path)
+        directory = os.path.dirname(path)
+        if level == "file":
+            if data:
+                fsync_path(path)
+            fsync_path(directory, directory=True)
+            return
+        with self.lock:
+            files = self.pending.setdefault(directory, set())
+            if data:
+                files.add(path)
+            full = len(files) >= durable_batch_size
+        if full:
+            self.flush(directory)
+
+    def moved(self, src, dst):
+        # src 改名或移动为 dst: 两个目录都要同步, 尚未同步的内容随文件转到 dst
+        if self._level() == "none":
+            return
+        src, dst = os.path.abspath(src), os.path.abspath(dst)
+        with self.lock:
+            files = self.pending.get(os.path.dirname(src))
+            data = files is not None and src in files
+            if data:
+                files.discard(src)
+        if os.path.dirname(src) != os.path.dirname(dst):
+            self.changed(src, data=False)
+        self.changed(dst, data=data)
+
+    def flush(self, directory=None):
+        '''
+        flush 的 Docstring
+        同步 directory (为 None 时为全部目录) 中尚未同步的文件和目录条目
+        '''
+        with self.lock:
+            if directory is None:
+                groups, self.pending = self.pending, {}
+            else:
+                groups = {directory: self.pending.pop(directory, set())}
+        files = [path for paths in groups.values() for path in paths]
+        if files:
+            with ContextThreadPoolExecutor(max_workers=min(setting("scan_workers"), len(files))) as executor:
+                list(executor.map(self._fsync_quietly, files))
+        for folder in groups:
+            self._fsync_quietly(folder, directory=True)
+
+    def _fsync_quietly(self, path, directory=False):
+        # 文件已被后续操作移走或删除时跳过, 其他错误只记录日志, 不中断运行
+        try:
+            fsync_path(path, directory)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.error(f"! 同步 {path} 到磁盘时出错: {e}")
+
+
+# 本次运行的持久化写入, 每个 TakeoutRepairer 各有一份
+durable_writes = ContextBound("durable_writes", DurableWrites())
+
+
 # 更新json中的title值, 把title值更新为现在media的full_name
 def update_json_title(media_path, json_path):
     '''
@@ -39,7 +376,8 @@ def update_json_title(media_path, json_path):
     try:
         data = json.loads(json_path.read_text(encoding="utf-8"))  # 从json中读取数据
         data["title"] = Path(media_path).name  # 草稿更改title值的扩展名
-        json_path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")  # 把草稿数据写入文件
+        durable_writes.write_text(json_path, json.dumps(data, ensure_ascii=False, indent=2))  # 把草稿数据写入文件 (原子替换)
+        sidecar_cache.store(json_path, data)  # 写入后的内容已经解析过, 之后读取时不再解析
     except Exception as e:
         logging.error(f"- 更新json {Path(json_path).name} 的title时出错: {e}")
 
@@ -50,6 +388,11 @@ def set_file_times(file_path, timestamp):
     set_file_times 的 Docstring
     给定一个文件路径和时间戳，修改该文件的访问时间、修改时间和创建时间
     '''
+    with run_stats.timer("set_file_times"):
+        _set_file_times(file_path, timestamp)
+
+
+def _set_file_times(file_path, timestamp):
     try:
         # 修改访问时间和修改时间 (跨平台)
         os.utime(file_path, (timestamp, timestamp))
@@ -73,29 +416,270 @@ def set_file_times(file_path, timestamp):
         logging.error(f"{file_path}时间戳修改失败: {e}")
 
 
-# 阶段 1: 遍历所有文件, 建立文件列表
-def collect_all_files(directory, extensions):
+# 并行扫描目录时使用的线程数
+scan_workers = 8
+
+
+def join_path(folder, name):
+    # 与 str(Path(folder) / name) 相同, 但不构造 Path
+    return name if folder == "." else os.path.join(folder, name)
+
+
+def _scan_directory_entries(folder, with_stats):
+    # 用一次 os.scandir 读取一个目录 (folder 为字符串), 把条目分为 媒体/JSON/其他
+    # 返回 (媒体文件名, JSON 文件名, {文件名: stat}, 子目录), 不构造 Path
+    media_names, json_names, stats, subdirs = [], [], {}, []
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    # 与 os.walk 一致, 不进入指向目录的符号链接
+                    if not entry.is_symlink():
+                        subdirs.append(join_path(folder, entry.name))
+                    continue
+                suffix = os.path.splitext(entry.name)[1].lower()
+                if suffix in media_extensions:
+                    media_names.append(entry.name)
+                elif suffix in json_extensions:
+                    json_names.append(entry.name)
+                else:
+                    continue
+                if with_stats:
+                    try:
+                        stats[entry.name] = entry.stat()
+                    except OSError:
+                        pass
+    except OSError as e:
+        logging.error(f"! 读取目录 {folder} 时出错: {e}")
+    return media_names, json_names, stats, subdirs
+
+
+def _iter_scan(directory, workers=None, with_stats=False, exclude=None):
+    # 多线程并行扫描目录树, 同级子目录同时扫描, 按完成先后产出 (目录, 媒体文件名, JSON 文件名, stat, 子目录), 均为字符串
+    # exclude 为不扫描的目录 (未匹配文件的移动目标), 按规范化后的绝对路径比较, 同名的普通相册照常扫描
+    root = str(Path(directory))
+    exclude = os.path.normcase(os.path.abspath(exclude)) if exclude else None
+    with ContextThreadPoolExecutor(max_workers=workers or setting("scan_workers")) as executor:
+        pending = {executor.submit(_scan_directory_entries, root, with_stats): root}
+        while pending:
+            done = next(as_completed(pending))
+            folder = pending.pop(done)
+            media_names, json_names, stats, subdirs = done.result()
+            if exclude:
+                # 移动目标目录存放上次运行移出的未匹配文件, 不再扫描
+                subdirs[:] = [subdir for subdir in subdirs if os.path.normcase(os.path.abspath(subdir)) != exclude]
+            for subdir in subdirs:
+                pending[executor.submit(_scan_directory_entries, subdir, with_stats)] = subdir
+            yield folder, media_names, json_names, stats, subdirs
+
+
+def iter_scanned_directories(directory, workers=None, with_stats=False, exclude=None):
+    '''
+    iter_scanned_directories 的 Docstring
+    多线程并行扫描目录树, 同级子目录同时扫描, 每扫描完一个目录就产出 (目录, 媒体文件, JSON 文件, stat, 子目录)
+    产出顺序取决于扫描完成的先后; 不进入 exclude 目录
+    '''
+    for folder, media_names, json_names, stats, subdirs in _iter_scan(directory, workers, with_stats, exclude):
+        folder = Path(folder)
+        yield (folder, [folder / name for name in media_names], [folder / name for name in json_names],
+               {folder / name: st for name, st in stats.items()}, [Path(subdir) for subdir in subdirs])
+
+
+def scan_catalog(directory, workers=None, with_stats=False, exclude=None):
+    '''
+    scan_catalog 的 Docstring
+    只遍历一次目录树, 把媒体文件和 JSON 文件放入 FileCatalog
+    文件按 os.walk 的顺序 (自上而下, 目录内按列出顺序) 编号; with_stats=True 时同时保存大小和修改时间
+    不进入 exclude 目录 (见 UnmatchedFiles.scan_exclude)
+    '''
+    results = {}
+    for folder, media_names, json_names, stats, subdirs in _iter_scan(directory, workers, with_stats, exclude):
+        results[folder] = (media_names, json_names, stats, subdirs)
+    catalog = FileCatalog(with_stats)
+    stack = [str(Path(directory))]
+    while stack:
+        folder = stack.pop()
+        media_names, json_names, stats, subdirs = results.pop(folder)
+        if media_names or json_names:
+            dir_id = catalog.add_directory(folder)
+            for name in media_names + json_names:
+                catalog.add(dir_id, name, FileCatalog.kind_of(name), stats.get(name))
+        stack.extend(reversed(subdirs))
+    return catalog
+
+
+# --- 紧凑的文件目录表 ---
+# 扫描时保存的 stat 结果, 只保留后续用到的大小和修改时间
+FileStat = namedtuple("FileStat", "st_size st_mtime_ns")
+
+
+def split_file_name(name):
+    # 按与 pathlib 相同的规则拆分 基名 和 扩展名 (即 Path.stem 和 Path.suffix), 不构造 Path
+    i = name.rfind(".")
+    if 0 < i < len(name) - 1:
+        return name[:i], name[i:]
+    return name, ""
+
+
+class FileCatalog:
     '''
-    collect_all_files 的 Docstring
-    遍历目录，收集指定扩展名的所有文件
+    FileCatalog 的 Docstring
+    几百万个文件时代替 Path 列表和以 Path 为键的匹配对字典:
+    每个目录只保存一次 (目录表), 每个文件只保存 目录编号 + 文件名, 文件种类、匹配状态和匹配到的 JSON 用整数数组保存
+    文件用编号表示, 只在需要访问文件系统时才用 path() 构造 Path
     '''
-    all_files = []
-    for root, _, names in os.walk(directory):
-        for name in names:
-            file_path = Path(root) / name
-            suffix = file_path.suffix.lower()
-            if suffix in extensions:
-                all_files.append(file_path)
-    return all_files
+    IMAGE, VIDEO, JSON = 0, 1, 2            # 文件种类
+    UNMATCHED, MATCHED, REMOVED = 0, 1, 2   # 匹配状态, REMOVED 表示已移到 unmatched 或已从匹配对中移除
+
+    def __init__(self, with_stats=False):
+        self.directories = []         # 目录表
+        self.directory_ids = {}       # {目录: 编号}
+        self.dir_ids = array("I")     # 每个文件所在目录的编号
+        self.names = []               # 文件名
+        self.kinds = array("B")
+        self.states = array("B")
+        self.partners = array("i")    # 媒体文件匹配到的 JSON 编号, -1 表示没有
+        self.sizes = array("q") if with_stats else None
+        self.mtimes = array("q") if with_stats else None
+        self._media_by_directory = None  # {目录编号: 媒体文件编号}, 找回已改名文件时才建立
+
+    @classmethod
+    def kind_of(cls, name):
+        suffix = split_file_name(name)[1].lower()
+        if suffix in image_extensions:
+            return cls.IMAGE
+        if suffix in video_extensions:
+            return cls.VIDEO
+        return cls.JSON
+
+    @classmethod
+    def from_paths(cls, media_files, json_files):
+        # 由 Path (或路径字符串) 列表建立目录表
+        catalog = cls()
+        for file_path in list(media_files) + list(json_files):
+            catalog.add_path(file_path)
+        return catalog
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        # 由匹配对 (media, json) 建立目录表, 多个媒体文件共用的 JSON 只保存一次
+        catalog = cls()
+        json_ids = {}
+        for media_file, json_file in pairs:
+            media_id = catalog.add_path(media_file)
+            if json_file:
+                json_file = str(json_file)
+                if json_file not in json_ids:
+                    json_ids[json_file] = catalog.add_path(json_file)
+                catalog.match(media_id, json_ids[json_file])
+        return catalog
+
+    def add_directory(self, folder):
+        folder = str(folder) or "."
+        dir_id = self.directory_ids.get(folder)
+        if dir_id is None:
+            dir_id = self.directory_ids[folder] = len(self.directories)
+            self.directories.append(folder)
+        return dir_id
+
+    def add(self, dir_id, name, kind, st=None):
+        index = len(self.names)
+        self.dir_ids.append(dir_id)
+        self.names.append(name)
+        self.kinds.append(kind)
+        self.states.append(self.UNMATCHED)
+        self.partners.append(-1)
+        if self.sizes is not None:
+            self.sizes.append(st.st_size if st else -1)
+            self.mtimes.append(st.st_mtime_ns if st else -1)
+        return index
+
+    def add_path(self, file_path, kind=None):
+        folder, name = os.path.split(str(file_path))
+        return self.add(self.add_directory(folder), name, self.kind_of(name) if kind is None else kind)
+
+    def path_str(self, i):
+        return join_path(self.directories[self.dir_ids[i]], self.names[i])
+
+    def path(self, i):
+        return Path(self.path_str(i))
+
+    def stat(self, i):
+        if self.sizes is None or self.sizes[i] < 0:
+            return None
+        return FileStat(self.sizes[i], self.mtimes[i])
+
+    def rename(self, i, new_path):
+        # 只用于同一目录内的改名 (更正扩展名)
+        self.names[i] = Path(new_path).name
+
+    def match(self, media_id, json_id):
+        self.partners[media_id] = json_id
+        self.states[media_id] = self.MATCHED
+        self.states[json_id] = self.MATCHED
+
+    def indices(self, *kinds, state=None):
+        return array("I", (i for i in range(len(self.names))
+                           if self.kinds[i] in kinds and (state is None or self.states[i] == state)))
+
+    def matched_media(self):
+        # 已匹配的媒体文件编号: 先图片后视频, 与匹配对字典的顺序相同
+        return self.indices(self.IMAGE, state=self.MATCHED) + self.indices(self.VIDEO, state=self.MATCHED)
+
+    def pair_count(self):
+        return sum(1 for i in range(len(self.names)) if self.kinds[i] != self.JSON and self.states[i] == self.MATCHED)
+
+    def pairs(self, media_ids):
+        return [(self.path(m), self.path(self.partners[m])) for m in media_ids]
+
+    def items(self):
+        # 与匹配对字典的 items() 相同, 逐个生成 (media_file, json_file)
+        for m in self.matched_media():
+            yield self.path(m), self.path(self.partners[m])
+
+    def media_paths_in(self, dir_id):
+        # 某个目录下所有已匹配媒体文件的当前路径 (只在找回已改名文件时使用)
+        if self._media_by_directory is None:
+            self._media_by_directory = {}
+            for m in self.matched_media():
+                self._media_by_directory.setdefault(self.dir_ids[m], array("I")).append(m)
+        return {self.path(m) for m in self._media_by_directory.get(dir_id, ())
+                if self.states[m] == self.MATCHED}
+
+    def directory_chunks(self, media_ids, size):
+        # 按所在目录分组, 每组最多 size 个文件编号
+        by_directory = {}
+        for m in media_ids:
+            by_directory.setdefault(self.dir_ids[m], array("I")).append(m)
+        for ids in by_directory.values():
+            for i in range(0, len(ids), size):
+                yield ids[i:i + size]
+
+    def jobs(self, media_ids, batch_size=1):
+        # 阶段 4 的任务, 只在提交任务时才构造 Path; batch_size > 1 时按目录分组
+        if batch_size > 1:
+            for ids in self.directory_chunks(media_ids, batch_size):
+                yield self.pairs(ids)
+        else:
+            for m in media_ids:
+                yield self.pairs((m,))
+
 
 def get_media_name_part_cut(media_file):
     '''
     get_media_name_part_cut 的 Docstring
     给定一个媒体文件路径, 提取可能的媒体文件名部分及其前45个字符
     '''
-    media_fullname = media_file.name  # 带扩展名的完整文件名
-    media_stem = media_file.stem  # 不带扩展名的文件名
-    media_ext = media_file.suffix  # 文件扩展名
+    return media_name_part_cut(media_file.name)
+
+
+def media_name_part_cut(media_fullname):
+    # 与 get_media_name_part_cut 相同, 但只需要文件名 (带扩展名的完整文件名), 不构造 Path
+    media_stem, media_ext = split_file_name(media_fullname)  # 不带扩展名的文件名, 文件扩展名
     # 获取前45个字符
     media_fullname_cut = get_file_name_cut(media_fullname)  # 获取媒体文件前45个字符，包括扩展名
     media_stem_cut = get_file_name_cut(media_stem)  #  获取媒体文件基名前45个字符
@@ -116,7 +700,12 @@ def get_json_stem_nodup(json_file):
     # 有没有去重编号: json_dupsuffix
     # 基名中是否包含媒体扩展名: ext_in_stem
     # 同时输出一个没有包含去重编号的基名: json_stem_nodup
-    json_stem = json_file.stem
+    return json_name_stem_nodup(json_file.name)
+
+
+def json_name_stem_nodup(json_fullname):
+    # 与 get_json_stem_nodup 相同, 但只需要文件名, 不构造 Path
+    json_stem = split_file_name(json_fullname)[0]
     # part.1 检查去重编号
     # 得到去重编号json_dupsuffix 
     # 和无论如何都没有了去重编号的json基名json_stem_nodup
@@ -182,138 +771,429 @@ def find_matching_json(media_file, all_json_files):
     return None  # 未找到匹配的 JSON 文件
 
 
-def live_photo_treat(media_file, matched_pairs):
-    # 对于可能是 live photo 类型的媒体文件，从已匹配的同名图片文件中寻找并建立对应的 JSON 文件
-    if media_file.suffix.lower() in video_extensions:
-        for ref_media_file in list(matched_pairs.keys()):
-            if (ref_media_file.parent == media_file.parent
-                and ref_media_file.suffix.lower() in image_extensions
-                and ref_media_file.stem.lower() == media_file.stem.lower()
-                and matched_pairs[ref_media_file]):
-                    new_json_fullname = media_file.name + ".json"
-                    new_json_file = media_file.parent / new_json_fullname
-                    try:
-                        shutil.copy2(matched_pairs[ref_media_file], new_json_file)
-                    except Exception as e:
-                        logging.error(f"[复制失败] 未能复制{matched_pairs[ref_media_file]}为{new_json_file}, 错误: {e}")   
-                    json_file = new_json_file
-                    update_json_title(media_file, json_file)
-                    print(f"LP.匹配成功: {media_file} <--> {json_file}")
+class _JsonBucket:
+    '''
+    _JsonBucket 的 Docstring
+    同一目录下、同一类 (是否含媒体扩展名, 去重编号) 的 JSON 文件
+    小写基名用 \\0 拼接成一个长字符串, 一次 str.find 即可找到第一个包含关键字的 JSON
+    '''
+    def __init__(self):
+        self.files = []     # JSON 文件路径
+        self.orders = []    # JSON 文件在原始遍历顺序中的序号
+        self.stems = []     # 去掉去重编号后的小写基名
+        self.used = []      # 是否已被匹配
+        self.haystack = None
+        self.offsets = None
+
+    def add(self, json_file, order, json_stem_nodup_lower):
+        self.files.append(json_file)
+        self.orders.append(order)
+        self.stems.append(json_stem_nodup_lower)
+        self.used.append(False)
+
+    def build(self):
+        self.offsets = []
+        pos = 0
+        for stem in self.stems:
+            self.offsets.append(pos)
+            pos += len(stem) + 1
+        self.haystack = "\0".join(self.stems) + "\0"
+
+    def find(self, key):
+        # 返回第一个基名包含 key 且未被使用的 JSON 的位置, 文件名中不可能出现 \0, 所以命中不会跨越两个基名
+        start = 0
+        while True:
+            pos = self.haystack.find(key, start)
+            if pos < 0:
+                return None
+            i = bisect_right(self.offsets, pos) - 1
+            if not self.used[i]:
+                return i
+            start = self.offsets[i] + len(self.stems[i]) + 1
+
+
+class JsonMatchIndex:
+    '''
+    JsonMatchIndex 的 Docstring
+    一次性解析所有 JSON 文件名, 按所在目录分组, 再按 (基名是否含媒体扩展名, 去重编号) 分桶
+    每个媒体文件只在同目录的相关桶里查找, 匹配结果与优先级 (E1D0/E1D1 > E0D0/E0D1) 与 find_matching_json 完全一致
+    给定 catalog 时, 文件用 FileCatalog 中的编号表示, 按 (目录编号, 文件名) 分组, 不构造 Path
+    '''
+    def __init__(self, all_json_files, catalog=None):
+        self.catalog = catalog
+        self.dirs = {}  # {parent: {(ext_flag, json_dupsuffix): _JsonBucket}}
+        self.location = {}  # {json_file: (bucket, 桶内位置)}
+        # 记录原始遍历顺序: 多个 JSON 同时满足条件时, 与逐个遍历一样取最先出现的那个
+        for order, json_file in enumerate(all_json_files):
+            parent, name = self._locate(json_file)
+            json_stem_nodup, ext_in_stem, json_dupsuffix = json_name_stem_nodup(name)
+            buckets = self.dirs.setdefault(parent, {})
+            bucket = buckets.get((bool(ext_in_stem), json_dupsuffix))
+            if bucket is None:
+                bucket = buckets[(bool(ext_in_stem), json_dupsuffix)] = _JsonBucket()
+            self.location[json_file] = (bucket, len(bucket.files))
+            bucket.add(json_file, order, json_stem_nodup.lower())
+        for buckets in self.dirs.values():
+            for bucket in buckets.values():
+                bucket.build()
+
+    def _locate(self, file):
+        # 返回 (所在目录, 文件名)
+        if self.catalog:
+            return self.catalog.dir_ids[file], self.catalog.names[file]
+        return file.parent, file.name
+
+    def _display(self, file):
+        return self.catalog.path_str(file) if self.catalog else file
+
+    def _first(self, buckets, candidates):
+        # candidates: [(桶键, 关键字, 规则名)], 返回原始顺序最靠前的命中
+        best = None
+        for bucket_key, key, rule in candidates:
+            bucket = buckets.get(bucket_key)
+            if bucket is None:
+                continue
+            i = bucket.find(key)
+            if i is not None and (best is None or bucket.orders[i] < best[0]):
+                best = (bucket.orders[i], bucket.files[i], rule)
+        return best
+
+    def find(self, media_file):
+        '''
+        find 的 Docstring
+        给定一个media_file, 返回匹配的JSON文件, 与 find_matching_json(media_file, 剩余JSON) 结果相同
+        '''
+        parent, name = self._locate(media_file)
+        buckets = self.dirs.get(parent)
+        if buckets:
+            (media_fullname_cut, media_stem_cut,
+             media_dupsuffix,
+             media_fullname_nodup_cut, media_stem_nodup_cut) = media_name_part_cut(name)
+            # step 1. 基名含媒体扩展名的 JSON; step 2. 基名不含媒体扩展名的 JSON
+            for ext_flag, key, key_nodup, rules in ((True, media_fullname_cut, media_fullname_nodup_cut, ("E1D0", "E1D1")),
+                                                    (False, media_stem_cut, media_stem_nodup_cut, ("E0D0", "E0D1"))):
+                candidates = [((ext_flag, None), key.lower(), rules[0])]
+                if media_dupsuffix:
+                    candidates.append(((ext_flag, media_dupsuffix), key_nodup.lower(), rules[1]))
+                best = self._first(buckets, candidates)
+                if best:
+                    _, json_file, rule = best
+                    run_stats.count(f"match.{rule}")
+                    print_file(f"{rule}.匹配成功: {self._display(media_file)} <--> {self._display(json_file)}")
                     return json_file
-    print(f"通过live_photo_treat未找到匹配的JSON文件 for {media_file}")
-    return None  # 未找到匹配的 JSON 文件
-    
+        print_file(f"通过find_matching_json未找到匹配的JSON文件 for {self._display(media_file)}")
+        return None  # 未找到匹配的 JSON 文件
 
-def find_matching_pairs(all_media_files, all_json_files):
-    # 匹配媒体文件与 JSON 文件，返回匹配对字典
-    # 0. 分离图片和视频文件列表
-    all_image_files = [f for f in all_media_files if f.suffix.lower() in image_extensions]
-    all_video_files = [f for f in all_media_files if f.suffix.lower() in video_extensions]
-    # 1. 先处理图片文件的匹配, 保证图片优先匹配, 找不到的同名视频可以通过 live photo 处理
-    print(f"--- 阶段 2.1: 寻找image文件的匹配 ---")
-    matched_pairs = dict.fromkeys(all_image_files, None)
-    for media_file in list(matched_pairs.keys()):
-        if matched_pairs[media_file] is None:
-            json_file = find_matching_json(media_file, all_json_files)
-            if json_file:
-                matched_pairs[media_file] = json_file
-                all_json_files.remove(json_file)  # 移除已匹配的 JSON 文件，防止重复使用
-    # 2. 再处理视频文件的匹配
-    print(f"--- 阶段 2.2: 寻找video文件的匹配 ---")
-    matched_pairs.update(dict.fromkeys(all_video_files, None))
-    for media_file in list(matched_pairs.keys()):
-        if matched_pairs[media_file] is None and media_file.suffix.lower() in video_extensions:
-            json_file = find_matching_json(media_file, all_json_files)
-            if json_file:
-                matched_pairs[media_file] = json_file
-                all_json_files.remove(json_file)  # 移除已匹配的 JSON 文件，防止重复使用
-    # 3. 再处理live photo可疑视频文件的匹配
-    print(f"--- 阶段 2.3: 处理live photo可疑video文件的匹配 ---")
-    for media_file in list(matched_pairs.keys()):
-        if (matched_pairs[media_file] is None 
-            and media_file.suffix.lower() in video_extensions):
-            json_file = live_photo_treat(media_file, matched_pairs)
-            if json_file:
-                matched_pairs[media_file] = json_file
+    def discard(self, json_file):
+        # 标记已匹配的 JSON 文件，防止重复使用
+        bucket, i = self.location[json_file]
+        bucket.used[i] = True
 
+
+# live photo 视频直接引用图片的 JSON, 不再复制一份 <视频名>.json (--live-photo-ref)
+live_photo_reference = False
+
+
+def copy_live_photo_json(ref_json_file, media_file, plan=None):
+    # 把同名图片的 JSON 复制为 <视频名>.json 并修改其中的 title, 返回新 JSON 的路径
+    new_json_file = media_file.parent / (media_file.name + ".json")
+    if plan:
+        plan.copy(ref_json_file, new_json_file)
+        plan.set_title(new_json_file, media_file.name)
+        return new_json_file
+    try:
+        durable_writes.copy(ref_json_file, new_json_file)
+    except Exception as e:
+        logging.error(f"[复制失败] 未能复制{ref_json_file}为{new_json_file}, 错误: {e}")
+    update_json_title(media_file, new_json_file)
+    return new_json_file
+
+
+def match_catalog(catalog, stage_headers=True, plan=None, unmatched=None):
+    '''
+    match_catalog 的 Docstring
+    在 FileCatalog 上匹配媒体文件与 JSON 文件, 匹配结果记入目录表 (partners/states), 规则和顺序与 find_matching_pairs 相同
+    未匹配的文件交给 unmatched (UnmatchedFiles) 处理, 状态记为 REMOVED
+    '''
+    # 0. 分离图片和视频文件
+    image_ids = catalog.indices(FileCatalog.IMAGE)
+    video_ids = catalog.indices(FileCatalog.VIDEO)
+    # 建立 JSON 索引, 每个 JSON 文件名只解析一次
+    json_index = JsonMatchIndex(catalog.indices(FileCatalog.JSON), catalog)
+    # 1. 先处理图片文件的匹配, 再处理视频文件的匹配
+    for header, media_ids in (("--- 阶段 2.1: 寻找image文件的匹配 ---", image_ids),
+                              ("--- 阶段 2.2: 寻找video文件的匹配 ---", video_ids)):
+        if stage_headers:
+            print(header)
+        for media_id in media_ids:
+            with run_stats.timer("match"):
+                json_id = json_index.find(media_id)
+            if json_id is not None:
+                catalog.match(media_id, json_id)
+                json_index.discard(json_id)
+    del json_index
+    # 3. 再处理live photo可疑视频文件的匹配
+    if stage_headers:
+        print(f"--- 阶段 2.3: 处理live photo可疑video文件的匹配 ---")
+    # 以 (目录编号, 小写基名) 为键索引已匹配的图片, 同一个键保留最先出现的图片
+    live_photo_index = {}
+    for image_id in image_ids:
+        if catalog.states[image_id] == FileCatalog.MATCHED:
+            key = (catalog.dir_ids[image_id], split_file_name(catalog.names[image_id])[0].lower())
+            live_photo_index.setdefault(key, image_id)
+    for video_id in video_ids:
+        if catalog.states[video_id] == FileCatalog.MATCHED:
+            continue
+        with run_stats.timer("live_photo"):
+            name = catalog.names[video_id]
+            image_id = live_photo_index.get((catalog.dir_ids[video_id], split_file_name(name)[0].lower()))
+            if image_id is None:
+                print_file(f"通过live photo未找到匹配的JSON文件 for {catalog.path_str(video_id)}")
+                continue
+            ref_json_id = catalog.partners[image_id]
+            if setting("live_photo_reference"):
+                # 与图片共用同一个 JSON, 阶段 3 只由图片改名这个 JSON
+                json_id = ref_json_id
+            else:
+                json_file = copy_live_photo_json(catalog.path(ref_json_id), catalog.path(video_id), plan)
+                json_id = catalog.add(catalog.dir_ids[video_id], json_file.name, FileCatalog.JSON)
+            catalog.match(video_id, json_id)
+            run_stats.count("match.LP")
+            print_file(f"LP.匹配成功: {catalog.path_str(video_id)} <--> {catalog.path_str(json_id)}")
+    del live_photo_index
     # 4. 善后清理
-    print(f"--- 阶段 2.4: 善后清理 ---")
-    matched_pairs = cleanup_matched_pairs(matched_pairs)
-    cleanup_unmatched_json(all_json_files)
+    if stage_headers:
+        print(f"--- 阶段 2.4: 善后清理 ---")
+    cleanup_catalog(catalog, plan, unmatched)
+    return catalog
 
-    return matched_pairs
 
+def cleanup_catalog(catalog, plan=None, unmatched=None):
+    # 把目录表中未匹配的媒体文件和 JSON 文件交给 unmatched 处理, 先媒体文件后 JSON 文件
+    unmatched = unmatched or UnmatchedFiles()
+    for kind, label in ((FileCatalog.IMAGE, "MEDIA"), (FileCatalog.VIDEO, "MEDIA"), (FileCatalog.JSON, "JSON")):
+        for i in catalog.indices(kind, state=FileCatalog.UNMATCHED):
+            file_path = catalog.path(i)
+            if label == "MEDIA" or file_path.exists():
+                unmatched.add(file_path, label, plan)
+            catalog.states[i] = FileCatalog.REMOVED
+    unmatched.flush()
 
-def cleanup_matched_pairs(matched_pairs):
+
+# 未匹配文件的目录名, 默认放在处理的根目录下, 扫描时跳过实际使用的移动目标目录
+unmatched_dir_name = "unmatched"
+# 每收集这么多个未匹配文件就执行一次移动, 限制内存占用
+unmatched_batch_size = 10000
+
+
+class UnmatchedFiles:
     '''
-    cleanup_matched_pairs 的 Docstring
-    清理匹配对字典，移除未匹配的项
+    UnmatchedFiles 的 Docstring
+    收集未匹配的文件并成批处理: 默认移到 <根目录>/unmatched/<相对路径>, 也可以用 target_root 指定其他目录
+    每批先一次建好所有目标目录, 再用 scan_workers 个线程并行移动; 源和目标在同一文件系统上时直接 os.rename (原子操作, 不复制数据)
+    给定 manifest 时不移动任何文件, 只把未匹配文件写入清单 (JSON Lines)
+    没有给定 root 时沿用原来的位置: 当前目录下的 unmatched/<去掉盘符的绝对路径>
     '''
-    # 1. 创建待删除键的列表
-    keys_to_delete = []
-    for media_file in matched_pairs:
-        if matched_pairs[media_file] is None:
+    def __init__(self, root=None, target_root=None, manifest=None):
+        self.root = Path(os.path.abspath(root)) if root else None
+        if target_root:
+            self.target_root = Path(target_root)
+        elif self.root:
+            self.target_root = self.root / unmatched_dir_name
+        else:
+            self.target_root = Path(unmatched_dir_name)
+        self.manifest = open(manifest, "w", encoding="utf-8") if manifest else None
+        self.pending = []  # [(源文件, 目标文件, 类别)]
+        self.lock = threading.Lock()
+        self.moved = self.failed = 0
+
+    def scan_exclude(self):
+        # 扫描时应跳过的目录: 实际的移动目标目录; 只写清单时不移动文件, 不跳过任何目录
+        return None if self.manifest else self.target_root
+
+    def target(self, file_path):
+        if self.root:
+            try:
+                return self.target_root / Path(os.path.abspath(file_path)).relative_to(self.root)
+            except ValueError:
+                pass
+        file_path = Path(file_path)
+        relative_path = file_path if file_path.anchor == '' else file_path.relative_to(file_path.anchor)
+        return self.target_root / relative_path
+
+    def add(self, file_path, label, plan=None):
+        # label 为 "MEDIA" 或 "JSON"; 给定 plan 时只把移动记入计划
+        run_stats.count("match.unmatched" if label == "MEDIA" else "match.unmatched_json")
+        if self.manifest:
+            with self.lock:
+                self.manifest.write(json.dumps({"kind": label.lower(), "path": os.path.abspath(file_path)}, ensure_ascii=False) + "\n")
+            return
+        target_path = self.target(file_path)
+        if plan:
+            plan.move(file_path, target_path)
+            return
+        with self.lock:
+            self.pending.append((file_path, target_path, label))
+            full = len(self.pending) >= unmatched_batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        # 执行已收集的移动: 先建目录, 再并行移动
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if not pending:
+            return
+        for target_dir in {target_path.parent for _, target_path, _ in pending}:
             try:
-                if media_file.anchor == '':
-                    media_relative_path = media_file
-                else:
-                    media_relative_path = media_file.relative_to(media_file.anchor)
-                target_dir = Path("unmatched") / media_relative_path.parent
                 target_dir.mkdir(parents=True, exist_ok=True)
-                target_path = target_dir / media_file.name
-                print(f"[清理] 正在移动未匹配 MEDIA 文件: {media_file} -> {target_path}")
-                logging.info(f"[清理] 未匹配 MEDIA 文件: {media_file} -> {target_path}")
-                shutil.move(str(media_file), str(target_path))
-            except Exception as e:
-                logging.error(f"[清理失败] 移动未匹配文件: {media_file} -> {target_path}, 错误: {e}")
-            keys_to_delete.append(media_file)
-    # 2. 删除未匹配的键
-    for key in keys_to_delete:
-        del matched_pairs[key]
+            except OSError as e:
+                logging.error(f"[清理失败] 创建目录 {target_dir} 时出错: {e}")
+        if len(pending) == 1:
+            self._move(pending[0])
+            return
+        with ContextThreadPoolExecutor(max_workers=setting("scan_workers")) as executor:
+            for _ in executor.map(self._move, pending):
+                pass
+
+    def _move(self, item):
+        file_path, target_path, label = item
+        failed = "移动未匹配文件" if label == "MEDIA" else "移动未匹配 JSON 文件"
+        try:
+            print_file(f"[清理] 正在移动未匹配 {label} 文件: {file_path} -> {target_path}")
+            logging.info(f"[清理] 未匹配 {label} 文件: {file_path} -> {target_path}")
+            durable_writes.move(file_path, target_path)
+            with self.lock:
+                self.moved += 1
+        except Exception as e:
+            logging.error(f"[清理失败] {failed}: {file_path} -> {target_path}, 错误: {e}")
+            with self.lock:
+                self.failed += 1
+
+    def close(self):
+        self.flush()
+        if self.manifest:
+            self.manifest.close()
+            self.manifest = None
 
+
+def find_matching_pairs(all_media_files, all_json_files, stage_headers=True, plan=None, unmatched=None):
+    # 匹配媒体文件与 JSON 文件，返回匹配对字典
+    # stage_headers=False 时不打印各小阶段的标题 (流式模式下每个目录调用一次)
+    # 给定 plan (演练模式) 时, 复制 live photo 的 JSON 和移动未匹配文件只记入计划
+    # 匹配在 FileCatalog 上完成 (见 match_catalog), 已匹配的 JSON 从 all_json_files 中移除
+    catalog = match_catalog(FileCatalog.from_paths(all_media_files, all_json_files), stage_headers, plan, unmatched)
+    matched_pairs = dict(catalog.items())
+    matched_json = set(matched_pairs.values())
+    if isinstance(all_json_files, set):
+        all_json_files -= matched_json
+    else:
+        all_json_files[:] = [f for f in all_json_files if f not in matched_json]
     return matched_pairs
 
 
-def cleanup_unmatched_json(all_json_files):
+# --- 阶段 3: 按文件内容识别类型 ---
+# 识别类型时读取的文件头长度 (与 filetype 相同)
+sniff_header_size = 8192
+# HEIF 图片的 ftyp 品牌 (filetype 只认识 heic 以及兼容 heic 的 mif1/msf1)
+heif_brands = {"heic", "heix", "heim", "heis", "hevc", "hevx"}
+# 没有 ftyp 的老式 QuickTime 文件以这些 atom 开头
+quicktime_atoms = {b"moov", b"mdat", b"wide", b"free", b"skip", b"pnot"}
+# 每个线程复用一个文件头缓冲区
+_sniff_buffers = threading.local()
+
+
+def isobmff_extension(header):
+    # 根据 ftyp 的主品牌和兼容品牌识别 HEIC 和 MOV, 其他品牌返回 None, 交给 filetype
+    # 主品牌为 "qt  " 的 MOV 如果兼容品牌里有 isom, filetype 会误认为 MP4
+    major_brand = bytes(header[8:12]).decode("latin-1")
+    if major_brand in heif_brands:
+        return ".heic"
+    if major_brand == "qt  ":
+        return ".mov"
+    if major_brand in ("mif1", "msf1"):
+        box_size = int.from_bytes(header[0:4], "big")
+        compatible_brands = {bytes(header[i:i + 4]).decode("latin-1") for i in range(16, min(box_size, len(header)) - 3, 4)}
+        if compatible_brands & heif_brands:
+            return ".heic"
+    return None
+
+
+def sniff_media_type(media_file):
     '''
-    cleanup_unmatched_json 的 Docstring
-    清理未匹配的 JSON 文件，移动到 unmatched 目录
+    sniff_media_type 的 Docstring
+    按文件内容识别类型, 返回扩展名 (如 ".jpg"、".heic"、".mov"), 无法识别时返回 None
+    文件头只读取一次, 读入本线程复用的缓冲区; HEIC 和 MOV 按 ftyp 品牌或开头的 atom 识别, 其他格式交给 filetype
     '''
-    for json_file in all_json_files:
-        if json_file and json_file.exists():
-            try:
-                if json_file.anchor == '':
-                    json_relative_path = json_file
-                else:
-                    json_relative_path = json_file.relative_to(json_file.anchor)
-                target_dir = Path("unmatched") / json_relative_path.parent
-                target_dir.mkdir(parents=True, exist_ok=True)
-                target_path = target_dir / json_file.name
-                print(f"[清理] 正在移动未匹配 JSON 文件: {json_file} -> {target_path}")
-                logging.info(f"[清理] 未匹配 JSON 文件: {json_file} -> {target_path}")
-                shutil.move(str(json_file), str(target_path))
-            except Exception as e:
-                logging.error(f"[清理失败] 移动未匹配 JSON 文件: {json_file} -> {target_path}, 错误: {e}")
+    buffer = getattr(_sniff_buffers, "buffer", None)
+    if buffer is None:
+        buffer = _sniff_buffers.buffer = bytearray(sniff_header_size)
+    with open(media_file, "rb", buffering=0) as f:
+        size = f.readinto(buffer)
+    return sniff_header(memoryview(buffer)[:size])
 
 
-def let_ext_correct(media_file, json_file):
-    # 检测文件类型
-    kind = filetype.guess(media_file)
+def sniff_header(header):
+    # 根据文件头 (bytes 或 memoryview) 识别类型, 返回扩展名, 无法识别时返回 None
+    size = len(header)
+    if size >= 12:
+        box_type = bytes(header[4:8])
+        box_size = int.from_bytes(header[0:4], "big")
+        if box_type == b"ftyp":
+            extension = isobmff_extension(header)
+            if extension:
+                return extension
+        elif box_type in quicktime_atoms and (box_size == 1 or box_size >= 8):
+            return ".mov"
+    kind = filetype.guess(bytes(header))
     if kind is None:
+        return None
+    return ".jpg" if kind.extension == "jpeg" else f".{kind.extension}"
+
+
+def detect_media_types(media_files, cache=None, executor=None, stats=None):
+    '''
+    detect_media_types 的 Docstring
+    并行识别一组媒体文件的类型, 返回 {media_file: 扩展名}, 无法识别为 "", 读取出错为 None
+    给定 cache 时, 文件没有变化就直接使用上次识别的结果, stats 为扫描阶段取得的 {media_file: stat 结果}, 避免再次 stat;
+    executor 为 None 时临时创建线程池
+    '''
+    def detect(media_file):
+        if cache:
+            kind = cache.cached_kind(media_file, stats.get(media_file) if stats else None)
+            if kind is not None:
+                return kind
+        try:
+            with run_stats.timer("type_detect"):
+                return sniff_media_type(media_file) or ""
+        except OSError:
+            return None  # 交给 let_ext_correct 按原流程处理 (例如文件已被改名)
+
+    if executor is None:
+        with ContextThreadPoolExecutor(max_workers=setting("scan_workers")) as executor:
+            return dict(zip(media_files, executor.map(detect, media_files)))
+    return dict(zip(media_files, executor.map(detect, media_files)))
+
+
+def let_ext_correct(media_file, json_file, plan=None, detected_extension=None):
+    # 给定 plan (演练模式) 时只把改名和修改 title 记入计划, 不修改文件
+    # detected_extension 为已经识别出的类型 (detect_media_types 的结果), 为 None 时在这里识别
+    # 检测文件类型
+    if detected_extension is None:
+        with run_stats.timer("type_detect"):
+            detected_extension = sniff_media_type(media_file)
+    if not detected_extension:
         print(f"! 无法识别文件类型: {media_file}")
         return media_file, json_file
-    detected_extension = f".{kind.extension}"
     current_extension = Path(media_file).suffix.lower()
-    if detected_extension == ".jpeg":  # jpg有两种扩展名
-        detected_extension = ".jpg"
-    if current_extension == ".jpeg":
+    if current_extension == ".jpeg":  # jpg有两种扩展名
         current_extension = ".jpg"
     if detected_extension != current_extension:
         # 构建新文件名
         new_media_fullname = Path(media_file).stem + detected_extension
         new_media_file = Path(media_file).with_name(new_media_fullname)
         count = 1
-        while new_media_file.exists():  # 如果新文件名已存在，添加数字后缀
+        while plan.exists(new_media_file) if plan else new_media_file.exists():  # 如果新文件名已存在，添加数字后缀
             if re.search(r"_\d{1,2}$", Path(new_media_file).stem):
                 new_media_fullname = re.sub(r"_\d{1,2}$", f"_{count}", Path(new_media_file).stem) + detected_extension
             else:
@@ -322,8 +1202,14 @@ def let_ext_correct(media_file, json_file):
             count += 1
         # 重命名媒体文件
         try: 
-            print(f"- 更正扩展名: {Path(media_file).name} --> {Path(new_media_file).name}")
-            Path(media_file).rename(new_media_file)
+            print_file(f"- 更正扩展名: {Path(media_file).name} --> {Path(new_media_file).name}")
+            if plan:
+                plan.rename(media_file, new_media_file)
+            else:
+                with run_stats.timer("rename"):
+                    Path(media_file).rename(new_media_file)
+                durable_writes.moved(media_file, new_media_file)
+            run_stats.count("ext.renamed")
             media_file = new_media_file  # 更新media_file为新文件名
         except Exception as e:
             logging.error(f"! 重命名文件 {Path(media_file).name} 时出错: {e}")
@@ -333,183 +1219,2481 @@ def let_ext_correct(media_file, json_file):
             try:
                 new_json_fullname = Path(media_file).name + ".json"
                 new_json_file = Path(json_file).with_name(new_json_fullname)
-                print(f"- 更正对应json文件名: {Path(json_file).name} --> {Path(new_json_file).name}")
-                Path(json_file).rename(new_json_file)
+                print_file(f"- 更正对应json文件名: {Path(json_file).name} --> {Path(new_json_file).name}")
+                if plan:
+                    plan.rename(json_file, new_json_file)
+                else:
+                    with run_stats.timer("rename"):
+                        Path(json_file).rename(new_json_file)
+                    durable_writes.moved(json_file, new_json_file)
+                    sidecar_cache.rename(json_file, new_json_file)
                 json_file = new_json_file  # 更新json_file为新文件名
             except Exception as e:
                 logging.error(f"! 重命名文件 {Path(json_file).name} 时出错: {e}")
         # 更新json中的title值
-        if json_file:
+        if json_file and plan:
+            plan.set_title(json_file, Path(media_file).name)
+        elif json_file:
             update_json_title(media_file, json_file)
 
     return media_file, json_file  # 返回更新后的文件路径
 
 
-def correct_ext_of_matched_pairs(matched_pairs):
+def shared_json_files(pairs):
+    # --live-photo-ref 时 live photo 视频与图片共用同一个 JSON, 返回被多个媒体文件共用的 JSON 集合
+    counts = Counter(json_file for _, json_file in pairs if json_file)
+    return {json_file for json_file, count in counts.items() if count > 1}
+
+
+def let_ext_correct_shared(media_file, json_file, shared, renamed_json, plan=None, detected_extension=None):
     '''
-    correct_ext_of_matched_pairs 的 Docstring
-    对匹配对中的媒体文件进行扩展名更正
+    let_ext_correct_shared 的 Docstring
+    shared 中的 JSON 被多个媒体文件共用: 只由图片按自己的新文件名改名, 改名结果记入 renamed_json,
+    视频只更正自己的扩展名, 并沿用图片改名后的 JSON
     '''
-    for media_file in list(matched_pairs.keys()):
-        json_file = matched_pairs[media_file]
-        new_media_file, new_json_file = let_ext_correct(media_file, json_file)
-        # 如果文件名有变更，更新匹配对字典的键和值
-        if new_media_file != media_file:
-            matched_pairs[new_media_file] = matched_pairs.pop(media_file)
-        if new_json_file != json_file:
-            matched_pairs[new_media_file] = new_json_file
-    return matched_pairs
+    json_file = renamed_json.get(json_file, json_file)
+    if json_file in shared and media_file.suffix.lower() in video_extensions:
+        new_media_file, _ = let_ext_correct(media_file, None, plan, detected_extension)
+        return new_media_file, json_file
+    new_media_file, new_json_file = let_ext_correct(media_file, json_file, plan, detected_extension)
+    if json_file in shared and new_json_file != json_file:
+        renamed_json[json_file] = new_json_file
+        shared.add(new_json_file)
+    return new_media_file, new_json_file
 
 
-def update_media_metadata(media_file, json_file):
-    """
-    使用 ExifTool 将 JSON 信息写入媒体文件 (支持 JPG, HEIC, MP4, MOV)
-    """
+# 阶段 3 每次并行识别类型的文件数, 识别结果只在内存中保留一组
+ext_chunk_size = 1000
+
+
+def correct_ext_of_catalog(catalog, journal=None, cache=None, plan=None, detected_types=None):
+    '''
+    correct_ext_of_catalog 的 Docstring
+    对目录表中已匹配的媒体文件进行扩展名更正, 改名结果直接写回目录表
+    给定 journal 时跳过已完成的文件, 并记录每次更正的结果
+    给定 cache 时跳过上次运行后没有变化的文件 (扩展名当时已经更正过)
+    给定 plan 时只记录计划, 不修改文件
+    文件类型按组 (ext_chunk_size) 用线程池并行识别, 改名仍按顺序执行, 避免同一目录下的新文件名互相冲突
+    多个媒体文件共用的 JSON 在目录表中只有一项, 由图片改名后视频自动沿用新文件名
+    detected_types 为已经识别出的类型 {媒体文件路径字符串: 扩展名} (例如读取压缩包时), 给定时不再读取文件头
+    '''
+    media_ids = catalog.matched_media()
+    # 每个 JSON 被引用的次数 (最多记到 2)
+    uses = array("B", bytes(len(catalog.names)))
+    for media_id in media_ids:
+        json_id = catalog.partners[media_id]
+        uses[json_id] = min(uses[json_id] + 1, 2)
+    with ContextThreadPoolExecutor(max_workers=setting("scan_workers")) as executor:
+        for start in range(0, len(media_ids), ext_chunk_size):
+            todo = {}
+            for media_id in media_ids[start:start + ext_chunk_size]:
+                media_key = catalog.path_str(media_id)
+                if cache and cache.lookup(media_key, verify_content=False, st=catalog.stat(media_id)):
+                    continue
+                if journal and journal.is_ext_done(media_key):
+                    continue
+                todo[catalog.path(media_id)] = media_id
+            if detected_types is not None:
+                detected = {media_file: detected_types.get(catalog.path_str(media_id), "") for media_file, media_id in todo.items()}
+            else:
+                stats = {media_file: catalog.stat(media_id) for media_file, media_id in todo.items()} if cache else None
+                detected = detect_media_types(list(todo), cache, executor, stats)
+            for media_file, media_id in todo.items():
+                json_id = catalog.partners[media_id]
+                json_file = catalog.path(json_id)
+                journal_key = media_file
+                if journal and not media_file.exists():
+                    # 上次运行已重命名但还没来得及写入日志, 在同目录下找回改名后的文件
+                    recovered = recover_renamed_pair(media_file, json_file, catalog.media_paths_in(catalog.dir_ids[media_id]))
+                    if recovered is None:
+                        logging.error(f"! 找不到文件 {media_file}, 已从匹配对中移除")
+                        catalog.states[media_id] = FileCatalog.REMOVED
+                        journal.record_rename(journal_key, None, None)
+                        continue
+                    media_file, json_file = recovered
+                    catalog.rename(media_id, media_file)
+                    catalog.rename(json_id, json_file)
+                shared = uses[json_id] > 1
+                if shared and catalog.kinds[media_id] == FileCatalog.VIDEO:
+                    # 共用的 JSON 只由图片改名, 视频只更正自己的扩展名
+                    new_media_file, _ = let_ext_correct(media_file, None, plan, detected[journal_key])
+                    new_json_file = json_file
+                else:
+                    new_media_file, new_json_file = let_ext_correct(media_file, json_file, plan, detected[journal_key])
+                if cache and detected[journal_key]:
+                    # 记住识别结果, 之后的运行中文件没有变化时不再读取文件头
+                    cache.record_kind(new_media_file, detected[journal_key])
+                if journal and shared and new_json_file != json_file:
+                    journal.record_json_rename(json_file, new_json_file)
+                # 如果文件名有变更，更新目录表中的文件名
+                catalog.rename(media_id, new_media_file)
+                catalog.rename(json_id, new_json_file)
+                if journal:
+                    journal.record_rename(journal_key, new_media_file, new_json_file)
+    return catalog
+
+
+def recover_renamed_pair(media_file, json_file, taken=()):
+    '''
+    recover_renamed_pair 的 Docstring
+    media_file 已不存在时, 按 let_ext_correct 的命名规则 (同基名或 基名_N + 新扩展名) 在同目录下找回改名后的文件
+    taken 中的文件属于其他匹配对, 不作为候选; 找不到时返回 None
+    '''
+    pattern = re.compile(re.escape(media_file.stem.lower()) + r"(_\d{1,2})?")
+    candidates = []
     try:
-        # 1. 读取 JSON 数据
-        data = json.loads(json_file.read_text(encoding="utf-8"))
-        # 2. 获取并处理时间戳
-        timestamp = None
-        if "photoTakenTime" in data and "timestamp" in data["photoTakenTime"]:
-            timestamp = float(data["photoTakenTime"]["timestamp"])
-        elif "creationTime" in data and "timestamp" in data["creationTime"]:
-            timestamp = float(data["creationTime"]["timestamp"])
-        if not timestamp:
-            print(f"! JSON中未找到时间戳, 跳过")
-            return
-        # 将时间戳转换为 ExifTool 需要的字符串格式 "YYYY:MM:DD HH:MM:SS"
-        # 注意：这里使用 local_timezone (在脚本开头定义的)
-        timestamp_localized = datetime.fromtimestamp(timestamp, local_timezone)
-        date_str = timestamp_localized.strftime("%Y:%m:%d %H:%M:%S")
-        # 3. 准备 ExifTool 命令参数
-        cmd = [
-            "exiftool", 
-            "-charset filename=utf8",  # 处理文件名中的非ASCII字符
-            "-overwrite_original",   # -overwrite_original: 直接覆盖原文件，不生成 _original 备份
-            "-P",   # -P: 保留文件系统修改时间 (虽然我们后面会手动改，但加个保险)
-            "-u",  # -u: 允许写入未知标签 (增加兼容性)
-            f"-AllDates={date_str}",    # 写入所有常见日期标签 (DateTimeOriginal, CreateDate, ModifyDate)
-        ]
-        # 4. 处理 GPS 信息
-        geo = data.get('geoDataExif') or data.get('geoData')
-        if geo and geo.get('latitude', 0.0) != 0.0:
-            lat = geo['latitude']
-            lng = geo['longitude']
-            alt = geo.get('altitude', 0)
-            # ExifTool 非常智能，直接传带符号的浮点数，它会自动计算 Ref (N/S, E/W)
-            cmd.append(f"-GPSLatitude={lat}")
-            cmd.append(f"-GPSLatitudeRef={lat}")
-            cmd.append(f"-GPSLongitude={lng}")
-            cmd.append(f"-GPSLongitudeRef={lng}")
-            cmd.append(f"-GPSAltitude={alt}")
-            # 针对视频文件的特殊 GPS 标签 (QuickTime)
-            # 格式通常为 "+23.1250+113.3393/"
-            if media_file.suffix.lower() in video_extensions:
-                 # 简单的视频 GPS 格式化，ExifTool 对视频 GPS 支持稍微复杂一点，这行尝试写入通用的 Keys
-                cmd.append(f"-Keys:GPSCoordinates={lat}, {lng}, {alt}")
-        # 5. 添加目标文件路径
-        # 必须把路径转为字符串
-        cmd.append(str(media_file))
-        # 6. 执行命令
-        # Windows下如果不把 exiftool.exe 放 PATH，可能需要指定完整路径，如 ".\exiftool.exe"
-        # 这里假设你把它放在了同目录或 PATH 里
-        exiftool_cmd = "exiftool" 
-        if os.path.exists("exiftool.exe"): # 如果当前目录下有
-            exiftool_cmd = os.path.abspath("exiftool.exe")
-        cmd[0] = exiftool_cmd
-        print(f"  - 正在调用 ExifTool 写入元数据...")
-        # capture_output=True 可以隐藏控制台的大量输出，只看报错
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode == 0:
-            print(f"√ ExifTool 写入成功")
-        else:
-            logging.error(f"ExifTool 报错 {media_file.name}: {result.stderr}")
-            print(f"! ExifTool 报错: {result.stderr.strip()}")
-        # 7. (可选) 再次强制刷新文件系统时间
-        # 虽然 ExifTool 加了 -FileModifyDate，但有时候 Python 的 os.utime 更准
-        set_file_times(media_file, timestamp)
-        set_file_times(json_file, timestamp)
-    except Exception as e:
-        logging.error(f"元数据更新流程出错 {media_file.name}: {e}")
-        print(f"! 错误: {e}")
+        with os.scandir(media_file.parent) as entries:
+            for entry in entries:
+                candidate = media_file.parent / entry.name
+                if (entry.is_file()
+                    and candidate not in taken
+                    and candidate.suffix.lower() in media_extensions
+                    and pattern.fullmatch(candidate.stem.lower())):
+                    candidates.append(candidate)
+    except OSError as e:
+        logging.error(f"! 读取目录 {media_file.parent} 时出错: {e}")
+        return None
+    # 优先选择已有对应 json 的候选文件
+    candidates.sort(key=lambda c: not c.with_name(c.name + ".json").exists())
+    for candidate in candidates:
+        new_json_file = json_file
+        if json_file and not json_file.exists():
+            new_json_file = candidate.with_name(candidate.name + ".json")
+            if not new_json_file.exists():
+                continue
+        print_file(f"- 找回已改名文件: {media_file.name} --> {candidate.name}")
+        return candidate, new_json_file
+    return None
 
 
-def update_media_metadata_with_matched_pairs(matched_pairs):
+# --- ExifTool 常驻进程池 ---
+# 单个 ExifTool 命令的超时时间 (秒), 超时视为进程卡死, 会被杀掉并重启
+exiftool_timeout = 300
+
+
+def get_exiftool_path():
+    # Windows下如果不把 exiftool.exe 放 PATH，可能需要指定完整路径，如 ".\exiftool.exe"
+    # 这里假设你把它放在了同目录或 PATH 里
+    exiftool_cmd = "exiftool"
+    if os.path.exists("exiftool.exe"):  # 如果当前目录下有
+        exiftool_cmd = os.path.abspath("exiftool.exe")
+    return exiftool_cmd
+
+
+def exiftool_result_ok(stdout, stderr):
+    # stay_open 模式下没有返回码, 根据输出判断单个文件是否写入成功
+    if "weren't updated due to errors" in stdout:
+        return False
+    return not any(line.startswith("Error") for line in stderr.splitlines())
+
+
+def _pipe_reader(pipe, line_queue):
+    # 后台线程: 逐行读取 ExifTool 的输出, 进程退出时放入 None
+    try:
+        for line in pipe:
+            line_queue.put(line)
+    except (OSError, ValueError):
+        pass
+    line_queue.put(None)
+
+
+class ExifToolWorker:
     '''
-    update_metadata_of_matched_pairs 的 Docstring
-    对匹配对中的媒体文件进行元数据更新
+    ExifToolWorker 的 Docstring
+    一个常驻的 exiftool -stay_open True -@ - 进程, 通过 stdin 接收参数块, 用 -execute 序号标记每条命令的结束
     '''
-    for media_file in list(matched_pairs.keys()):
-        json_file = matched_pairs[media_file]
-        if json_file:
-            print(f"--- 正在使用 {json_file} 更新元数据: {media_file} ---")
-            update_media_metadata(media_file, json_file)
-    return matched_pairs
+    def __init__(self):
+        self.proc = None
+        self.seq = 0
+        self.start()
+
+    def start(self):
+        self.proc = subprocess.Popen(
+            [get_exiftool_path(), "-stay_open", "True", "-@", "-"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            text=True, encoding="utf-8", errors="replace")
+        self.stdout_queue = queue.Queue()
+        self.stderr_queue = queue.Queue()
+        for pipe, line_queue in ((self.proc.stdout, self.stdout_queue), (self.proc.stderr, self.stderr_queue)):
+            threading.Thread(target=_pipe_reader, args=(pipe, line_queue), daemon=True).start()
 
-def update_media_metadata_with_matched_pairs_multi_tasking(matched_pairs):
-    tasks = list(matched_pairs.items())
-    workers = os.cpu_count() or 8
-    with ThreadPoolExecutor(max_workers=workers) as executor: # 例如使用8个线程
-        # 提交阶段 4 的所有元数据更新任务
-        futures = {executor.submit(update_media_metadata, media_path, json_path): (media_path, json_path) for media_path, json_path in tasks}
-        # 等待所有任务完成
-        for future in as_completed(futures):
-            # 处理结果或异常
-            # 🚨 查找原始文件路径
-            media_path, json_path = futures[future]  
+    def kill(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+    def restart(self):
+        self.kill()
+        self.start()
+
+    def _collect(self, line_queue, marker, deadline):
+        # 读取输出直到遇到 {readyN} 标记
+        lines = []
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("ExifTool 响应超时")
             try:
-                # 尝试获取任务结果（这也会触发异常，如果任务失败）
-                future.result()     
-            except Exception as e:
-                # 报告错误时，可以明确指出是哪个文件出了问题
-                logging.error(f"--- 阶段 4:处理文件 {media_path.name} 时发生错误: {e}")
-            pass
+                line = line_queue.get(timeout=remaining)
+            except queue.Empty:
+                raise TimeoutError("ExifTool 响应超时")
+            if line is None:
+                raise EOFError("ExifTool 进程意外退出")
+            if line.strip() == marker:
+                return "".join(lines)
+            lines.append(line)
 
+    def execute(self, args, timeout=None):
+        '''
+        execute 的 Docstring
+        发送一组参数 (每行一个参数), 返回 (stdout, stderr)
+        '''
+        results = []
+        self.execute_many([args], results, timeout)
+        return results[0]
 
-# ⭐ 主函数 (修改为两阶段处理) ⭐
-def repair_media_files(directory):
-    # 2.1 构造基于目录的日志文件名
-    # 规范化目录名，防止特殊字符
-    sanitized_dir = Path(directory).name.replace(os.sep, '_').replace(':', '_').replace(' ', '_')
-    log_filename = f"media_file_repair_{sanitized_dir}.log"
+    def execute_many(self, commands, results, timeout=None):
+        '''
+        execute_many 的 Docstring
+        把多条命令用 -execute 分隔, 拼成一个参数块一次写入, 再按序号依次读取每条命令的输出
+        每完成一条命令就把 (stdout, stderr) 追加到 results, 出错时 results 中保留已完成的部分
+        '''
+        lines = []
+        markers = []
+        for args in commands:
+            self.seq += 1
+            marker = f"{{ready{self.seq}}}"
+            lines += list(args) + ["-echo4", marker, f"-execute{self.seq}"]
+            markers.append(marker)
+        self.proc.stdin.write("\n".join(lines) + "\n")
+        self.proc.stdin.flush()
+        for marker in markers:
+            # 每条命令单独计算超时
+            deadline = time.monotonic() + (timeout or exiftool_timeout)
+            stdout = self._collect(self.stdout_queue, marker, deadline)
+            stderr = self._collect(self.stderr_queue, marker, deadline)
+            results.append((stdout, stderr))
 
-    # 2.2 配置日志（只在这个实例中生效）
-    # 注意：要用 filemode='w' 清空旧日志，或用 'a' 追加
-    logging.basicConfig(filename=log_filename, level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", encoding="utf-8", filemode='a')
-    print(f"日志文件: {log_filename}")
+    def close(self):
+        try:
+            self.proc.stdin.write("-stay_open\nFalse\n")
+            self.proc.stdin.flush()
+            self.proc.wait(timeout=10)
+        except Exception:
+            self.kill()
 
-    # --- 阶段 1: 寻找并归类媒体文件与配置文件 --- 遍历：扫描所有文件，建立媒体文件和 JSON 文件的初始列表
-    print(f"--- 阶段 1: 寻找并归类媒体文件与配置文件 ---")
-    all_media_files = collect_all_files(directory, media_extensions)
-    all_json_files = collect_all_files(directory, json_extensions)      
-    all_json_files = set(all_json_files)  # 转为集合以便后续移除已匹配的 JSON 文件      
-    print(f"扫描完成。发现 {len(all_media_files)} 个媒体文件，{len(all_json_files)} 个 JSON 文件。")
 
-    # --- 阶段 2: 匹配媒体文件与配置文件 --- 建立配对列表
-    print(f"--- 阶段 2: 匹配媒体文件与配置文件 ---")
-    matched_pairs = find_matching_pairs(all_media_files, all_json_files)
-    print(f"匹配完成。共匹配到 {len(matched_pairs) - list(matched_pairs.values()).count(None)} 对媒体文件与 JSON 文件。")
-    
-    # --- 阶段 3: 更正扩展名 ---
-    print(f"--- 阶段 3: 更正扩展名 ---")
-    matched_pairs = correct_ext_of_matched_pairs(matched_pairs)
-    print(f"扩展名更正完成。")
-    
-    # --- 阶段 4: 更新元数据 ---
-    print(f"--- 阶段 4: 更新元数据 ---")
-    update_media_metadata_with_matched_pairs_multi_tasking(matched_pairs)
-    
-    
-    print(f"元数据更新完成。")
+class ExifToolPool:
+    '''
+    ExifToolPool 的 Docstring
+    常驻 ExifTool 进程池, 每个工作线程借用一个进程, 避免每个文件都重新启动 Perl 解释器
+    进程崩溃时自动重启并重试一次, 卡死 (超时) 时杀掉重启并报告失败
+    '''
+    def __init__(self, size):
+        self.workers = [ExifToolWorker() for _ in range(size)]
+        self.idle = queue.Queue()
+        for worker in self.workers:
+            self.idle.put(worker)
 
-    
+    def execute(self, args, timeout=None):
+        '''
+        execute 的 Docstring
+        在空闲进程上执行一组参数, 返回 (是否成功, stdout, stderr)
+        '''
+        return self.execute_many([args], timeout)[0]
 
+    def execute_many(self, commands, timeout=None):
+        '''
+        execute_many 的 Docstring
+        在同一个空闲进程上一次性发送多条命令, 返回每条命令的 (是否成功, stdout, stderr)
+        进程崩溃时重启并从未完成的命令继续, 同一条命令连续崩溃两次或卡死则记为失败
+        '''
+        worker = self.idle.get()
+        results = []
+        crashed_at = None
+        try:
+            while len(results) < len(commands):
+                done = []
+                error = None
+                try:
+                    worker.execute_many(commands[len(results):], done, timeout)
+                except TimeoutError as e:
+                    logging.error(f"ExifTool 进程卡死, 正在重启: {e}")
+                    worker.restart()
+                    error = str(e)
+                except (EOFError, OSError) as e:
+                    logging.error(f"ExifTool 进程崩溃, 正在重启: {e}")
+                    worker.restart()
+                    index = len(results) + len(done)
+                    if crashed_at == index:
+                        error = "ExifTool 进程重启后仍然失败"
+                    crashed_at = index
+                results += [(exiftool_result_ok(stdout, stderr), stdout, stderr) for stdout, stderr in done]
+                if error:
+                    results.append((False, "", error))
+            return results
+        finally:
+            self.idle.put(worker)
 
+    def close(self):
+        for worker in self.workers:
+            worker.close()
 
-if __name__ == "__main__":
-    # 使用argparse解析命令行参数
-    parser = argparse.ArgumentParser(description="修复媒体文件元数据")
-    parser.add_argument("directory", help="需要处理的目录路径")
-    args = parser.parse_args()
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_json_metadata(data):
+    '''
+    read_json_metadata 的 Docstring
+    从 JSON 数据中取出要写入的值, 返回 (timestamp, geo); geo 为 (lat, lng, alt), 没有有效 GPS 时为 None
+    '''
+    # 获取并处理时间戳
+    timestamp = None
+    if "photoTakenTime" in data and "timestamp" in data["photoTakenTime"]:
+        timestamp = float(data["photoTakenTime"]["timestamp"])
+    elif "creationTime" in data and "timestamp" in data["creationTime"]:
+        timestamp = float(data["creationTime"]["timestamp"])
+    geo = data.get('geoDataExif') or data.get('geoData')
+    if geo and geo.get('latitude', 0.0) != 0.0:
+        geo = (geo['latitude'], geo['longitude'], geo.get('altitude', 0))
+    else:
+        geo = None
+    return timestamp, geo
+
+
+# JSON 中要用到的值: 时间戳、GPS (lat, lng, alt) 或 None、title
+SidecarRecord = namedtuple("SidecarRecord", "timestamp geo title")
+# 解析结果缓存的最大条数
+sidecar_cache_size = 100000
+
+
+class SidecarCache:
+    '''
+    SidecarCache 的 Docstring
+    JSON 文件的解析结果缓存 (LRU): 每个 JSON 只解析一次, 保存为 SidecarRecord
+    以绝对路径为键, 按文件大小和修改时间判断是否有效; 修改 title 后直接存入写入的内容, 改名后随文件移动
+    多线程共用, 最多保存 max_entries 条
+    '''
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries or sidecar_cache_size
+        self.entries = OrderedDict()  # {绝对路径: ((大小, 修改时间), SidecarRecord)}
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def load(self, json_file):
+        # 返回 JSON 的 SidecarRecord, 文件不存在或不是有效 JSON 时抛出异常
+        path = os.path.abspath(json_file)
+        st = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry and entry[0] == (st.st_size, st.st_mtime_ns):
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return self._put(path, (st.st_size, st.st_mtime_ns), data)
+
+    def store(self, json_file, data):
+        # 刚写入 json_file 的内容为 data, 直接记入缓存
+        path = os.path.abspath(json_file)
+        st = os.stat(path)
+        return self._put(path, (st.st_size, st.st_mtime_ns), data)
+
+    def _put(self, path, version, data):
+        timestamp, geo = read_json_metadata(data)
+        record = SidecarRecord(timestamp, geo, data.get("title"))
+        with self.lock:
+            self.entries[path] = (version, record)
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return record
+
+    def rename(self, json_file, new_json_file):
+        # 改名不改变大小和修改时间, 记录随文件移动
+        with self.lock:
+            entry = self.entries.pop(os.path.abspath(json_file), None)
+            if entry:
+                self.entries[os.path.abspath(new_json_file)] = entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# 每个 TakeoutRepairer 各有一份
+sidecar_cache = ContextBound("sidecar_cache", SidecarCache())
+
+
+# --- 时区 ---
+# 按照片的 GPS 位置选择时区 (--gps-timezone), 没有 GPS 或查不到时区的照片使用 local_timezone (--timezone)
+gps_timezone = False
+# 按 GPS 查询时区时的网格大小 (度): 四个角和中心点在同一时区的格子只查询一次, 跨时区边界的格子逐个坐标查询
+# 这是近似: 完全落在一个格子内部、不经过这五个点的时区飞地会被当作周围的时区
+gps_timezone_cell = 0.1
+# 跨时区边界的格子中, 坐标按这个小数位数取整后缓存 (约 1 米)
+gps_timezone_digits = 5
+_epoch = datetime(1970, 1, 1)
+# 已换算的日期 {1970-01-01 起的天数: "YYYY:MM:DD"}
+_exif_days = {}
+
+
+class ZoneOffsets:
+    '''
+    ZoneOffsets 的 Docstring
+    预先展开一个时区的全部 UTC 偏移变化点 (pytz 的 _utc_transition_times), 之后每个时间戳只需一次二分查找和一次加法
+    结果与 datetime.fromtimestamp(timestamp, tz) 相同; 不是 pytz 的 tzinfo 时直接使用 datetime
+    '''
+    def __init__(self, tz):
+        self.tz = tz
+        transitions = getattr(tz, "_utc_transition_times", None)
+        if transitions:
+            self.starts = [(t - _epoch).total_seconds() for t in transitions]
+            self.offsets = [int(info[0].total_seconds()) for info in tz._transition_info]
+        elif isinstance(tz, pytz.BaseTzInfo):
+            # UTC 和固定偏移的时区
+            self.starts = [float("-inf")]
+            self.offsets = [int(tz.utcoffset(None).total_seconds())]
+        else:
+            self.starts = self.offsets = None
+
+    def format(self, timestamp):
+        # 返回 "YYYY:MM:DD HH:MM:SS"
+        if self.starts is None:
+            return datetime.fromtimestamp(timestamp, self.tz).strftime("%Y:%m:%d %H:%M:%S")
+        local = int(timestamp // 1) + self.offsets[bisect_right(self.starts, timestamp) - 1]
+        day, seconds = divmod(local, 86400)
+        date = _exif_days.get(day)
+        if date is None:
+            d = _epoch + timedelta(days=day)
+            date = _exif_days[day] = f"{d.year:04d}:{d.month:02d}:{d.day:02d}"
+        hour, seconds = divmod(seconds, 3600)
+        return f"{date} {hour:02d}:{seconds // 60:02d}:{seconds % 60:02d}"
+
+
+# 已展开的时区 {tzinfo: ZoneOffsets}, 每个时区在一次运行中只展开一次
+_zone_offsets = {}
+# 按 GPS 查到的时区 {(纬度格, 经度格): tzinfo 或 None, 跨时区边界的格子为 _mixed_cell}
+_gps_zone_cells = {}
+_mixed_cell = object()
+# 跨时区边界的格子中逐个坐标查到的时区 {(纬度, 经度): tzinfo 或 None}
+_gps_zone_points = {}
+_gps_timezone_finder = None
+_gps_timezone_lock = threading.Lock()
+
+
+def zone_offsets(tz):
+    zone = _zone_offsets.get(tz)
+    if zone is None:
+        zone = _zone_offsets[tz] = ZoneOffsets(tz)
+    return zone
+
+
+def gps_timezone_finder():
+    '''
+    gps_timezone_finder 的 Docstring
+    返回 timezonefinder 的查询对象 (离线的时区边界数据, 只在 --gps-timezone 时需要), 没有安装时抛出 ImportError
+    '''
+    global _gps_timezone_finder
+    with _gps_timezone_lock:
+        if _gps_timezone_finder is None:
+            try:
+                from timezonefinder import TimezoneFinder
+            except ImportError:
+                raise ImportError("按 GPS 选择时区需要 timezonefinder: pip install timezonefinder") from None
+            _gps_timezone_finder = TimezoneFinder(in_memory=True)
+        return _gps_timezone_finder
+
+
+def _gps_zone_name(lat, lng):
+    finder = gps_timezone_finder()
+    lat, lng = min(90.0, max(-90.0, lat)), min(180.0, max(-180.0, lng))
+    with _gps_timezone_lock:
+        return finder.timezone_at(lng=lng, lat=lat)
+
+
+def _gps_zone_of(name):
+    try:
+        return pytz.timezone(name) if name else None
+    except pytz.UnknownTimeZoneError:
+        return None
+
+
+def gps_zone(geo):
+    '''
+    gps_zone 的 Docstring
+    返回 GPS 位置 (lat, lng, alt) 所在的时区, 查不到时返回 None
+    网格的四个角和中心点都在同一时区时整格共用一次查询结果 (近似, 见 gps_timezone_cell); 否则按取整后的坐标逐个查询, 结果与处理顺序无关
+    '''
+    lat, lng = geo[0], geo[1]
+    row, col = math.floor(lat / gps_timezone_cell), math.floor(lng / gps_timezone_cell)
+    tz = _gps_zone_cells.get((row, col), _mixed_cell)
+    if tz is not _mixed_cell:
+        return tz
+    if (row, col) not in _gps_zone_cells:
+        names = {_gps_zone_name(r * gps_timezone_cell, c * gps_timezone_cell)
+                 for r in (row, row + 1) for c in (col, col + 1)}
+        if len(names) == 1:
+            # 四个角相同时再查中心点, 减少把格子中间的时区边界漏掉的情况
+            names.add(_gps_zone_name((row + 0.5) * gps_timezone_cell, (col + 0.5) * gps_timezone_cell))
+        tz = _gps_zone_of(names.pop()) if len(names) == 1 else _mixed_cell
+        _gps_zone_cells[(row, col)] = tz
+        if tz is not _mixed_cell:
+            return tz
+    point = (round(lat, gps_timezone_digits), round(lng, gps_timezone_digits))
+    try:
+        return _gps_zone_points[point]
+    except KeyError:
+        pass
+    tz = _gps_zone_points[point] = _gps_zone_of(_gps_zone_name(*point))
+    return tz
+
+
+def format_exif_date(timestamp, geo=None):
+    # 将时间戳转换为 ExifTool 需要的字符串格式 "YYYY:MM:DD HH:MM:SS"
+    # 使用 local_timezone (--timezone); --gps-timezone 时按 geo 所在的时区
+    tz = gps_zone(geo) if setting("gps_timezone") and geo else None
+    return zone_offsets(tz or setting("local_timezone")).format(timestamp)
+
+
+def format_exif_dates(items):
+    '''
+    format_exif_dates 的 Docstring
+    把一批 (timestamp, geo) 一起换算为日期字符串: 先确定每个位置的时区 (见 gps_zone), 再按时区成组换算, 返回与 items 顺序相同的列表
+    '''
+    by_zone = {}
+    use_gps, default_tz = setting("gps_timezone"), setting("local_timezone")
+    for i, (timestamp, geo) in enumerate(items):
+        tz = gps_zone(geo) if use_gps and geo else None
+        by_zone.setdefault(tz or default_tz, []).append(i)
+    dates = [None] * len(items)
+    for tz, indices in by_zone.items():
+        format_date = zone_offsets(tz).format
+        for i in indices:
+            dates[i] = format_date(items[i][0])
+    return dates
+
+
+def build_exiftool_args(media_file, data, date_str=None):
+    '''
+    build_exiftool_args 的 Docstring
+    根据 JSON 数据生成 ExifTool 参数列表 (不含程序名和目标文件), 返回 (timestamp, args); 没有时间戳时返回 (None, None)
+    data 可以是 JSON 字典, 也可以是 SidecarCache 中的 SidecarRecord; date_str 为已经换算好的拍摄时间
+    '''
+    if isinstance(data, SidecarRecord):
+        timestamp, geo = data.timestamp, data.geo
+    else:
+        timestamp, geo = read_json_metadata(data)
+    if not timestamp:
+        return None, None
+    date_str = date_str or format_exif_date(timestamp, geo)
+    args = [
+        "-charset", "filename=utf8",  # 处理文件名中的非ASCII字符
+        "-overwrite_original",   # -overwrite_original: 直接覆盖原文件，不生成 _original 备份
+        "-P",   # -P: 保留文件系统修改时间 (虽然我们后面会手动改，但加个保险)
+        "-u",  # -u: 允许写入未知标签 (增加兼容性)
+        f"-AllDates={date_str}",    # 写入所有常见日期标签 (DateTimeOriginal, CreateDate, ModifyDate)
+    ]
+    # 处理 GPS 信息
+    if geo:
+        lat, lng, alt = geo
+        # ExifTool 非常智能，直接传带符号的浮点数，它会自动计算 Ref (N/S, E/W)
+        args.append(f"-GPSLatitude={lat}")
+        args.append(f"-GPSLatitudeRef={lat}")
+        args.append(f"-GPSLongitude={lng}")
+        args.append(f"-GPSLongitudeRef={lng}")
+        args.append(f"-GPSAltitude={alt}")
+        # 针对视频文件的特殊 GPS 标签 (QuickTime)
+        # 格式通常为 "+23.1250+113.3393/"
+        if media_file.suffix.lower() in video_extensions:
+             # 简单的视频 GPS 格式化，ExifTool 对视频 GPS 支持稍微复杂一点，这行尝试写入通用的 Keys
+            args.append(f"-Keys:GPSCoordinates={lat}, {lng}, {alt}")
+    return timestamp, args
+
+
+def prepare_metadata_task(media_file, json_file, cache=None, record=None, date_str=None):
+    '''
+    prepare_metadata_task 的 Docstring
+    读取 JSON 并生成 ExifTool 参数, 返回 (timestamp, args); 不需要写入 (没有时间戳或文件未变化) 时返回 None
+    批量处理时 record 和 date_str 为已经读取的 JSON 和换算好的拍摄时间
+    '''
+    timestamp, args = build_exiftool_args(media_file, record or sidecar_cache.load(json_file), date_str)
+    if not timestamp:
+        print_file(f"! JSON中未找到时间戳, 跳过")
+        run_stats.count("write.no_timestamp")
+        return None
+    if cache and cache.is_current(media_file, json_file, args):
+        print_file(f"- 文件未变化, 跳过: {media_file}")
+        return None
+    return timestamp, args
+
+
+def finish_metadata_task(media_file, json_file, timestamp, args, ok, stderr, cache=None):
+    '''
+    finish_metadata_task 的 Docstring
+    ExifTool 执行后的收尾: 报告结果, 修改文件系统时间, 写入成功时记录到增量缓存, 返回 ok
+    '''
+    if ok:
+        run_stats.count("write.ok")
+        print_file(f"√ ExifTool 写入成功")
+    else:
+        run_stats.count("write.failed")
+        logging.error(f"ExifTool 报错 {media_file.name}: {stderr}")
+        print(f"! ExifTool 报错: {stderr.strip()}")
+    # (可选) 再次强制刷新文件系统时间
+    # 虽然 ExifTool 加了 -FileModifyDate，但有时候 Python 的 os.utime 更准
+    set_file_times(media_file, timestamp)
+    set_file_times(json_file, timestamp)
+    if ok:
+        # ExifTool 的 -overwrite_original 本身是写临时文件后改名, 这里只需按持久化级别同步
+        durable_writes.changed(media_file)
+    if ok and cache:
+        cache.record(media_file, json_file, args)
+    return ok
+
+
+def update_media_metadata(media_file, json_file, exiftool_pool=None, cache=None):
+    """
+    使用 ExifTool 将 JSON 信息写入媒体文件 (支持 JPG, HEIC, MP4, MOV)
+    给定 exiftool_pool 时使用常驻进程, 否则每个文件启动一次 exiftool
+    给定 cache 时, 文件没有变化且元数据相同则跳过 ExifTool
+    处理完成 (写入成功或 JSON 中没有时间戳) 返回 True, 出错返回 False
+    """
+    try:
+        # 1. 读取 JSON 数据, 准备 ExifTool 命令参数
+        prepared = prepare_metadata_task(media_file, json_file, cache)
+        if prepared is None:
+            return True
+        timestamp, args = prepared
+        # 2. 执行命令, 目标文件路径必须转为字符串
+        print_file(f"  - 正在调用 ExifTool 写入元数据...")
+        with run_stats.timer("exiftool"):
+            if exiftool_pool:
+                ok, _, stderr = exiftool_pool.execute(args + [str(media_file)])
+            else:
+                # capture_output=True 可以隐藏控制台的大量输出，只看报错
+                result = subprocess.run([get_exiftool_path()] + args + [str(media_file)], capture_output=True, text=True)
+                ok, stderr = result.returncode == 0, result.stderr
+        # 3. 报告结果并刷新文件系统时间
+        return finish_metadata_task(media_file, json_file, timestamp, args, ok, stderr, cache)
+    except Exception as e:
+        logging.error(f"元数据更新流程出错 {media_file.name}: {e}")
+        print(f"! 错误: {e}")
+        return False
+
+
+def exiftool_path_key(path):
+    # ExifTool 输出中的文件路径在 Windows 上使用正斜杠, 比较前统一规范化 (大小写、分隔符、多余的 . 和 ..)
+    return os.path.normcase(os.path.normpath(path))
+
+
+def exiftool_failed_files(stdout, stderr, paths):
+    '''
+    exiftool_failed_files 的 Docstring
+    一条命令写入多个文件时, 根据 "Error: ... - 文件路径" 判断哪些文件失败; 无法归属到具体文件的错误视为全部失败
+    路径按 exiftool_path_key 规范化后比较; 路径本身可能含有 " - ", 从右向左依次尝试每个分隔位置
+    '''
+    if exiftool_result_ok(stdout, stderr):
+        return set()
+    keys = {exiftool_path_key(path): path for path in paths}
+    failed = set()
+    for line in stderr.splitlines():
+        if not line.startswith("Error"):
+            continue
+        line = line.rstrip()
+        i = line.rfind(" - ")
+        while i >= 0:
+            path = keys.get(exiftool_path_key(line[i + 3:]))
+            if path is not None:
+                failed.add(path)
+                break
+            i = line.rfind(" - ", 0, i)
+        else:
+            return set(paths)
+    return failed or set(paths)
+
+
+def prepare_metadata_batch(pairs, cache=None):
+    '''
+    prepare_metadata_batch 的 Docstring
+    读取一组匹配对的 JSON 并生成参数, 参数完全相同的文件 (同一时间戳和 GPS) 归为一组
+    匹配对也可以是 (media_file, json_file, (timestamp, args)), 直接使用计划中已生成的参数, 不再读取 JSON
+    返回 (results, groups): results 为不需要写入或出错的 [(media_file, 是否完成)], groups 为 {参数元组: [(media_file, json_file, timestamp)]}
+    '''
+    results = []
+    groups = {}
+    # 先读取这一批的 JSON, 拍摄时间一起换算; 读取出错的文件在下面逐个报告
+    records = {}
+    for media_file, json_file, *planned in pairs:
+        if not planned:
+            try:
+                records[media_file] = sidecar_cache.load(json_file)
+            except Exception:
+                pass
+    dated = [media_file for media_file, record in records.items() if record.timestamp]
+    dates = dict(zip(dated, format_exif_dates([(records[m].timestamp, records[m].geo) for m in dated])))
+    for media_file, json_file, *planned in pairs:
+        try:
+            prepared = planned[0] if planned else prepare_metadata_task(media_file, json_file, cache,
+                                                                        records.get(media_file), dates.get(media_file))
+        except Exception as e:
+            logging.error(f"元数据更新流程出错 {media_file.name}: {e}")
+            print(f"! 错误: {e}")
+            results.append((media_file, False))
+            continue
+        if prepared is None:
+            results.append((media_file, True))
+            continue
+        timestamp, args = prepared
+        groups.setdefault(tuple(args), []).append((media_file, json_file, timestamp))
+    return results, groups
+
+
+def metadata_batch_commands(groups):
+    # 每组生成一条命令: 公共参数 + 该组所有文件路径
+    commands = [list(args) + [str(media_file) for media_file, _, _ in members] for args, members in groups.items()]
+    print_file(f"  - 正在调用 ExifTool 批量写入 {sum(len(m) for m in groups.values())} 个文件 ({len(commands)} 条命令)...")
+    return commands
+
+
+def finish_metadata_batch(groups, outputs, results, cache=None):
+    '''
+    finish_metadata_batch 的 Docstring
+    根据每条命令的输出判断每个文件是否成功, 逐个文件收尾, 结果追加到 results 并返回
+    '''
+    for (args, members), (_, stdout, stderr) in zip(groups.items(), outputs):
+        failed = exiftool_failed_files(stdout, stderr, [str(media_file) for media_file, _, _ in members])
+        for media_file, json_file, timestamp in members:
+            try:
+                ok = finish_metadata_task(media_file, json_file, timestamp, list(args),
+                                          str(media_file) not in failed, stderr, cache)
+            except Exception as e:
+                logging.error(f"元数据更新流程出错 {media_file.name}: {e}")
+                ok = False
+            results.append((media_file, ok))
+    return results
+
+
+def update_media_metadata_batch(pairs, exiftool_pool, cache=None):
+    '''
+    update_media_metadata_batch 的 Docstring
+    批量写入一组匹配对 (通常来自同一目录): 参数完全相同的文件合并为一条命令,
+    所有命令用 -execute 分隔, 作为一个参数块一次发送给 ExifTool
+    返回 [(media_file, 是否完成)], 每个文件仍单独报告结果和修改文件时间
+    '''
+    results, groups = prepare_metadata_batch(pairs, cache)
+    if not groups:
+        return results
+    with run_stats.timer("exiftool", files=sum(len(members) for members in groups.values())):
+        outputs = exiftool_pool.execute_many(metadata_batch_commands(groups))
+    return finish_metadata_batch(groups, outputs, results, cache)
+
+
+def group_pairs_by_directory(pairs, batch_size):
+    # 按所在目录分组, 每组最多 batch_size 个匹配对
+    by_directory = {}
+    for pair in pairs:
+        by_directory.setdefault(pair[0].parent, []).append(pair)
+    for members in by_directory.values():
+        for i in range(0, len(members), batch_size):
+            yield members[i:i + batch_size]
+
+
+# --- 阶段 4.0: 预检查已有元数据, 跳过已经正确的文件 ---
+# 预检查时每次 exiftool -json 调用最多读取的文件数 (同一目录的文件一起读取)
+precheck_chunk_size = 1000
+# 预检查读取的标签: 拍摄时间、GPS、文件修改时间
+precheck_tags = ["-DateTimeOriginal", "-CreateDate", "-GPSLatitude", "-GPSLatitudeRef",
+                 "-GPSLongitude", "-GPSLongitudeRef", "-GPSAltitude", "-GPSCoordinates", "-FileModifyDate"]
+
+
+def _signed_coordinate(value, ref, negative_ref):
+    # -n 输出的 EXIF 坐标不带符号, 需要根据 Ref (S/W) 加上符号
+    value = float(value)
+    if isinstance(ref, str) and ref.upper().startswith(negative_ref):
+        return -abs(value)
+    return value
+
+
+def compare_existing_metadata(info, timestamp, geo):
+    '''
+    compare_existing_metadata 的 Docstring
+    比较 exiftool -json -n 读出的已有元数据与 JSON 中要写入的值
+    返回 "same" (完全一致), "times" (只有文件修改时间不同), "differs" (需要重新写入)
+    '''
+    existing_date = str(info.get("DateTimeOriginal") or info.get("CreateDate") or "")[:19]
+    if existing_date != format_exif_date(timestamp, geo):
+        return "differs"
+    if geo:
+        lat, lng, alt = geo
+        try:
+            if "GPSLatitude" in info:
+                existing_lat = _signed_coordinate(info["GPSLatitude"], info.get("GPSLatitudeRef"), "S")
+                existing_lng = _signed_coordinate(info["GPSLongitude"], info.get("GPSLongitudeRef"), "W")
+            else:
+                # 视频的 GPS 在 Keys:GPSCoordinates 中, -n 输出为 "纬度 经度 高度"
+                existing_lat, existing_lng = (float(v) for v in str(info["GPSCoordinates"]).split()[:2])
+            existing_alt = float(info.get("GPSAltitude", alt))
+        except (KeyError, ValueError, TypeError):
+            return "differs"
+        if (abs(existing_lat - lat) > 1e-5 or abs(existing_lng - lng) > 1e-5
+                or abs(abs(existing_alt) - abs(alt)) > 1.0):
+            return "differs"
+    try:
+        file_time = datetime.strptime(str(info.get("FileModifyDate")), "%Y:%m:%d %H:%M:%S%z").timestamp()
+    except ValueError:
+        return "times"
+    return "same" if abs(file_time - timestamp) < 1 else "times"
+
+
+class MetadataPrecheck:
+    '''
+    MetadataPrecheck 的 Docstring
+    对一组匹配对 (同一目录) 用一次 exiftool -json 读取已有的拍摄时间、GPS 和文件时间, 与 JSON 比较,
+    只把不一致的文件交给写入阶段; 只有文件时间不同的文件直接修改文件时间, 不再重写文件
+    '''
+    def __init__(self, exiftool_pool, cache=None):
+        self.exiftool_pool = exiftool_pool
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.skipped = 0
+
+    def filter(self, pairs):
+        '''
+        filter 的 Docstring
+        返回 (需要写入的匹配对, 已经正确而跳过的匹配对)
+        '''
+        to_write, skipped, expected = [], [], {}
+        for media_file, json_file in pairs:
+            try:
+                record = sidecar_cache.load(json_file)
+                timestamp, args = build_exiftool_args(media_file, record)
+            except Exception:
+                timestamp = None
+            if not timestamp:
+                # 出错或没有时间戳的文件交给写入阶段按原流程处理
+                to_write.append((media_file, json_file))
+                continue
+            expected[str(media_file)] = (media_file, json_file, timestamp, record.geo, args)
+        if not expected:
+            return to_write, skipped
+        with run_stats.timer("precheck_read", files=len(expected)):
+            ok, stdout, stderr = self.exiftool_pool.execute(
+                ["-json", "-n", "-charset", "filename=utf8"] + precheck_tags + list(expected))
+        try:
+            # 读取失败的文件不会出现在 -json 的结果中, 不能按位置对应, 按规范化后的路径对应
+            existing = {exiftool_path_key(item["SourceFile"]): item
+                        for item in json.loads(stdout) if item.get("SourceFile")} if stdout.strip() else {}
+        except ValueError:
+            logging.error(f"预检查输出无法解析: {stderr.strip()}")
+            existing = {}
+        for path, (media_file, json_file, timestamp, geo, args) in expected.items():
+            info = existing.get(exiftool_path_key(path))
+            result = compare_existing_metadata(info, timestamp, geo) if info else "differs"
+            if result == "differs":
+                to_write.append((media_file, json_file))
+                continue
+            if result == "times":
+                set_file_times(media_file, timestamp)
+            set_file_times(json_file, timestamp)
+            if self.cache:
+                self.cache.record(media_file, json_file, args)
+            skipped.append((media_file, json_file))
+        with self.lock:
+            self.skipped += len(skipped)
+        run_stats.count("precheck.skipped", len(skipped))
+        return to_write, skipped
+
+
+def precheck_matched_pairs(catalog, media_ids, journal=None, cache=None):
+    '''
+    precheck_matched_pairs 的 Docstring
+    阶段 4.0: 按目录并行预检查目录表中的媒体文件 (media_ids), 返回 (需要写入的文件编号, 跳过的文件数)
+    跳过的文件会记入进度日志; 每组文件在检查时才构造 Path
+    '''
+    remaining = array("I")
+    max_workers = setting("stage4_max_workers")
+    with ExifToolPool(max_workers) as exiftool_pool, ContextThreadPoolExecutor(max_workers=max_workers) as executor:
+        precheck = MetadataPrecheck(exiftool_pool, cache)
+
+        def check(ids):
+            pairs = catalog.pairs(ids)
+            to_write, skipped = precheck.filter(pairs)
+            if journal:
+                for media_file, _ in skipped:
+                    journal.mark_written(media_file)
+            to_write = {media_file for media_file, _ in to_write}
+            return [m for m, (media_file, _) in zip(ids, pairs) if media_file in to_write]
+
+        for to_write in executor.map(check, catalog.directory_chunks(media_ids, precheck_chunk_size)):
+            remaining.extend(to_write)
+    print(f"预检查完成: {precheck.skipped} 个文件的元数据已经正确, 不再写入")
+    return remaining, precheck.skipped
+
+
+# --- 阶段 4 调度: 执行后端与自适应并发 ---
+def _job_bytes(results):
+    # 统计一个任务写入的字节数 (ExifTool 会重写整个文件), 用于估算磁盘吞吐
+    total = 0
+    for media_file, _ in results:
+        try:
+            total += os.path.getsize(media_file)
+        except OSError:
+            pass
+    return total
+
+
+def run_metadata_job(job, exiftool_pool, cache=None):
+    '''
+    run_metadata_job 的 Docstring
+    执行一个任务 (一个或多个匹配对), 返回 (results, 写入字节数, 耗时)
+    '''
+    start = time.monotonic()
+    if len(job) == 1 and len(job[0]) == 2:
+        media_file, json_file = job[0]
+        results = [(media_file, update_media_metadata(media_file, json_file, exiftool_pool, cache))]
+    else:
+        results = update_media_metadata_batch(job, exiftool_pool, cache)
+    return results, _job_bytes(results), time.monotonic() - start
+
+
+class ThreadBackend:
+    '''
+    ThreadBackend 的 Docstring
+    线程后端: 每个线程借用一个常驻 ExifTool
+    '''
+    def __init__(self, size, cache=None):
+        self.cache = cache
+        self.exiftool_pool = ExifToolPool(size)
+        self.executor = ContextThreadPoolExecutor(max_workers=size)
+
+    def submit(self, job):
+        return self.executor.submit(run_metadata_job, job, self.exiftool_pool, self.cache)
+
+    def close(self):
+        self.executor.shutdown()
+        self.exiftool_pool.close()
+
+
+class AsyncExifToolWorker:
+    '''
+    AsyncExifToolWorker 的 Docstring
+    ExifToolWorker 的 asyncio 版本, 用 asyncio 子进程驱动 exiftool -stay_open True -@ -
+    '''
+    def __init__(self):
+        self.proc = None
+        self.seq = 0
+
+    async def start(self):
+        self.proc = await asyncio.create_subprocess_exec(
+            get_exiftool_path(), "-stay_open", "True", "-@", "-",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+    async def kill(self):
+        if self.proc and self.proc.returncode is None:
+            self.proc.kill()
+            await self.proc.wait()
+
+    async def restart(self):
+        await self.kill()
+        await self.start()
+
+    async def _collect(self, stream, marker):
+        lines = []
+        while True:
+            line = await stream.readline()
+            if not line:
+                raise EOFError("ExifTool 进程意外退出")
+            line = line.decode("utf-8", errors="replace")
+            if line.strip() == marker:
+                return "".join(lines)
+            lines.append(line)
+
+    async def execute_many(self, commands, results, timeout=None):
+        # 与 ExifToolWorker.execute_many 相同的协议
+        lines = []
+        markers = []
+        for args in commands:
+            self.seq += 1
+            marker = f"{{ready{self.seq}}}"
+            lines += list(args) + ["-echo4", marker, f"-execute{self.seq}"]
+            markers.append(marker)
+        self.proc.stdin.write(("\n".join(lines) + "\n").encode("utf-8"))
+        await self.proc.stdin.drain()
+        for marker in markers:
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    asyncio.gather(self._collect(self.proc.stdout, marker), self._collect(self.proc.stderr, marker)),
+                    timeout or exiftool_timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError("ExifTool 响应超时")
+            results.append((stdout, stderr))
+
+    async def close(self):
+        try:
+            self.proc.stdin.write(b"-stay_open\nFalse\n")
+            await self.proc.stdin.drain()
+            await asyncio.wait_for(self.proc.wait(), 10)
+        except Exception:
+            await self.kill()
+
+
+class AsyncioBackend:
+    '''
+    AsyncioBackend 的 Docstring
+    asyncio 后端: 一个事件循环线程驱动所有 ExifTool 子进程, 等待 ExifTool 时不占用线程
+    读取 JSON、修改文件时间、记录增量缓存和 fsync 等阻塞的文件操作交给线程池 (run_in_executor), 不阻塞事件循环
+    '''
+    def __init__(self, size, cache=None):
+        self.cache = cache
+        self.executor = ContextThreadPoolExecutor(max_workers=size)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=contextvars.copy_context().run, args=(self.loop.run_forever,), daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(size), self.loop).result()
+
+    async def _start(self, size):
+        self.workers = [AsyncExifToolWorker() for _ in range(size)]
+        self.idle = asyncio.Queue()
+        for worker in self.workers:
+            await worker.start()
+            self.idle.put_nowait(worker)
+
+    async def _execute_many(self, commands):
+        # 与 ExifToolPool.execute_many 相同的重启与重试规则
+        worker = await self.idle.get()
+        results = []
+        crashed_at = None
+        try:
+            while len(results) < len(commands):
+                done = []
+                error = None
+                try:
+                    await worker.execute_many(commands[len(results):], done)
+                except TimeoutError as e:
+                    logging.error(f"ExifTool 进程卡死, 正在重启: {e}")
+                    await worker.restart()
+                    error = str(e)
+                except (EOFError, OSError) as e:
+                    logging.error(f"ExifTool 进程崩溃, 正在重启: {e}")
+                    await worker.restart()
+                    index = len(results) + len(done)
+                    if crashed_at == index:
+                        error = "ExifTool 进程重启后仍然失败"
+                    crashed_at = index
+                results += [(exiftool_result_ok(stdout, stderr), stdout, stderr) for stdout, stderr in done]
+                if error:
+                    results.append((False, "", error))
+            return results
+        finally:
+            self.idle.put_nowait(worker)
+
+    async def _run(self, job):
+        start = time.monotonic()
+        results, groups = await self.loop.run_in_executor(self.executor, prepare_metadata_batch, job, self.cache)
+        if groups:
+            start_exiftool = time.perf_counter()
+            outputs = await self._execute_many(metadata_batch_commands(groups))
+            run_stats.observe("exiftool", time.perf_counter() - start_exiftool, sum(len(members) for members in groups.values()))
+            results = await self.loop.run_in_executor(self.executor, finish_metadata_batch, groups, outputs, results, self.cache)
+        nbytes = await self.loop.run_in_executor(self.executor, _job_bytes, results)
+        return results, nbytes, time.monotonic() - start
+
+    def submit(self, job):
+        return asyncio.run_coroutine_threadsafe(self._run(job), self.loop)
+
+    async def _close(self):
+        for worker in self.workers:
+            await worker.close()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self._close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.executor.shutdown()
+
+
+# 阶段 4 的执行后端: thread (线程), asyncio (异步子进程)
+stage4_executors = ("thread", "asyncio")
+
+
+def open_stage4_backend(executor, size, cache=None):
+    if executor == "asyncio":
+        return AsyncioBackend(size, cache)
+    return ThreadBackend(size, cache)
+
+
+class AdaptiveScheduler:
+    '''
+    AdaptiveScheduler 的 Docstring
+    分批提交任务: 同时在执行的任务数不超过当前并发上限, 而不是一次性为所有文件创建 future
+    每完成一轮任务, 根据这一轮的磁盘吞吐 (字节/秒) 和单个文件的平均耗时调整并发上限:
+    吞吐上升则继续沿当前方向调整, 吞吐下降则反向, 吞吐持平但耗时变长则减少并发
+    方向始终为 +1/-1; 吞吐持平时进入 settled 状态, 不调整并发, 连续几轮持平后再沿当前方向试探一次
+    '''
+    def __init__(self, backend, max_workers, min_workers=1, adaptive=True):
+        self.backend = backend
+        self.max_workers = max(1, max_workers)
+        self.min_workers = max(1, min(min_workers, self.max_workers))
+        self.adaptive = adaptive
+        self.limit = max(self.min_workers, self.max_workers // 2) if adaptive else self.max_workers
+        self.direction = 1
+        self.settled = False  # 吞吐持平, 暂不调整并发
+        self.prev = None  # 上一轮的 (吞吐, 平均耗时)
+        self.hold = 0
+
+    def _tune(self, throughput, latency):
+        self.settled = False
+        if self.prev is not None:
+            prev_throughput, prev_latency = self.prev
+            if throughput >= prev_throughput * 1.05:
+                pass  # 吞吐上升, 继续当前方向
+            elif throughput <= prev_throughput * 0.95:
+                self.direction = -self.direction
+            elif latency > prev_latency * 1.2:
+                self.direction = -1
+            else:
+                # 持平: 保持不变, 连续几轮持平后再沿当前方向试探一次
+                self.hold += 1
+                self.settled = self.hold < 3
+        if not self.settled:
+            self.hold = 0
+            # 已经到达上下限时掉头, 下一次试探才会真正改变并发
+            if not self.min_workers <= self.limit + self.direction <= self.max_workers:
+                self.direction = -self.direction
+            self.limit = min(self.max_workers, max(self.min_workers, self.limit + self.direction))
+        self.prev = (throughput, latency)
+
+    def run(self, jobs, on_result, total=None, queue_depth=None):
+        '''
+        run 的 Docstring
+        依次提交 jobs (可以是生成器) 中的任务, 每个任务完成后调用 on_result(results)
+        total 为文件总数, queue_depth 返回上游队列中等待的文件数, 两者只用于显示进度
+        '''
+        jobs = iter(jobs)
+        in_flight = {}
+        exhausted = False
+        submitted_files = done_files = 0
+        round_files = round_bytes = 0
+        round_latency = 0.0
+        round_start = time.monotonic()
+        while True:
+            while not exhausted and len(in_flight) < self.limit:
+                job = next(jobs, None)
+                if job is None:
+                    exhausted = True
+                    break
+                in_flight[self.backend.submit(job)] = job
+                submitted_files += len(job)
+            if not in_flight:
+                break
+            finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                job = in_flight.pop(future)
+                try:
+                    results, nbytes, elapsed = future.result()
+                except Exception as e:
+                    logging.error(f"--- 阶段 4:处理文件 {job[0][0].name} 等 {len(job)} 个文件时发生错误: {e}")
+                    continue
+                on_result(results)
+                done_files += len(job)
+                round_files += len(job)
+                round_bytes += nbytes
+                round_latency += elapsed
+            # 每一轮至少完成 2 倍并发上限个文件后再统计
+            if round_files >= max(8, 2 * self.limit):
+                seconds = max(time.monotonic() - round_start, 1e-6)
+                latency = round_latency / round_files
+                throughput = (round_bytes or round_files) / seconds
+                progress = f"{done_files}/{total}" if total is not None else f"{done_files}"
+                waiting = queue_depth() if queue_depth else (total - submitted_files if total is not None else 0)
+                print_progress(f"[阶段 4] 进度 {progress} | 并发 {self.limit}/{self.max_workers} | 执行中 {len(in_flight)} | 排队 {waiting}"
+                      f" | 平均耗时 {latency * 1000:.0f} ms | 吞吐 {round_bytes / seconds / 1e6:.1f} MB/s")
+                if self.adaptive:
+                    self._tune(throughput, latency)
+                round_files = round_bytes = 0
+                round_latency = 0.0
+                round_start = time.monotonic()
+        return done_files
+
+
+# 阶段 4 的默认执行后端与最大并发
+stage4_executor = "thread"
+stage4_max_workers = os.cpu_count() or 8
+
+
+def update_media_metadata_with_matched_pairs(matched_pairs):
+    '''
+    update_metadata_of_matched_pairs 的 Docstring
+    对匹配对中的媒体文件进行元数据更新
+    '''
+    for media_file in list(matched_pairs.keys()):
+        json_file = matched_pairs[media_file]
+        if json_file:
+            print(f"--- 正在使用 {json_file} 更新元数据: {media_file} ---")
+            update_media_metadata(media_file, json_file)
+    return matched_pairs
+
+def update_media_metadata_with_matched_pairs_multi_tasking(matched_pairs, journal=None, cache=None, batch_size=1, skip_correct=False):
+    # batch_size > 1 时按目录分组批量写入, 每组作为一个参数块发送给 ExifTool
+    # skip_correct=True 时先预检查, 跳过元数据已经正确的文件; 返回预检查跳过的文件数
+    # matched_pairs 可以是匹配对字典或 FileCatalog, 任务在提交时才构造 Path
+    catalog = matched_pairs if isinstance(matched_pairs, FileCatalog) else FileCatalog.from_pairs(matched_pairs.items())
+    tasks = catalog.matched_media()
+    if journal:
+        # 跳过上次运行已经写入成功的文件
+        pending = array("I", (m for m in tasks if not journal.is_written(catalog.path_str(m))))
+        print(f"跳过 {len(tasks) - len(pending)} 个已完成的文件")
+        tasks = pending
+    skipped = 0
+    if skip_correct and tasks:
+        print(f"--- 阶段 4.0: 预检查已有元数据 ---")
+        tasks, skipped = precheck_matched_pairs(catalog, tasks, journal, cache)
+
+    def on_result(results):
+        for media_path, ok in results:
+            if ok and journal:
+                journal.mark_written(media_path)
+
+    jobs = catalog.jobs(tasks, batch_size)
+    backend = open_stage4_backend(setting("stage4_executor"), setting("stage4_max_workers"), cache)
+    try:
+        AdaptiveScheduler(backend, setting("stage4_max_workers")).run(jobs, on_result, total=len(tasks))
+    finally:
+        backend.close()
+    return skipped
+
+
+# --- 流式处理: 逐个目录 扫描 → 匹配 → 更正扩展名 → 写入元数据 ---
+# 流式模式下各阶段之间队列的最大长度, 控制内存占用
+stream_queue_size = 1000
+
+
+class _StreamStage:
+    '''
+    _StreamStage 的 Docstring
+    流式模式的一个阶段线程, 从 inbox 队列取数据直到 None, 在当前 TakeoutRepairer 的环境中运行 (见 ContextThreadPoolExecutor)
+    线程出错时记录异常 (error), 并继续取空 inbox 直到 close(), 上游不会阻塞在有上限的队列上
+    '''
+    def __init__(self, name, inbox, target, *args, **kwargs):
+        self.name = name
+        self.inbox = inbox
+        self.error = None
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=contextvars.copy_context().run, args=(self._run, target, args, kwargs), daemon=True)
+
+    def _run(self, target, args, kwargs):
+        try:
+            target(*args, **kwargs)
+        except BaseException as e:
+            logging.error(f"! 流式模式的{self.name}线程出错, 正在停止: {e}")
+            self.error = e
+            # close() 放入 None 之前线程可能已经取走了 None, 所以同时检查 closed
+            while True:
+                try:
+                    if self.inbox.get(timeout=0.1) is None:
+                        break
+                except queue.Empty:
+                    if self.closed.is_set():
+                        break
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        # 通知线程退出并等待结束
+        self.inbox.put(None)
+        self.closed.set()
+        self.thread.join()
+
+
+def _ext_worker(ext_queue, write_queue, precheck=None, cache=None, executor=None):
+    # 阶段 3 线程: 每次处理一个目录的匹配对, 更正扩展名后交给阶段 4; 单线程处理, 避免同一目录下的重命名互相冲突
+    # 给定 precheck 时, 先用一次 exiftool -json 读取整个目录, 只把元数据不一致的文件交给阶段 4
+    while True:
+        item = ext_queue.get()
+        if item is None:
+            break
+        pairs = []
+        shared = shared_json_files((media_file, json_file) for media_file, json_file, _, _ in item)
+        renamed_json = {}
+        # 先并行识别整个目录的文件类型, 再按顺序改名
+        detected = detect_media_types([media_file for media_file, _, ext_done, _ in item if not ext_done], cache, executor,
+                                      {media_file: st for media_file, _, _, st in item})
+        for media_file, json_file, ext_done, _ in item:
+            json_file = renamed_json.get(json_file, json_file)
+            if not ext_done:
+                try:
+                    kind = detected.get(media_file)
+                    media_file, json_file = let_ext_correct_shared(media_file, json_file, shared, renamed_json,
+                                                                   detected_extension=kind)
+                    if cache and kind:
+                        cache.record_kind(media_file, kind)
+                except Exception as e:
+                    logging.error(f"! 更正扩展名 {media_file} 时出错: {e}")
+            pairs.append((media_file, json_file))
+        if precheck:
+            try:
+                pairs, _ = precheck.filter(pairs)
+            except Exception as e:
+                logging.error(f"! 预检查目录 {pairs[0][0].parent} 时出错: {e}")
+        for pair in pairs:
+            write_queue.put(pair)
+
+
+def _iter_queue_jobs(write_queue, batch_size=1):
+    # 从队列中取出匹配对组成任务, 遇到 None 结束; batch_size > 1 时一次取出多个已在队列中的匹配对
+    while True:
+        item = write_queue.get()
+        if item is None:
+            return
+        job = [item]
+        while len(job) < batch_size:
+            try:
+                item = write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                yield job
+                return
+            job.append(item)
+        yield job
+
+
+def stream_media_files(directory, cache=None, batch_size=1, skip_correct=False, unmatched=None):
+    '''
+    stream_media_files 的 Docstring
+    流式处理: 每扫描并匹配完一个目录, 就把该目录的匹配对放入更正扩展名和写入元数据的队列
+    Takeout 的匹配只发生在同一目录内, 所以逐目录匹配与整体匹配的结果相同
+    队列有上限, 写入跟不上时扫描会暂停等待, 内存占用与文件总数无关
+    skip_correct=True 时逐目录预检查, 跳过元数据已经正确的文件
+    返回 (匹配对的数量, 预检查跳过的文件数)
+    '''
+    # 阶段 3 的队列以目录为单位, 只缓冲少量目录
+    ext_queue = queue.Queue(maxsize=4)
+    write_queue = queue.Queue(maxsize=stream_queue_size)
+    pair_count = 0
+    precheck_pool = ExifToolPool(1) if skip_correct else None
+    detect_executor = ContextThreadPoolExecutor(max_workers=setting("scan_workers"))
+    precheck = MetadataPrecheck(precheck_pool, cache) if skip_correct else None
+    backend = open_stage4_backend(setting("stage4_executor"), setting("stage4_max_workers"), cache)
+    try:
+        ext_stage = _StreamStage("阶段 3", ext_queue, _ext_worker, ext_queue, write_queue, precheck, cache, detect_executor)
+        write_stage = _StreamStage("阶段 4", write_queue, AdaptiveScheduler(backend, setting("stage4_max_workers")).run,
+                                   _iter_queue_jobs(write_queue, batch_size), lambda results: None, queue_depth=write_queue.qsize)
+        ext_stage.start()
+        write_stage.start()
+        try:
+            exclude = unmatched.scan_exclude() if unmatched else None
+            for folder, media_files, json_files, stats, _ in iter_scanned_directories(directory, with_stats=bool(cache),
+                                                                                      exclude=exclude):
+                if not media_files and not json_files:
+                    continue
+                print_file(f"--- 目录: {folder} ({len(media_files)} 个媒体文件, {len(json_files)} 个 JSON 文件) ---")
+                run_stats.count("scan.media", len(media_files))
+                run_stats.count("scan.json", len(json_files))
+                # JSON 保持扫描顺序: 多个 JSON 都能匹配时取最先出现的那个, 与批量模式相同
+                matched_pairs = find_matching_pairs(media_files, json_files, stage_headers=False, unmatched=unmatched)
+                # 上次运行后没有变化的文件, 扩展名已经更正过; 扫描时的 stat 结果一起交给阶段 3
+                ext_queue.put([(media_file, json_file,
+                                bool(cache and cache.lookup(media_file, verify_content=False, st=stats.get(media_file))),
+                                stats.get(media_file))
+                               for media_file, json_file in matched_pairs.items()])
+                pair_count += len(matched_pairs)
+                if ext_stage.error or write_stage.error:
+                    break
+        finally:
+            # 依次关闭各阶段: 先等阶段 3 处理完, 再通知阶段 4 退出
+            ext_stage.close()
+            write_stage.close()
+        # 阶段线程出错时不再继续扫描, 把异常交给调用者
+        for stage in (ext_stage, write_stage):
+            if stage.error:
+                raise stage.error
+    finally:
+        backend.close()
+        detect_executor.shutdown()
+        if precheck_pool:
+            precheck_pool.close()
+    return pair_count, precheck.skipped if precheck else 0
+
+
+# --- 演练模式: 生成操作计划 (--plan), 之后再执行计划 (--apply) ---
+class ActionPlan:
+    '''
+    ActionPlan 的 Docstring
+    演练模式的操作计划: 记录将要执行的移动、复制、改名、修改 title 和 ExifTool 写入, 不修改任何文件
+    created/removed 记录执行后会出现或消失的路径, 使改名时的重名检查与实际执行时一致
+    origin 记录计划中的路径现在实际对应的文件, 生成 ExifTool 参数时从这里读取 JSON
+    '''
+    plan_version = 1
+
+    def __init__(self):
+        self.actions = []
+        self.created = set()
+        self.removed = set()
+        self.origin = {}
+
+    def exists(self, path):
+        return path in self.created or (path not in self.removed and path.exists())
+
+    def source(self, path):
+        return self.origin.get(path, path)
+
+    def _relocate(self, op, src, dst):
+        self.actions.append({"op": op, "src": src, "dst": dst})
+        self.origin[dst] = self.origin.pop(src, src)
+        self.removed.add(src)
+        self.created.discard(src)
+        self.created.add(dst)
+        self.removed.discard(dst)
+
+    def move(self, src, dst):
+        self._relocate("move", src, dst)
+
+    def rename(self, src, dst):
+        self._relocate("rename", src, dst)
+
+    def copy(self, src, dst):
+        self.actions.append({"op": "copy", "src": src, "dst": dst})
+        self.origin[dst] = self.source(src)
+        self.created.add(dst)
+        self.removed.discard(dst)
+
+    def set_title(self, json_file, title):
+        self.actions.append({"op": "title", "json": json_file, "title": title})
+
+    def write(self, media_file, json_file, timestamp, args):
+        # ExifTool 会重写整个文件, 以文件大小估算写入量
+        try:
+            nbytes = os.path.getsize(self.source(media_file))
+        except OSError:
+            nbytes = 0
+        self.actions.append({"op": "write", "media": media_file, "json": json_file,
+                             "timestamp": timestamp, "args": args, "bytes": nbytes})
+
+    def save(self, path, directory):
+        '''
+        save 的 Docstring
+        写入计划文件 (JSON Lines): 第一行为文件头, 之后每行一个操作, 最后一行为汇总; 路径一律保存为绝对路径
+        返回汇总
+        '''
+        counts = Counter(action["op"] for action in self.actions)
+        summary = {"op": "summary", **counts,
+                   "bytes": sum(action["bytes"] for action in self.actions if action["op"] == "write")}
+        header = {"op": "plan", "version": self.plan_version, "root": str(Path(directory).resolve()),
+                  "created": datetime.now(setting("local_timezone")).isoformat(timespec="seconds")}
+        with open(path, "w", encoding="utf-8") as f:
+            for action in [header] + self.actions + [summary]:
+                action = {key: os.path.abspath(value) if isinstance(value, Path) else value for key, value in action.items()}
+                f.write(json.dumps(action, ensure_ascii=False, separators=(",", ":")) + "\n")
+        return summary
+
+
+def plan_metadata_writes(matched_pairs, plan):
+    '''
+    plan_metadata_writes 的 Docstring
+    阶段 4 的演练: 从 JSON 生成每个文件的 ExifTool 参数并记入计划
+    '''
+    for media_file, json_file in matched_pairs.items():
+        try:
+            timestamp, args = build_exiftool_args(media_file, sidecar_cache.load(plan.source(json_file)))
+        except Exception as e:
+            logging.error(f"读取 JSON {json_file} 时出错: {e}")
+            print(f"! 错误: {e}")
+            continue
+        if not timestamp:
+            print_file(f"! JSON中未找到时间戳, 跳过: {json_file}")
+            continue
+        plan.write(media_file, json_file, timestamp, args)
+
+
+def load_plan(plan_file):
+    '''
+    load_plan 的 Docstring
+    读取计划文件, 返回 (文件操作按所在目录分组的字典, 写入任务列表)
+    同一目录的文件操作保持计划中的顺序 (改名可能会用到前面的操作腾出的文件名)
+    '''
+    file_actions = {}
+    writes = []
+    with open(plan_file, encoding="utf-8") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get("op") != "plan" or header.get("version") != ActionPlan.plan_version:
+            raise ValueError(f"{plan_file} 不是有效的计划文件")
+        for line in f:
+            action = json.loads(line)
+            if action["op"] == "write":
+                writes.append((Path(action["media"]), Path(action["json"]), (action["timestamp"], action["args"])))
+            elif action["op"] == "title":
+                file_actions.setdefault(Path(action["json"]).parent, []).append(action)
+            elif action["op"] in ("move", "copy", "rename"):
+                file_actions.setdefault(Path(action["src"]).parent, []).append(action)
+    return file_actions, writes
+
+
+def apply_file_actions(actions):
+    # 依次执行同一目录的文件操作, 返回 (成功数, 失败数)
+    ok = failed = 0
+    for action in actions:
+        op = action["op"]
+        try:
+            if op == "title":
+                update_json_title(action["title"], Path(action["json"]))
+            else:
+                src, dst = Path(action["src"]), Path(action["dst"])
+                print_file(f"- {op}: {src} --> {dst}")
+                if op == "move":
+                    # 与移动未匹配文件相同: 不覆盖已有文件, 跨文件系统时不会留下不完整的文件
+                    dst.parent.mkdir(parents=True, exist_ok=True)
+                    durable_writes.move(src, dst)
+                elif op == "copy":
+                    durable_writes.copy(src, dst)
+                else:
+                    if dst.exists():
+                        raise FileExistsError(f"目标文件已存在: {dst}")
+                    with run_stats.timer("rename"):
+                        src.rename(dst)
+                    durable_writes.moved(src, dst)
+            ok += 1
+        except Exception as e:
+            logging.error(f"! 执行计划操作 {action} 时出错: {e}")
+            failed += 1
+    return ok, failed
+
+
+def apply_plan(plan_file, batch_size=1):
+    '''
+    apply_plan 的 Docstring
+    执行 --plan 生成的计划, 不再重复匹配和类型识别:
+    文件操作按目录分组, 不同目录并行、同一目录按顺序执行; 之后用阶段 4 的调度器并行写入元数据
+    返回 (成功的文件操作数, 失败的文件操作数, 写入任务数)
+    '''
+    file_actions, writes = load_plan(plan_file)
+    print(f"--- 执行计划: {sum(len(a) for a in file_actions.values())} 个文件操作, {len(writes)} 个文件写入 ---")
+    ok = failed = 0
+    with ContextThreadPoolExecutor(max_workers=setting("scan_workers")) as executor:
+        for group_ok, group_failed in executor.map(apply_file_actions, file_actions.values()):
+            ok += group_ok
+            failed += group_failed
+    print(f"文件操作完成: 成功 {ok} 个, 失败 {failed} 个")
+    jobs = group_pairs_by_directory(writes, batch_size) if batch_size > 1 else ([write] for write in writes)
+    backend = open_stage4_backend(setting("stage4_executor"), setting("stage4_max_workers"))
+    try:
+        AdaptiveScheduler(backend, setting("stage4_max_workers")).run(jobs, lambda results: None, total=len(writes))
+    finally:
+        backend.close()
+    return ok, failed, len(writes)
+
+
+# --- 直接读取 Takeout 压缩包 (--archives), 不先解压 ---
+# 解出文件时每次复制的块大小
+archive_copy_chunk = 1024 * 1024
+
+
+class TakeoutArchive:
+    '''
+    TakeoutArchive 的 Docstring
+    一个 Takeout 压缩包 (.zip 或 .tgz/.tar.gz/.tar), 按压缩包中的顺序逐个读取普通文件成员
+    zip 的成员列表来自中央目录, 只读取需要的部分; tar 没有目录, 只能从头到尾顺序读取
+    '''
+    def __init__(self, path):
+        self.path = Path(path)
+        self.is_zip = zipfile.is_zipfile(self.path)
+
+    def members(self, names=None):
+        # 按顺序产出 (成员名, 文件对象); 给定 names 时只产出其中的成员, 文件对象只在取下一个成员之前有效
+        if self.is_zip:
+            with zipfile.ZipFile(self.path) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or (names is not None and info.filename not in names):
+                        continue
+                    with archive.open(info) as f:
+                        yield info.filename, f
+        else:
+            with tarfile.open(self.path, "r|*") as archive:
+                for info in archive:
+                    if not info.isfile() or (names is not None and info.name not in names):
+                        continue
+                    yield info.name, archive.extractfile(info)
+
+
+def archive_member_target(destination, name):
+    # 成员解出后的路径 (字符串); 绝对路径或含 ".." 的成员名返回 None, 防止写到目标目录之外
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+    if not parts or name.startswith(("/", "\\")) or ".." in parts or ":" in parts[0]:
+        return None
+    return os.path.join(destination, *parts)
+
+
+def copy_member(source, target):
+    # 原样写出一个成员 (先写临时文件再改名), 不覆盖已有文件
+    tmp = temp_path_for(target)
+    try:
+        with open(tmp, "xb") as f:
+            shutil.copyfileobj(source, f, archive_copy_chunk)
+    except BaseException:
+        durable_writes._discard(tmp)
+        raise
+    durable_writes.replace(tmp, target, overwrite=False)
+
+
+def index_takeout_archive(archive, destination):
+    '''
+    index_takeout_archive 的 Docstring
+    第一遍读取压缩包: JSON 文件直接解出到目标目录 (只有几 KB, 之后的匹配、改名和修改 title 照常在磁盘上进行),
+    媒体文件只读取文件头识别类型; 返回 (媒体文件路径, JSON 文件路径, {媒体文件路径: 扩展名}), 路径均为字符串
+    '''
+    media_files, json_files, types = [], [], {}
+    for name, f in archive.members():
+        target = archive_member_target(destination, name)
+        if target is None:
+            logging.error(f"! 跳过不安全的成员名: {archive.path}: {name}")
+            continue
+        suffix = os.path.splitext(name)[1].lower()
+        try:
+            if suffix in media_extensions:
+                with run_stats.timer("type_detect"):
+                    types[target] = sniff_header(f.read(sniff_header_size)) or ""
+                media_files.append(target)
+            elif suffix in json_extensions:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                copy_member(f, target)
+                json_files.append(target)
+        except OSError as e:
+            logging.error(f"! 读取 {archive.path}: {name} 时出错: {e}")
+    return media_files, json_files, types
+
+
+class ArchivePlan(ActionPlan):
+    '''
+    ArchivePlan 的 Docstring
+    读取压缩包时的操作计划: 媒体文件还在压缩包中 (virtual), 对它们的移动和改名只用于确定最终路径;
+    JSON 文件已经解出, 对它们的操作之后照常执行
+    '''
+    def __init__(self, media_files):
+        super().__init__()
+        self.virtual = set(media_files)
+
+    def exists(self, path):
+        return path in self.created or (path not in self.removed and (str(path) in self.virtual or path.exists()))
+
+    def targets(self):
+        # {媒体文件原路径: 最终路径}, 只包含被移动或改名的媒体文件
+        return {str(origin): path for path, origin in self.origin.items() if str(origin) in self.virtual}
+
+    def file_actions(self):
+        # 需要在磁盘上执行的操作 (只涉及 JSON 文件)
+        return [action for action in self.actions
+                if action["op"] == "title" or (action["op"] != "write" and action["src"].suffix.lower() in json_extensions)]
+
+
+def start_member_write(source, target, args):
+    '''
+    start_member_write 的 Docstring
+    启动一次性的 ExifTool 进程, 从标准输入读取成员内容, 写入元数据后输出到 target 旁边的临时文件 (-o), 文件只写入一次
+    成员内容发送完就返回 (process, tmp), 由 finish_member_write 关闭标准输入并等待 ExifTool 结束, 读取压缩包不等待 ExifTool
+    读取成员出错时杀掉 ExifTool 并抛出异常, 不会把不完整的内容交给 ExifTool 写出
+    '''
+    tmp = temp_path_for(target)
+    command = [get_exiftool_path(), *args, "-o", str(tmp), "-"]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            chunk = source.read(archive_copy_chunk)
+            if not chunk:
+                break
+            try:
+                process.stdin.write(chunk)
+            except OSError as e:
+                # ExifTool 提前退出 (如文件格式错误), 结果由 finish_member_write 判断
+                logging.error(f"! 向 ExifTool 发送 {target} 时出错: {e}")
+                break
+        try:
+            process.stdin.flush()
+        except OSError:
+            pass
+    except BaseException:
+        process.kill()
+        process.communicate()
+        durable_writes._discard(tmp)
+        raise
+    return process, tmp
+
+
+def finish_member_write(process, tmp, target, timestamp, start):
+    '''
+    finish_member_write 的 Docstring
+    等待 start_member_write 启动的 ExifTool 结束, 成功时把临时文件改名为 target 并设置文件时间, 返回是否成功
+    ExifTool 失败时删除临时文件返回 False, 其他错误删除临时文件后抛出异常; 两种情况调用者都会原样写出该成员
+    '''
+    try:
+        try:
+            stdout, stderr = process.communicate(timeout=exiftool_timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            stdout, stderr = process.communicate()
+        run_stats.observe("exiftool", time.perf_counter() - start)
+        stdout, stderr = stdout.decode("utf-8", "replace"), stderr.decode("utf-8", "replace")
+        if process.returncode != 0 or not exiftool_result_ok(stdout, stderr):
+            logging.error(f"! ExifTool 写入 {target} 失败, 原样写出: {stderr.strip()}")
+            durable_writes._discard(tmp)
+            return False
+        durable_writes.replace(tmp, target, overwrite=False)
+    except BaseException:
+        durable_writes._discard(tmp)
+        raise
+    set_file_times(target, timestamp)
+    print_file(f"- 已写出: {target}")
+    return True
+
+
+def extract_takeout_archive(archive, destination, targets, writes, executor, window):
+    '''
+    extract_takeout_archive 的 Docstring
+    第二遍读取压缩包: 每个媒体文件直接写到最终路径 (更正后的文件名或 unmatched 目录), JSON 已在第一遍解出
+    有元数据要写入的成员交给 start_member_write, 由 ExifTool 从标准输入读取并写出, 再交给 executor 等待 ExifTool 结束 (finish_member_write)
+    同时在写入的成员最多 window 个, 达到上限时先等其中一个完成, 临时文件和 ExifTool 进程的数量不随压缩包大小增长
+    写入失败或出错的成员再读一遍原样写出, 不会丢失; 返回 (写出的媒体文件数, 写入元数据的文件数, 写入失败的文件数)
+    '''
+    count = written = 0
+    failed = {}  # 需要再读一遍原样写出的成员 {成员名: 最终路径}
+    in_flight = {}  # {future: (成员名, 最终路径)}
+
+    def collect(futures):
+        nonlocal written
+        for future in futures:
+            name, final = in_flight.pop(future)
+            try:
+                ok = future.result()
+            except Exception as e:
+                logging.error(f"! 写入 {archive.path}: {name} -> {final} 的元数据时出错, 原样写出: {e}")
+                ok = False
+            if ok:
+                run_stats.count("write.ok")
+                written += 1
+            else:
+                failed[name] = final
+
+    for name, f in archive.members():
+        target = archive_member_target(destination, name)
+        suffix = os.path.splitext(name)[1].lower()
+        if target is None or suffix in json_extensions:
+            continue
+        final = targets.get(target) or Path(target)
+        write = writes.get(str(final))
+        if write is not None and len(in_flight) >= window:
+            collect(wait(in_flight, return_when=FIRST_COMPLETED)[0])
+        try:
+            final.parent.mkdir(parents=True, exist_ok=True)
+            if write is None:
+                copy_member(f, final)
+            else:
+                timestamp, args = write
+                start = time.perf_counter()
+                process, tmp = start_member_write(f, final, args)
+                in_flight[executor.submit(finish_member_write, process, tmp, final, timestamp, start)] = (name, final)
+        except Exception as e:
+            logging.error(f"! 写出 {archive.path}: {name} -> {final} 时出错: {e}")
+            if write is None:
+                continue
+            failed[name] = final
+        if suffix in media_extensions:
+            count += 1
+    collect(list(in_flight))
+    if failed:
+        run_stats.count("write.failed", len(failed))
+        # 成员已被 ExifTool 读取, 压缩包只能顺序读取时需要再读一遍
+        for name, f in archive.members(set(failed)):
+            try:
+                copy_member(f, failed[name])
+            except OSError as e:
+                logging.error(f"! 写出 {archive.path}: {name} -> {failed[name]} 时出错: {e}")
+    return count, written, len(failed)
+
+
+def repair_takeout_archives(archives, directory, unmatched=None):
+    '''
+    repair_takeout_archives 的 Docstring
+    直接读取 Takeout 压缩包, 把修复后的文件写入 directory, 不需要先解压:
+    1. 并行读取各压缩包: 解出 JSON, 按文件头识别媒体文件类型
+    2. 在目录表上匹配、更正扩展名并生成 ExifTool 参数; 媒体文件的移动和改名只记入 ArchivePlan
+    3. 执行 JSON 的改名/复制/修改 title, 再并行读取各压缩包, 每个媒体文件由 ExifTool 从标准输入读取, 写入元数据后直接写到最终路径
+    返回 (写出的媒体文件数, 写入元数据的文件数, 写入失败的文件数)
+    '''
+    destination = os.path.abspath(directory)
+    os.makedirs(destination, exist_ok=True)
+    archives = [TakeoutArchive(path) for path in archives]
+    print(f"--- 阶段 1: 读取 {len(archives)} 个压缩包的文件列表并解出 JSON 文件 ---")
+    media_files, json_files, types = [], [], {}
+    with run_stats.stage("scan"), ContextThreadPoolExecutor(max_workers=setting("scan_workers")) as executor:
+        for media, jsons, kinds in executor.map(lambda archive: index_takeout_archive(archive, destination), archives):
+            media_files += media
+            json_files += jsons
+            types.update(kinds)
+    print(f"扫描完成。发现 {len(media_files)} 个媒体文件，{len(json_files)} 个 JSON 文件。")
+    run_stats.count("scan.media", len(media_files))
+    run_stats.count("scan.json", len(json_files))
+
+    print(f"--- 阶段 2: 匹配媒体文件与配置文件 ---")
+    plan = ArchivePlan(media_files)
+    catalog = FileCatalog.from_paths(media_files, json_files)
+    del media_files, json_files
+    with run_stats.stage("match"):
+        match_catalog(catalog, plan=plan, unmatched=unmatched)
+    print(f"匹配完成。共匹配到 {catalog.pair_count()} 对媒体文件与 JSON 文件。")
+    print(f"--- 阶段 3: 更正扩展名 ---")
+    with run_stats.stage("ext"):
+        correct_ext_of_catalog(catalog, plan=plan, detected_types=types)
+        plan_metadata_writes(catalog, plan)
+        ok, failed = apply_file_actions(plan.file_actions())
+    print(f"扩展名更正完成。JSON 文件操作 {ok} 个成功, {failed} 个失败。")
+
+    print(f"--- 阶段 4: 写出媒体文件并更新元数据 ---")
+    targets = plan.targets()
+    writes = {str(action["media"]): (action["timestamp"], action["args"]) for action in plan.actions if action["op"] == "write"}
+    del plan, catalog, types
+    count = written = failed = 0
+    # 各压缩包并行读取, 同时运行的 ExifTool 进程总数约为 stage4_max_workers, 平均分给同时读取的压缩包
+    readers = max(1, min(len(archives), setting("scan_workers")))
+    window = max(1, setting("stage4_max_workers") // readers)
+    with run_stats.stage("write"), ContextThreadPoolExecutor(max_workers=setting("stage4_max_workers")) as write_executor, \
+            ContextThreadPoolExecutor(max_workers=readers) as executor:
+        for result in executor.map(lambda archive: extract_takeout_archive(archive, destination, targets, writes,
+                                                                             write_executor, window), archives):
+            count += result[0]
+            written += result[1]
+            failed += result[2]
+    return count, written, failed
+
+
+# --- 进度日志 (断点续跑) 与增量缓存 ---
+class _SqliteStore:
+    '''
+    _SqliteStore 的 Docstring
+    多线程共享的 SQLite 文件, 写操作攒够 commit_every 条才提交一次, 避免每个文件都同步一次磁盘
+    '''
+    commit_every = 500
+    schema = ""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.schema)
+
+    def _commit(self):
+        # 调用者需持有 self.lock; 先同步已完成的文件写入, 保证记录为完成的文件都已落盘
+        durable_writes.flush()
+        self.conn.commit()
+
+    def _changed(self, count=1):
+        # 调用者需持有 self.lock
+        self.pending += count
+        if self.pending >= self.commit_every:
+            self._commit()
+            self.pending = 0
+
+    def flush(self):
+        with self.lock:
+            self._commit()
+            self.pending = 0
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+class ProgressJournal(_SqliteStore):
+    '''
+    ProgressJournal 的 Docstring
+    进度日志, 记录扫描结果、匹配对、每次扩展名更正和每个完成的元数据写入, 重新运行时跳过已完成的工作
+    '''
+    schema = '''
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, kind TEXT);
+        CREATE TABLE IF NOT EXISTS pairs (media TEXT PRIMARY KEY, json TEXT,
+                                          ext_done INTEGER DEFAULT 0, written INTEGER DEFAULT 0);
+    '''
+
+    def __init__(self, path, directory):
+        super().__init__(path)
+        root = str(Path(directory).resolve())
+        saved_root = self.get_meta("root")
+        if saved_root is None:
+            self.set_meta("root", root)
+            self.flush()
+        elif saved_root != root:
+            raise ValueError(f"进度日志属于目录 {saved_root}, 与当前目录 {root} 不符")
+        self.ext_done = {row[0] for row in self.conn.execute("SELECT media FROM pairs WHERE ext_done = 1")}
+        self.written = {row[0] for row in self.conn.execute("SELECT media FROM pairs WHERE written = 1")}
+
+    def get_meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    # 阶段 1: 扫描结果
+    def record_scan(self, all_media_files, all_json_files):
+        with self.lock:
+            self.conn.execute("DELETE FROM files")
+            self.conn.executemany("INSERT OR REPLACE INTO files (path, kind) VALUES (?, ?)",
+                                  chain(((str(f), "media") for f in all_media_files), ((str(f), "json") for f in all_json_files)))
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('scan_done', '1')")
+            self._commit()
+            self.pending = 0
+
+    def load_scan_catalog(self):
+        # 返回上次记录的扫描结果 (FileCatalog), 没有记录时返回 None
+        if not self.get_meta("scan_done"):
+            return None
+        catalog = FileCatalog()
+        for path, kind in self.conn.execute("SELECT path, kind FROM files ORDER BY rowid"):
+            catalog.add_path(path, None if kind == "media" else FileCatalog.JSON)
+        return catalog
+
+    # 阶段 2: 匹配对
+    def record_pairs(self, matched_pairs):
+        with self.lock:
+            self.conn.execute("DELETE FROM pairs")
+            self.conn.executemany("INSERT OR REPLACE INTO pairs (media, json) VALUES (?, ?)",
+                                  ((str(m), str(j) if j else None) for m, j in matched_pairs.items()))
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('match_done', '1')")
+            self._commit()
+            self.pending = 0
+        self.ext_done = set()
+        self.written = set()
+
+    def load_pairs_catalog(self):
+        # 返回上次记录的匹配对 (FileCatalog, 包含已更正的文件名), 没有记录时返回 None
+        if not self.get_meta("match_done"):
+            return None
+        return FileCatalog.from_pairs(self.conn.execute("SELECT media, json FROM pairs ORDER BY rowid"))
+
+    # 阶段 3: 扩展名更正
+    def is_ext_done(self, media_file):
+        return str(media_file) in self.ext_done
+
+    def record_rename(self, media_file, new_media_file, new_json_file):
+        # new_media_file 为 None 表示该匹配对已失效, 直接删除
+        with self.lock:
+            if new_media_file is None:
+                self.conn.execute("DELETE FROM pairs WHERE media = ?", (str(media_file),))
+            else:
+                self.conn.execute("UPDATE pairs SET media = ?, json = ?, ext_done = 1 WHERE media = ?",
+                                  (str(new_media_file), str(new_json_file) if new_json_file else None, str(media_file)))
+                self.ext_done.add(str(new_media_file))
+            self._changed()
+
+    def record_json_rename(self, json_file, new_json_file):
+        # 共用的 JSON 改名后, 同步更新所有引用它的匹配对
+        with self.lock:
+            self.conn.execute("UPDATE pairs SET json = ? WHERE json = ?", (str(new_json_file), str(json_file)))
+            self._changed()
+
+    # 阶段 4: 元数据写入
+    def is_written(self, media_file):
+        return str(media_file) in self.written
+
+    def mark_written(self, media_file):
+        with self.lock:
+            self.conn.execute("UPDATE pairs SET written = 1 WHERE media = ?", (str(media_file),))
+            self.written.add(str(media_file))
+            self._changed()
+
+
+class IncrementalCache(_SqliteStore):
+    '''
+    IncrementalCache 的 Docstring
+    增量缓存, 记录每个媒体文件的 (路径, 大小, 修改时间, 部分内容哈希) 以及匹配到的 JSON 和已写入的 ExifTool 参数
+    之后的运行中, 文件没有变化且要写入的元数据相同时跳过 ExifTool
+    另外记录按内容识别出的文件类型, 文件没有变化时不再读取文件头
+    '''
+    schema = '''
+        CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,
+                                          head_hash TEXT, json TEXT, args TEXT);
+        CREATE TABLE IF NOT EXISTS kinds (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, kind TEXT);
+    '''
+    # 部分内容哈希读取文件开头和结尾各 64KB
+    hash_chunk = 64 * 1024
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.entries = {row[0]: row[1:] for row in self.conn.execute(
+            "SELECT path, size, mtime_ns, head_hash, json, args FROM files")}
+        self.kinds = {row[0]: row[1:] for row in self.conn.execute("SELECT path, size, mtime_ns, kind FROM kinds")}
+        self.skipped = 0
+
+    def fingerprint(self, media_file, size):
+        # 文件大小 + 开头和结尾各 hash_chunk 字节的哈希
+        digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+        with open(media_file, "rb") as f:
+            digest.update(f.read(self.hash_chunk))
+            if size > 2 * self.hash_chunk:
+                f.seek(-self.hash_chunk, os.SEEK_END)
+                digest.update(f.read(self.hash_chunk))
+        return digest.hexdigest()
+
+    def lookup(self, media_file, verify_content=True, st=None):
+        '''
+        lookup 的 Docstring
+        文件自上次记录后没有变化时返回缓存记录 (json, args), 否则返回 None
+        verify_content=False 时只比较大小和修改时间, 不读取文件内容
+        st 为已知的 stat 结果 (如扫描阶段取得的), 不提供时调用 os.stat
+        '''
+        # 路径统一转为绝对路径, 用相对路径或绝对路径运行都能命中缓存
+        entry = self.entries.get(os.path.abspath(media_file))
+        if entry is None:
+            return None
+        size, mtime_ns, head_hash, json_path, args = entry
+        if st is None:
+            try:
+                st = os.stat(media_file)
+            except OSError:
+                return None
+        if st.st_size != size or st.st_mtime_ns != mtime_ns:
+            return None
+        if verify_content and self.fingerprint(media_file, size) != head_hash:
+            return None
+        return json_path, args
+
+    def is_current(self, media_file, json_file, args):
+        # 文件没有变化, 且上次用同一个 JSON 写入了相同的元数据
+        entry = self.lookup(media_file)
+        if entry is None or entry != (os.path.abspath(json_file), json.dumps(args, ensure_ascii=False)):
+            return False
+        with self.lock:
+            self.skipped += 1
+        return True
+
+    def record(self, media_file, json_file, args):
+        # 在元数据和文件时间都写完之后调用, 记录的是写入后的文件状态
+        st = os.stat(media_file)
+        row = (st.st_size, st.st_mtime_ns, self.fingerprint(media_file, st.st_size),
+               os.path.abspath(json_file), json.dumps(args, ensure_ascii=False))
+        with self.lock:
+            self.entries[os.path.abspath(media_file)] = row
+            self.conn.execute("INSERT OR REPLACE INTO files (path, size, mtime_ns, head_hash, json, args) "
+                              "VALUES (?, ?, ?, ?, ?, ?)", (os.path.abspath(media_file),) + row)
+            self._changed()
+        # ExifTool 改写了文件, 已识别的类型仍然有效, 更新为写入后的大小和修改时间
+        kind = self.kinds.get(os.path.abspath(media_file))
+        if kind:
+            self.record_kind(media_file, kind[2], st)
+
+    def cached_kind(self, media_file, st=None):
+        # 文件自上次识别后没有变化时返回当时识别的扩展名, 否则返回 None; st 为已知的 stat 结果, 不提供时调用 os.stat
+        entry = self.kinds.get(os.path.abspath(media_file))
+        if entry is None:
+            return None
+        if st is None:
+            try:
+                st = os.stat(media_file)
+            except OSError:
+                return None
+        if (st.st_size, st.st_mtime_ns) != entry[:2]:
+            return None
+        return entry[2]
+
+    def record_kind(self, media_file, kind, st=None):
+        st = st or os.stat(media_file)
+        row = (st.st_size, st.st_mtime_ns, kind)
+        path = os.path.abspath(media_file)
+        with self.lock:
+            if self.kinds.get(path) == row:
+                return
+            self.kinds[path] = row
+            self.conn.execute("INSERT OR REPLACE INTO kinds (path, size, mtime_ns, kind) VALUES (?, ?, ?, ?)", (path,) + row)
+            self._changed()
+
+
+def default_cache_path(directory):
+    # 增量缓存放在根目录旁边, 不会被当作媒体文件扫描
+    root = Path(directory).resolve()
+    return root.parent / f"{root.name}.metafix_cache.db"
+
+
+# --- 可导入的接口 ---
+class RepairConfig:
+    '''
+    RepairConfig 的 Docstring
+    一次修复的设置, 默认值与命令行参数相同
+    全部设置都属于各自的 TakeoutRepairer; timezone 及之后的设置为 None 时沿用模块中的当前值 (命令行在 __main__ 中赋值)
+    '''
+    def __init__(self, state=None, incremental=False, batch_size=1, skip_correct=False, unmatched_dir=None,
+                 unmatched_manifest=None, timezone=None, gps_timezone=None, live_photo_ref=None, quiet=None, scan_workers=None,
+                 executor=None, max_workers=None, sidecar_cache_size=None, durability=None):
+        self.state = state
+        self.incremental = incremental
+        self.batch_size = batch_size
+        self.skip_correct = skip_correct
+        self.unmatched_dir = unmatched_dir
+        self.unmatched_manifest = unmatched_manifest
+        self.timezone = timezone  # 时区名 (如 "Asia/Shanghai") 或 tzinfo
+        self.gps_timezone = gps_timezone  # 按 GPS 位置选择时区, 没有 GPS 的照片使用 timezone
+        self.live_photo_ref = live_photo_ref
+        self.quiet = quiet
+        self.scan_workers = scan_workers
+        self.executor = executor
+        self.max_workers = max_workers
+        self.sidecar_cache_size = sidecar_cache_size
+        self.durability = durability  # durability_levels 之一
+
+    def settings(self):
+        # 以模块变量名为键的设置 (见 setting), 未指定的项取模块中的当前值
+        timezone = pytz.timezone(self.timezone) if isinstance(self.timezone, str) else self.timezone
+        return {
+            "local_timezone": timezone or local_timezone,
+            "gps_timezone": gps_timezone if self.gps_timezone is None else self.gps_timezone,
+            "live_photo_reference": live_photo_reference if self.live_photo_ref is None else self.live_photo_ref,
+            "quiet": quiet if self.quiet is None else self.quiet,
+            "scan_workers": self.scan_workers or scan_workers,
+            "stage4_executor": self.executor or stage4_executor,
+            "stage4_max_workers": self.max_workers or stage4_max_workers,
+            "sidecar_cache_size": self.sidecar_cache_size or sidecar_cache_size,
+            "durability": self.durability or durability,
+        }
+
+
+class RepairContext:
+    '''
+    RepairContext 的 Docstring
+    一个 TakeoutRepairer 的运行环境: 设置 (RepairConfig.settings)、运行统计、持久化写入和 JSON 解析缓存
+    TakeoutRepairer 的方法在自己的环境中执行, 模块中的 setting()、run_stats、durable_writes 和 sidecar_cache 都指向这里
+    '''
+    def __init__(self, settings):
+        self.settings = settings
+        self.run_stats = RunStats()
+        self.durable_writes = DurableWrites(settings["durability"])
+        self.sidecar_cache = SidecarCache(settings["sidecar_cache_size"])
+
+
+def in_repair_context(method):
+    # TakeoutRepairer 方法的装饰器: 在实例自己的 RepairContext 中执行, 已经在其中时 (方法互相调用) 直接执行
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if _repair_context.get() is self.context:
+            return method(self, *args, **kwargs)
+        token = _repair_context.set(self.context)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            _repair_context.reset(token)
+    return wrapper
+
+
+class TakeoutRepairer:
+    '''
+    TakeoutRepairer 的 Docstring
+    可导入的修复接口, 每个实例处理一个根目录, 各阶段可以单独调用:
+        with TakeoutRepairer("/takeout/root", RepairConfig(batch_size=50)) as repairer:
+            repairer.scan()
+            repairer.match()
+            repairer.correct_extensions()
+            repairer.write_metadata()
+    run() 依次执行全部阶段. 进度日志、增量缓存、未匹配文件、匹配结果 (catalog) 以及设置、运行统计 (run_stats)、
+    持久化写入和 JSON 解析缓存都属于实例 (RepairContext), 设置不同的多个实例可以在同一进程的不同线程中同时运行
+    '''
+    def __init__(self, directory, config=None):
+        self.directory = directory
+        self.config = config or RepairConfig()
+        self.context = RepairContext(self.config.settings())
+        self.run_stats = self.context.run_stats
+        self.journal = None
+        self.cache = None
+        self.unmatched = None
+        self.catalog = None
+        self.matched = False
+
+    @in_repair_context
+    def open(self):
+        config = self.config
+        try:
+            # 进度日志 (可选), 用于中断后继续运行; 已有匹配结果时跳过扫描和匹配
+            self.journal = ProgressJournal(config.state, self.directory) if config.state else None
+            # 增量缓存 (可选), 跳过上次处理后没有变化的文件
+            self.cache = IncrementalCache(default_cache_path(self.directory)) if config.incremental else None
+            # 未匹配文件默认移到根目录下的 unmatched 目录, 或只写入清单
+            self.unmatched = UnmatchedFiles(self.directory, config.unmatched_dir, config.unmatched_manifest)
+            if self.journal:
+                self.catalog = self.journal.load_pairs_catalog()
+                self.matched = self.catalog is not None
+        except BaseException:
+            # 打开失败 (如进度日志属于其他根目录) 时关闭已经打开的部分
+            self.close()
+            raise
+        return self
+
+    @in_repair_context
+    def close(self):
+        unmatched, journal, cache = self.unmatched, self.journal, self.cache
+        self.unmatched = self.journal = self.cache = None
+        try:
+            if unmatched:
+                unmatched.close()
+        finally:
+            # 中途出错时也同步已完成的写入, 再提交进度日志和增量缓存
+            durable_writes.flush()
+            if journal:
+                journal.close()
+            if cache:
+                cache.close()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @in_repair_context
+    def scan(self):
+        '''
+        scan 的 Docstring
+        阶段 1: 扫描根目录, 返回 FileCatalog; 进度日志中有扫描结果时直接读取
+        '''
+        if self.catalog is not None:
+            return self.catalog
+        print(f"--- 阶段 1: 寻找并归类媒体文件与配置文件 ---")
+        with run_stats.stage("scan"):
+            catalog = self.journal.load_scan_catalog() if self.journal else None
+            if catalog:
+                print(f"从进度日志 {self.config.state} 读取扫描结果")
+            else:
+                # 只遍历一次目录树, 结果放入紧凑的目录表; 增量模式下同时保留大小和修改时间供后续阶段复用
+                catalog = scan_catalog(self.directory, with_stats=bool(self.cache),
+                                       exclude=self.unmatched.scan_exclude() if self.unmatched else None)
+                if self.journal:
+                    self.journal.record_scan((catalog.path_str(i) for i in catalog.indices(FileCatalog.IMAGE, FileCatalog.VIDEO)),
+                                             (catalog.path_str(i) for i in catalog.indices(FileCatalog.JSON)))
+        media_count = len(catalog.indices(FileCatalog.IMAGE, FileCatalog.VIDEO))
+        json_count = len(catalog.names) - media_count
+        print(f"扫描完成。发现 {media_count} 个媒体文件，{json_count} 个 JSON 文件。")
+        run_stats.count("scan.media", media_count)
+        run_stats.count("scan.json", json_count)
+        self.catalog = catalog
+        return catalog
+
+    @in_repair_context
+    def match(self, plan=None):
+        '''
+        match 的 Docstring
+        阶段 2: 匹配媒体文件与 JSON 文件, 未匹配的文件交给 unmatched; 返回匹配对的数量
+        '''
+        if self.matched:
+            print(f"从进度日志 {self.config.state} 读取匹配结果, 跳过阶段 1 和阶段 2")
+        else:
+            catalog = self.scan()
+            print(f"--- 阶段 2: 匹配媒体文件与配置文件 ---")
+            with run_stats.stage("match"):
+                match_catalog(catalog, plan=plan, unmatched=self.unmatched)
+                durable_writes.flush()
+                if self.journal:
+                    self.journal.record_pairs(catalog)
+            self.matched = True
+        pair_count = self.catalog.pair_count()
+        print(f"匹配完成。共匹配到 {pair_count} 对媒体文件与 JSON 文件。")
+        return pair_count
+
+    @in_repair_context
+    def correct_extensions(self, plan=None):
+        # 阶段 3: 按文件内容更正扩展名 (需要先 match)
+        if not self.matched:
+            self.match(plan)
+        print(f"--- 阶段 3: 更正扩展名 ---")
+        with run_stats.stage("ext"):
+            correct_ext_of_catalog(self.catalog, self.journal, self.cache, plan)
+            durable_writes.flush()
+            if self.journal:
+                self.journal.flush()
+        print(f"扩展名更正完成。")
+
+    @in_repair_context
+    def write_metadata(self):
+        # 阶段 4: 写入元数据 (需要先 match, 通常在 correct_extensions 之后), 返回预检查跳过的文件数
+        if not self.matched:
+            self.match()
+        print(f"--- 阶段 4: 更新元数据 ---")
+        with run_stats.stage("write"):
+            precheck_skipped = update_media_metadata_with_matched_pairs_multi_tasking(
+                self.catalog, self.journal, self.cache, self.config.batch_size, self.config.skip_correct)
+            durable_writes.flush()
+        print(f"元数据更新完成。")
+        if self.config.skip_correct:
+            print(f"预检查: {precheck_skipped} 个文件的元数据已经正确, 已跳过写入。")
+        if self.cache:
+            print(f"增量模式: {self.cache.skipped} 个文件未变化, 已跳过 ExifTool。")
+        return precheck_skipped
+
+    @in_repair_context
+    def save_plan(self, plan_file):
+        '''
+        save_plan 的 Docstring
+        演练模式: 匹配、识别类型并生成 ExifTool 参数, 全部记入计划文件, 不修改任何文件; 返回计划的汇总
+        '''
+        plan = ActionPlan()
+        self.match(plan)
+        self.correct_extensions(plan)
+        print(f"--- 阶段 4: 生成元数据写入计划 ---")
+        with run_stats.stage("plan"):
+            plan_metadata_writes(self.catalog, plan)
+            summary = plan.save(plan_file, self.directory)
+        print(f"计划已保存到 {plan_file}: 移动 {summary.get('move', 0)} 个, 复制 {summary.get('copy', 0)} 个, "
+              f"改名 {summary.get('rename', 0)} 个, 修改 title {summary.get('title', 0)} 个, 写入元数据 {summary.get('write', 0)} 个文件")
+        print(f"预计重写 {summary['bytes'] / 1e9:.2f} GB ({summary['bytes']} 字节)。确认后使用 --apply {plan_file} 执行。")
+        return summary
+
+    @in_repair_context
+    def stream(self):
+        # 流式模式: 四个阶段按目录流水线执行, 返回 (匹配对的数量, 预检查跳过的文件数)
+        print(f"--- 流式处理: 扫描 → 匹配 → 更正扩展名 → 更新元数据 ---")
+        with run_stats.stage("stream"):
+            pair_count, precheck_skipped = stream_media_files(self.directory, self.cache, self.config.batch_size,
+                                                              self.config.skip_correct, self.unmatched)
+            durable_writes.flush()
+        print(f"元数据更新完成。共处理 {pair_count} 对媒体文件与 JSON 文件。")
+        if self.config.skip_correct:
+            print(f"预检查: {precheck_skipped} 个文件的元数据已经正确, 已跳过写入。")
+        if self.cache:
+            print(f"增量模式: {self.cache.skipped} 个文件未变化, 已跳过 ExifTool。")
+        return pair_count, precheck_skipped
+
+    @in_repair_context
+    def run(self):
+        # 依次执行全部阶段, 返回预检查跳过的文件数
+        self.match()
+        self.correct_extensions()
+        return self.write_metadata()
+
+    @in_repair_context
+    def apply_plan(self, plan_file):
+        # 执行 save_plan 生成的计划, 返回 (成功的文件操作数, 失败的文件操作数, 写入任务数)
+        with run_stats.stage("apply"):
+            result = apply_plan(plan_file, self.config.batch_size)
+            durable_writes.flush()
+        return result
+
+    @in_repair_context
+    def repair_archives(self, archives):
+        # 直接读取 Takeout 压缩包, 修复后的文件写入根目录 (此时为输出目录), 返回 (写出的媒体文件数, 写入元数据的文件数, 写入失败的文件数)
+        result = repair_takeout_archives(archives, self.directory, self.unmatched)
+        durable_writes.flush()
+        return result
+
+
+# ⭐ 主函数 (修改为两阶段处理) ⭐
+def repair_media_files(directory, state=None, incremental=False, stream=False, batch_size=1, skip_correct=False, report=None,
+                       plan_file=None, apply_file=None, archives=None, unmatched_dir=None, unmatched_manifest=None):
+    # 2.1 构造基于目录的日志文件名
+    # 规范化目录名，防止特殊字符
+    sanitized_dir = Path(directory).name.replace(os.sep, '_').replace(':', '_').replace(' ', '_')
+    log_filename = f"media_file_repair_{sanitized_dir}.log"
+    # 运行报告默认与日志文件放在一起
+    report_filename = report or f"media_file_repair_{sanitized_dir}.report.json"
+
+    # 2.2 配置日志（只在这个实例中生效）
+    # 注意：要用 filemode='w' 清空旧日志，或用 'a' 追加
+    logging.basicConfig(filename=log_filename, level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s", encoding="utf-8", filemode='a')
+    print(f"日志文件: {log_filename}")
+
+    # 2.3 进度日志、增量缓存和未匹配文件的处理由 TakeoutRepairer 管理
+    repairer = TakeoutRepairer(directory, RepairConfig(state=state, incremental=incremental, batch_size=batch_size,
+                                                       skip_correct=skip_correct, unmatched_dir=unmatched_dir,
+                                                       unmatched_manifest=unmatched_manifest)).open()
+    run_start = time.perf_counter()
+    try:
+        if apply_file:
+            # --- 执行计划: 不再扫描和匹配 ---
+            ok, failed, write_count = repairer.apply_plan(apply_file)
+            print(f"计划执行完成。文件操作 {ok} 个成功, {failed} 个失败; 写入元数据 {write_count} 个文件。")
+        elif archives:
+            # --- 直接读取 Takeout 压缩包: directory 为输出目录 ---
+            count, written, failed = repairer.repair_archives(archives)
+            print(f"压缩包处理完成。共写出 {count} 个媒体文件, 其中 {written} 个写入了元数据, {failed} 个写入失败 (已原样写出)。")
+        elif stream:
+            repairer.stream()
+        elif plan_file:
+            # --- 演练模式: 只生成操作计划, 不修改文件 ---
+            repairer.save_plan(plan_file)
+        else:
+            repairer.run()
+    finally:
+        cache = repairer.cache
+        repairer.close()
+        if unmatched_manifest:
+            print(f"未匹配文件清单已保存到 {unmatched_manifest}")
+        stats = repairer.run_stats
+        if cache:
+            stats.count("incremental.skipped", cache.skipped)
+        # 无论正常结束还是中途出错, 都写出运行报告
+        stats.add_stage("total", time.perf_counter() - run_start)
+        stats.print_summary()
+        stats.write_report(report_filename)
+
+
+if __name__ == "__main__":
+    # 使用argparse解析命令行参数
+    parser = argparse.ArgumentParser(description="修复媒体文件元数据")
+    parser.add_argument("directory", help="需要处理的目录路径")
+    parser.add_argument("--state", help="进度日志文件路径 (SQLite), 中断后用同一个文件重新运行即可从断点继续")
+    parser.add_argument("--incremental", action="store_true", help="增量模式: 缓存放在根目录旁边, 跳过上次处理后没有变化的文件")
+    parser.add_argument("--stream", action="store_true", help="流式模式: 逐个目录匹配并立即写入元数据, 不等待全部扫描完成")
+    parser.add_argument("--batch-size", type=int, default=1, help="阶段 4 每批写入的文件数, 大于 1 时按目录分组批量调用 ExifTool (默认 1)")
+    parser.add_argument("--skip-correct", action="store_true", help="写入前按目录批量读取已有元数据, 跳过拍摄时间、GPS 和文件时间都已正确的文件")
+    parser.add_argument("--executor", choices=stage4_executors, default=stage4_executor, help="阶段 4 的执行后端: thread (线程), asyncio (异步子进程), 默认 thread")
+    parser.add_argument("--max-workers", type=int, default=stage4_max_workers, help=f"阶段 4 的最大并发数, 实际并发会根据吞吐自动调整 (默认 {stage4_max_workers})")
+    parser.add_argument("--live-photo-ref", action="store_true", help="live photo 视频直接引用同名图片的 JSON, 不再复制一份 JSON 文件")
+    parser.add_argument("--plan", metavar="PLAN", help="演练模式: 只扫描、匹配和识别类型, 把所有移动、改名、JSON 修改和 ExifTool 参数写入计划文件, 不修改任何文件")
+    parser.add_argument("--apply", metavar="PLAN", help="执行 --plan 生成的计划文件, 不再重复匹配和类型识别")
+    parser.add_argument("--archives", nargs="+", metavar="ARCHIVE", help="直接读取 Takeout 压缩包 (.zip/.tgz), 不先解压; 此时 directory 为输出目录")
+    parser.add_argument("--unmatched-dir", help=f"未匹配文件的移动目标目录 (默认为根目录下的 {unmatched_dir_name})")
+    parser.add_argument("--unmatched-manifest", metavar="FILE", help="不移动未匹配的文件, 只把它们写入清单文件 (JSON Lines)")
+    parser.add_argument("--report", help="运行报告 (JSON) 的保存路径, 默认与日志文件放在一起")
+    parser.add_argument("--quiet", action="store_true", help="不输出逐文件的信息和阶段 4 的进度 (进度写入日志文件), 只输出阶段标题、错误和汇总")
+    parser.add_argument("--scan-workers", type=int, default=scan_workers, help=f"并行扫描目录和移动未匹配文件的线程数 (默认 {scan_workers})")
+    parser.add_argument("--timezone", default=local_timezone.zone, help=f"写入拍摄时间使用的时区 (IANA 时区名, 如 Europe/Berlin、UTC), 默认 {local_timezone.zone}")
+    parser.add_argument("--durability", choices=durability_levels, default=durability,
+                        help="写入的持久化级别: none (只保证原子替换), batch (按目录成组 fsync), file (每个文件立即 fsync), 默认 none")
+    parser.add_argument("--gps-timezone", action="store_true", help="按照片的 GPS 位置选择时区 (需要 pip install timezonefinder), 没有 GPS 的照片使用 --timezone; "
+                             "按 0.1 度网格近似: 四个角和中心点在同一时区的网格整格使用该时区")
+    args = parser.parse_args()
+    try:
+        local_timezone = pytz.timezone(args.timezone)
+    except pytz.UnknownTimeZoneError:
+        parser.error(f"未知的时区: {args.timezone}")
+    gps_timezone = args.gps_timezone
+    durability = args.durability
+    if gps_timezone:
+        try:
+            gps_timezone_finder()
+        except ImportError as e:
+            parser.error(str(e))
+    scan_workers = args.scan_workers
+    stage4_executor = args.executor
+    stage4_max_workers = args.max_workers
+    quiet = args.quiet
+    live_photo_reference = args.live_photo_ref
+    if args.stream and args.state:
+        parser.error("--stream 不支持 --state, 流式模式可配合 --incremental 实现断点续跑")
+    if args.plan and args.apply:
+        parser.error("--plan 和 --apply 不能同时使用")
+    if (args.plan or args.apply) and (args.stream or args.state or args.incremental or args.skip_correct):
+        parser.error("--plan/--apply 不支持 --stream、--state、--incremental 和 --skip-correct")
+    if args.apply and (args.unmatched_dir or args.unmatched_manifest):
+        parser.error("--apply 按计划中记录的位置移动未匹配文件, 不支持 --unmatched-dir 和 --unmatched-manifest")
+    if args.archives and (args.plan or args.apply or args.stream or args.state or args.incremental or args.skip_correct):
+        parser.error("--archives 不支持 --plan、--apply、--stream、--state、--incremental 和 --skip-correct")
 
-    repair_media_files(args.directory)
+    repair_media_files(args.directory, state=args.state, incremental=args.incremental, stream=args.stream, batch_size=args.batch_size, skip_correct=args.skip_correct, report=args.report,
+                       plan_file=args.plan, apply_file=args.apply, archives=args.archives,
+                       unmatched_dir=args.unmatched_dir, unmatched_manifest=args.unmatched_manifest)
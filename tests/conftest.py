@@ -0,0 +1,139 @@
+import json
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# 脚本不是安装的包, 直接从仓库根目录导入
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import google_takeout_metafix_v2_mt as metafix  # noqa: E402
+
+
+@pytest.fixture
+def quiet_context():
+    # 在独立的 RepairContext 中运行 (不输出逐文件信息, 统计不写入模块级的 run_stats)
+    context = metafix.RepairContext(metafix.RepairConfig(quiet=True).settings())
+    token = metafix._repair_context.set(context)
+    yield context
+    metafix._repair_context.reset(token)
+
+
+
+JPG = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00" + b"\x00" * 200
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 200
+MP4 = b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom" + b"\x00" * 200
+
+
+def sidecar(title, timestamp):
+    return json.dumps({"title": title, "photoTakenTime": {"timestamp": str(timestamp)},
+                       "geoData": {"latitude": 23.1, "longitude": 120.5, "altitude": 3.0}})
+
+
+@pytest.fixture
+def takeout_tree(tmp_path):
+    # 一个小的 Takeout 目录树: 普通匹配对、去重编号、扩展名错误、live photo、未匹配的媒体文件和 JSON
+    root = tmp_path / "Takeout" / "Google Photos"
+    for folder in ("Photos from 2020", "Album A"):
+        p = root / folder
+        p.mkdir(parents=True)
+        for i in range(3):
+            (p / f"IMG_{i}.jpg").write_bytes(JPG + bytes([i]))
+            (p / f"IMG_{i}.jpg.json").write_text(sidecar(f"IMG_{i}.jpg", 1600000000 + i))
+        (p / "IMG_1(1).jpg").write_bytes(JPG)
+        (p / "IMG_1.jpg(1).json").write_text(sidecar("IMG_1(1).jpg", 1600000100))
+        (p / "wrong.jpg").write_bytes(PNG)
+        (p / "wrong.jpg.supplemental-metadata.json").write_text(sidecar("wrong.jpg", 1600000200))
+        (p / "LIVE_1.heic").write_bytes(JPG)
+        (p / "LIVE_1.heic.json").write_text(sidecar("LIVE_1.heic", 1600000400))
+        (p / "LIVE_1.mp4").write_bytes(MP4)
+        (p / "orphan.jpg").write_bytes(JPG + b"orphan")
+        (p / "metadata.json").write_text("{}")
+    return root
+
+
+class FakeExifToolPool:
+    '''
+    FakeExifToolPool 的 Docstring
+    代替常驻 ExifTool 进程池, 不需要安装 exiftool; 记录收到的目标文件和完整参数, 按 behaviour(目标文件) 的结果
+    返回成功/失败或抛出异常 (behaviour 返回异常实例时)
+    '''
+    behaviour = staticmethod(lambda target: True)
+    targets = []
+    commands = []
+
+    def __init__(self, size):
+        self.size = size
+
+    def execute(self, args, timeout=None):
+        return self.execute_many([args], timeout)[0]
+
+    def execute_many(self, commands, timeout=None):
+        results = []
+        for args in commands:
+            target = args[-1]
+            FakeExifToolPool.targets.append(target)
+            FakeExifToolPool.commands.append(list(args))
+            outcome = FakeExifToolPool.behaviour(target)
+            if isinstance(outcome, BaseException):
+                raise outcome
+            results.append((True, "    1 image files updated\n", "") if outcome else (False, "", f"Error: cannot write {target}\n"))
+        return results
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@pytest.fixture
+def fake_exiftool(monkeypatch):
+    monkeypatch.setattr(metafix, "ExifToolPool", FakeExifToolPool)
+    monkeypatch.setattr(FakeExifToolPool, "behaviour", staticmethod(lambda target: True))
+    monkeypatch.setattr(FakeExifToolPool, "targets", [])
+    monkeypatch.setattr(FakeExifToolPool, "commands", [])
+    return FakeExifToolPool
+
+
+EXIFTOOL_STUB = '''#!{python}
+# 代替 exiftool 的一次性写入: exiftool <参数...> -o <输出文件> -, 从标准输入读取文件内容
+import json, os, sys, time
+args = sys.argv[1:]
+output = args[args.index("-o") + 1]
+start = time.time()
+data = sys.stdin.buffer.read()
+time.sleep(float(os.environ.get("STUB_DELAY", "0")))
+fail = os.environ.get("STUB_FAIL")
+if os.environ.get("STUB_LOG"):
+    with open(os.environ["STUB_LOG"], "a") as log:
+        log.write(json.dumps({{"output": output, "start": start, "end": time.time()}}) + "\\n")
+if fail and fail in output:
+    sys.stderr.write("Error: cannot write " + output + "\\n")
+    sys.exit(1)
+no_output = os.environ.get("STUB_NO_OUTPUT")
+if not (no_output and no_output in output):
+    with open(output, "xb") as f:
+        f.write(data + b"<exif>")
+print("    1 image files created")
+'''
+
+
+@pytest.fixture
+def exiftool_stub(tmp_path, monkeypatch):
+    # 可执行的 exiftool 替身, 写出的文件内容为原内容加上 b"<exif>"; 通过环境变量控制失败 (STUB_FAIL)、
+    # 报告成功但没有写出文件 (STUB_NO_OUTPUT)、延迟 (STUB_DELAY) 和调用记录 (STUB_LOG)
+    if os.name == "nt":
+        pytest.skip("替身脚本需要 shebang")
+    stub = tmp_path / "bin" / "exiftool"
+    stub.parent.mkdir()
+    stub.write_text(EXIFTOOL_STUB.format(python=sys.executable))
+    stub.chmod(0o755)
+    monkeypatch.setattr(metafix, "get_exiftool_path", lambda: str(stub))
+    for name in ("STUB_FAIL", "STUB_NO_OUTPUT", "STUB_DELAY", "STUB_LOG"):
+        monkeypatch.delenv(name, raising=False)
+    return stub
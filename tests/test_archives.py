@@ -0,0 +1,107 @@
+import json
+import os
+import tarfile
+import zipfile
+from collections import Counter
+from pathlib import Path
+
+import pytest
+
+import google_takeout_metafix_v2_mt as metafix
+
+MARKER = b"<exif>"
+
+
+def build_archive(tree, path):
+    # 把 takeout_tree 打包为 zip 或 tgz, 成员名以 Takeout/ 开头
+    base = tree.parent.parent
+    files = sorted(p for p in base.rglob("*") if p.is_file())
+    if path.suffix == ".zip":
+        with zipfile.ZipFile(path, "w") as archive:
+            for p in files:
+                archive.write(p, p.relative_to(base).as_posix())
+    else:
+        with tarfile.open(path, "w:gz") as archive:
+            for p in files:
+                archive.add(p, p.relative_to(base).as_posix())
+    return {p.relative_to(base).as_posix(): p.read_bytes() for p in files}
+
+
+def media_outputs(root):
+    return [p for p in Path(root).rglob("*") if p.is_file() and p.suffix.lower() in metafix.media_extensions]
+
+
+def raw_contents(root):
+    # 去掉替身写入的标记, 得到原始内容
+    return Counter(p.read_bytes().removesuffix(MARKER) for p in media_outputs(root))
+
+
+@pytest.mark.parametrize("suffix", [".zip", ".tgz"])
+def test_failed_writes_fall_back_to_raw_members(tmp_path, takeout_tree, exiftool_stub, quiet_context, capsys,
+                                                monkeypatch, suffix):
+    members = build_archive(takeout_tree, tmp_path / f"takeout{suffix}")
+    media = {name: data for name, data in members.items() if Path(name).suffix.lower() in metafix.media_extensions}
+    # IMG_2 ExifTool 报告失败; IMG_0 报告成功但没有写出文件 (改名时出错); 其余成功
+    monkeypatch.setenv("STUB_FAIL", "IMG_2")
+    monkeypatch.setenv("STUB_NO_OUTPUT", "IMG_0")
+    output = tmp_path / "Output"
+    count, written, failed = metafix.repair_takeout_archives([tmp_path / f"takeout{suffix}"], output,
+                                                             metafix.UnmatchedFiles(output))
+    capsys.readouterr()
+
+    assert count == len(media)
+    assert failed == 4  # 两个目录中的 IMG_0 和 IMG_2
+    assert written == sum(p.read_bytes().endswith(MARKER) for p in media_outputs(output)) > 0
+    # 没有丢失任何媒体文件 (未匹配的写到 unmatched 目录), 失败的成员原样写出, 也没有留下临时文件
+    assert raw_contents(output) == Counter(media.values())
+    assert (output / "unmatched" / "Takeout" / "Google Photos" / "Album A" / "orphan.jpg").read_bytes() == \
+        media["Takeout/Google Photos/Album A/orphan.jpg"]
+    for folder in ("Photos from 2020", "Album A"):
+        for name in ("IMG_0.jpg", "IMG_2.jpg"):
+            assert (output / "Takeout" / "Google Photos" / folder / name).read_bytes() == \
+                media[f"Takeout/Google Photos/{folder}/{name}"]
+        # 成功的成员只由 ExifTool 写出一次
+        assert (output / "Takeout" / "Google Photos" / folder / "IMG_1.jpg").read_bytes() == \
+            media[f"Takeout/Google Photos/{folder}/IMG_1.jpg"] + MARKER
+    leftovers = [name for _, _, names in os.walk(output) for name in names if name.startswith(".")]
+    assert leftovers == []
+    assert quiet_context.run_stats.counters["write.failed"] == failed
+    assert quiet_context.run_stats.counters["write.ok"] == written
+
+
+def test_all_writes_failing_still_writes_every_member(tmp_path, takeout_tree, exiftool_stub, quiet_context, capsys,
+                                                      monkeypatch):
+    members = build_archive(takeout_tree, tmp_path / "takeout.zip")
+    media = [data for name, data in members.items() if Path(name).suffix.lower() in metafix.media_extensions]
+    monkeypatch.setenv("STUB_FAIL", "Takeout")
+    output = tmp_path / "Output"
+    count, written, failed = metafix.repair_takeout_archives([tmp_path / "takeout.zip"], output, metafix.UnmatchedFiles(output))
+    capsys.readouterr()
+    assert (count, written) == (len(media), 0)
+    assert failed > 0
+    assert Counter(p.read_bytes() for p in media_outputs(output)) == Counter(media)
+
+
+def test_writes_in_flight_are_capped(tmp_path, takeout_tree, exiftool_stub, capsys, monkeypatch):
+    build_archive(takeout_tree, tmp_path / "takeout.zip")
+    log = tmp_path / "exiftool.log"
+    monkeypatch.setenv("STUB_LOG", str(log))
+    monkeypatch.setenv("STUB_DELAY", "0.05")
+    context = metafix.RepairContext(metafix.RepairConfig(quiet=True, max_workers=2, scan_workers=1).settings())
+    token = metafix._repair_context.set(context)
+    try:
+        output = tmp_path / "Output"
+        count, written, failed = metafix.repair_takeout_archives([tmp_path / "takeout.zip"], output,
+                                                                 metafix.UnmatchedFiles(output))
+    finally:
+        metafix._repair_context.reset(token)
+    capsys.readouterr()
+    runs = [json.loads(line) for line in log.read_text().splitlines()]
+    assert len(runs) == written > 2 and failed == 0
+    # 同一时刻运行的 ExifTool (以及输出目录里的临时文件) 不超过 stage4_max_workers 个
+    events = sorted([(run["start"], 1) for run in runs] + [(run["end"], -1) for run in runs])
+    running = peak = 0
+    for _, change in events:
+        running += change
+        peak = max(peak, running)
+    assert peak <= 2
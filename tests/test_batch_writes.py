@@ -0,0 +1,31 @@
+import google_takeout_metafix_v2_mt as metafix
+
+PATHS = ["/photos/A/IMG_1.jpg", "/photos/A/IMG_2.jpg", "/photos/A/Trip - Day 1.jpg"]
+UPDATED = "    3 image files updated\n"
+
+
+def test_successful_batch_has_no_failures():
+    assert metafix.exiftool_failed_files(UPDATED, "", PATHS) == set()
+    # 警告不算失败
+    assert metafix.exiftool_failed_files(UPDATED, "Warning: [minor] Bad MakerNotes - /photos/A/IMG_1.jpg\n", PATHS) == set()
+
+
+def test_per_file_error_lines_fail_only_those_files():
+    stdout = "    1 image files updated\n    2 files weren't updated due to errors\n"
+    stderr = ("Error: Not a valid JPG (looks more like a PNG) - /photos/A/IMG_2.jpg\n"
+              "Error: File is read-only - /photos/A/Trip - Day 1.jpg\n")
+    assert metafix.exiftool_failed_files(stdout, stderr, PATHS) == {PATHS[1], PATHS[2]}
+
+
+def test_paths_are_compared_after_normalisation():
+    stderr = "Error: File not found - /photos/A/./IMG_1.jpg\n"
+    assert metafix.exiftool_failed_files("", stderr, PATHS) == {PATHS[0]}
+
+
+def test_unattributed_errors_fail_the_whole_batch():
+    assert metafix.exiftool_failed_files("", "Error: Unknown option -Foo\n", PATHS) == set(PATHS)
+    # 有一行无法归属时, 不能只信任其他行
+    stderr = "Error: Bad format - /photos/A/IMG_1.jpg\nError: something else\n"
+    assert metafix.exiftool_failed_files("", stderr, PATHS) == set(PATHS)
+    # 只有 "weren't updated" 而没有错误行
+    assert metafix.exiftool_failed_files("    1 files weren't updated due to errors\n", "", PATHS) == set(PATHS)
@@ -0,0 +1,91 @@
+import os
+import stat
+
+import pytest
+
+import google_takeout_metafix_v2_mt as metafix
+
+
+def leftovers(directory):
+    return [name for name in os.listdir(directory) if name.startswith(".")]
+
+
+@pytest.mark.skipif(os.name == "nt", reason="Windows 没有 Unix 权限位")
+def test_replace_keeps_permission_bits(tmp_path, quiet_context):
+    path = tmp_path / "IMG_1.jpg.json"
+    path.write_text("{}")
+    path.chmod(0o640)
+    metafix.durable_writes.write_text(path, '{"title": "IMG_1.jpg"}')
+    assert path.read_text() == '{"title": "IMG_1.jpg"}'
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+    # 复制覆盖已有文件时也保留目标的权限位
+    src = tmp_path / "other.json"
+    src.write_text("[]")
+    src.chmod(0o600)
+    metafix.durable_writes.copy(src, path)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+
+
+def test_failed_write_leaves_original_and_no_partial_file(tmp_path, quiet_context, monkeypatch):
+    path = tmp_path / "IMG_1.jpg.json"
+    path.write_text("original")
+    # 写临时文件时出错
+    with pytest.raises(TypeError):
+        metafix.durable_writes.write_text(path, None)
+    assert path.read_text() == "original"
+    assert leftovers(tmp_path) == []
+
+    # 替换时出错
+    def failing_replace(src, dst):
+        raise OSError("disk full")
+    monkeypatch.setattr(metafix.os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        metafix.durable_writes.write_text(path, "new")
+    assert path.read_text() == "original"
+    assert leftovers(tmp_path) == []
+
+
+class RecordingConnection:
+    # 代替 sqlite3 连接 (commit 不能直接替换), 记录提交的时机
+    def __init__(self, conn, events):
+        self.conn = conn
+        self.events = events
+
+    def commit(self):
+        self.events.append(("commit", None))
+        self.conn.commit()
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def test_batch_mode_syncs_pending_directories_before_journal_commit(tmp_path, monkeypatch):
+    context = metafix.RepairContext(metafix.RepairConfig(quiet=True, durability="batch").settings())
+    token = metafix._repair_context.set(context)
+    try:
+        events = []
+        real_fsync_path = metafix.fsync_path
+
+        def fsync_path(path, directory=False):
+            events.append(("fsync", os.path.abspath(path)))
+            real_fsync_path(path, directory)
+        monkeypatch.setattr(metafix, "fsync_path", fsync_path)
+        journal = metafix.ProgressJournal(tmp_path / "state.db", tmp_path)
+        journal.conn = RecordingConnection(journal.conn, events)
+        folder = tmp_path / "Album A"
+        folder.mkdir()
+        path = folder / "IMG_1.jpg.json"
+        path.write_text("{}")
+        events.clear()
+        metafix.durable_writes.write_text(path, '{"title": "IMG_1.jpg"}')
+        # batch 级别下写入后不立即同步, 提交进度日志前才同步文件和目录
+        assert events == []
+        journal.mark_written(path)
+        journal.flush()
+        assert events[-1] == ("commit", None)
+        synced = [path for kind, path in events[:-1] if kind == "fsync"]
+        assert str(path) in synced and str(folder) in synced
+        assert context.durable_writes.pending == {}
+        journal.close()
+    finally:
+        metafix._repair_context.reset(token)
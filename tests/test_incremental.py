@@ -0,0 +1,52 @@
+import os
+
+import google_takeout_metafix_v2_mt as metafix
+from conftest import JPG, PNG
+
+
+def test_scan_stats_are_used_without_another_stat(tmp_path, quiet_context, monkeypatch):
+    media_file = tmp_path / "IMG_1.jpg"
+    media_file.write_bytes(PNG)
+    cache = metafix.IncrementalCache(tmp_path / "cache.db")
+    try:
+        cache.record_kind(media_file, ".png")
+        st = os.stat(media_file)
+        scanned = metafix.FileStat(st.st_size, st.st_mtime_ns)
+
+        def no_stat(*args, **kwargs):
+            raise AssertionError("扫描阶段已有 stat 结果, 不应再次 stat")
+        monkeypatch.setattr(metafix.os, "stat", no_stat)
+        assert cache.cached_kind(media_file, scanned) == ".png"
+        detected = metafix.detect_media_types([media_file], cache, stats={media_file: scanned})
+        assert detected == {media_file: ".png"}
+        monkeypatch.undo()
+        # 文件变化后 (大小或修改时间不同) 重新识别
+        media_file.write_bytes(JPG)
+        changed = os.stat(media_file)
+        assert cache.cached_kind(media_file, metafix.FileStat(changed.st_size, changed.st_mtime_ns)) is None
+        assert metafix.detect_media_types([media_file], cache) == {media_file: ".jpg"}
+    finally:
+        cache.close()
+
+
+def test_incremental_rerun_reuses_catalog_stats(tmp_path, takeout_tree, fake_exiftool, monkeypatch, capsys):
+    config = metafix.RepairConfig(quiet=True, incremental=True)
+    with metafix.TakeoutRepairer(takeout_tree, config) as repairer:
+        repairer.run()
+    # 修改一个文件的时间, 第二次运行时它需要重新识别类型, 应使用扫描时的 stat 结果
+    changed = takeout_tree / "Album A" / "IMG_2.jpg"
+    os.utime(changed, (1500000000, 1500000000))
+    calls = []
+    real_cached_kind = metafix.IncrementalCache.cached_kind
+
+    def cached_kind(self, media_file, st=None):
+        calls.append((media_file, st))
+        return real_cached_kind(self, media_file, st)
+    monkeypatch.setattr(metafix.IncrementalCache, "cached_kind", cached_kind)
+    fake_exiftool.targets.clear()
+    with metafix.TakeoutRepairer(takeout_tree, config) as repairer:
+        repairer.run()
+    capsys.readouterr()
+    assert [media_file for media_file, _ in calls] == [changed]
+    assert calls[0][1].st_mtime_ns == 1500000000 * 10 ** 9
+    assert [os.path.basename(target) for target in fake_exiftool.targets] == ["IMG_2.jpg"]
@@ -0,0 +1,66 @@
+from pathlib import Path
+
+import pytest
+
+import google_takeout_metafix_v2_mt as metafix
+
+
+def test_journal_records_survive_reopen(tmp_path):
+    root = tmp_path / "root"
+    root.mkdir()
+    state = tmp_path / "state.db"
+    media = [root / "a.jpg", root / "b.mp4"]
+    json_files = [root / "a.jpg.json", root / "b.mp4.json"]
+    journal = metafix.ProgressJournal(state, root)
+    journal.record_scan(media, json_files)
+    journal.record_pairs(dict(zip(media, json_files)))
+    journal.record_rename(media[1], root / "b.mov", json_files[1])
+    journal.mark_written(media[0])
+    journal.close()
+
+    journal = metafix.ProgressJournal(state, root)
+    try:
+        catalog = journal.load_pairs_catalog()
+        assert catalog.pair_count() == 2
+        assert journal.is_written(media[0])
+        assert not journal.is_written(root / "b.mov")
+        assert journal.is_ext_done(root / "b.mov")
+        assert not journal.is_ext_done(media[0])
+        assert journal.load_scan_catalog() is not None
+    finally:
+        journal.close()
+
+
+def test_journal_refuses_another_root(tmp_path):
+    state = tmp_path / "state.db"
+    metafix.ProgressJournal(state, tmp_path / "a").close()
+    with pytest.raises(ValueError):
+        metafix.ProgressJournal(state, tmp_path / "b")
+
+
+def test_resume_writes_only_unfinished_files(tmp_path, takeout_tree, fake_exiftool, capsys):
+    config = metafix.RepairConfig(state=str(tmp_path / "state.db"), quiet=True)
+    # 第一次运行: IMG_1 写入失败 (相当于中断前没有完成)
+    fake_exiftool.behaviour = staticmethod(lambda target: Path(target).name != "IMG_1.jpg")
+    with metafix.TakeoutRepairer(takeout_tree, config) as repairer:
+        repairer.run()
+        first_pairs = repairer.catalog.pair_count()
+    first = [Path(target) for target in fake_exiftool.targets]
+    assert first_pairs == len(first)
+
+    # 第二次运行: 从进度日志读取匹配结果, 只重新写入没有完成的文件
+    fake_exiftool.targets.clear()
+    fake_exiftool.behaviour = staticmethod(lambda target: True)
+    with metafix.TakeoutRepairer(takeout_tree, config) as repairer:
+        assert repairer.matched
+        repairer.run()
+        assert repairer.catalog.pair_count() == first_pairs
+        assert "scan" not in repairer.run_stats.report()["stages_seconds"]
+    assert sorted(Path(target).name for target in fake_exiftool.targets) == ["IMG_1.jpg", "IMG_1.jpg"]
+
+    # 第三次运行: 全部完成, 不再调用 ExifTool
+    fake_exiftool.targets.clear()
+    with metafix.TakeoutRepairer(takeout_tree, config) as repairer:
+        repairer.run()
+    assert fake_exiftool.targets == []
+    capsys.readouterr()
@@ -0,0 +1,67 @@
+import random
+from pathlib import Path
+
+import google_takeout_metafix_v2_mt as metafix
+
+LONG = "Screenshot_2021-01-01-12-00-00-000_com.very.long.app.name"
+
+# 一个目录中的媒体文件和 JSON 文件, 覆盖 E1D0/E1D1/E0D0/E0D1、45 字符截断、大小写和 supplemental-metadata
+MEDIA = ["IMG_1.jpg", "IMG_1(1).jpg", "IMG_1(2).jpg", "IMG_2.JPG", "IMG_3.mp4", "IMG_3.jpg", "wrong.jpg",
+         f"{LONG}.jpg", f"{LONG}(1).jpg", "VID_4.mp4", "photo.heic", "orphan.jpg", "a.jpg", "ab.jpg"]
+JSON = ["IMG_1.jpg.json", "IMG_1.jpg(1).json", "IMG_1(2).json", "img_2.jpg.json", "IMG_3.json", "IMG_3.jpg.json",
+        "wrong.jpg.supplemental-metadata.json", f"{LONG[:45]}.json", f"{LONG[:42]}(1).json", "VID_4.json",
+        "photo.heic.json", "metadata.json", "ab.jpg.json", "a.json"]
+
+
+def legacy_and_index_results(media_files, json_files):
+    # 按相同顺序逐个匹配, 已匹配的 JSON 从两边同时去掉
+    index = metafix.JsonMatchIndex(json_files)
+    remaining = list(json_files)
+    results = []
+    for media_file in media_files:
+        found = index.find(media_file)
+        expected = metafix.find_matching_json(media_file, remaining)
+        results.append((media_file, found, expected))
+        if found:
+            index.discard(found)
+            remaining.remove(found)
+    return results
+
+
+def test_index_matches_legacy_on_fixture(quiet_context, capsys):
+    media_files, json_files = [], []
+    for folder in ("Photos from 2020", "Album A"):
+        media_files += [Path(folder) / name for name in MEDIA]
+        json_files += [Path(folder) / name for name in JSON]
+    results = legacy_and_index_results(media_files, json_files)
+    capsys.readouterr()
+    for media_file, found, expected in results:
+        assert found == expected, media_file
+    matched = {media_file.name for media_file, found, _ in results if found and media_file.parent.name == "Album A"}
+    assert {"IMG_1.jpg", "IMG_1(1).jpg", "IMG_2.JPG", f"{LONG}.jpg", "VID_4.mp4"} <= matched
+    assert "orphan.jpg" not in matched
+
+
+def test_index_matches_legacy_on_random_names(quiet_context, capsys):
+    # 随机组合基名、扩展名和去重编号, 包括同一 JSON 可被多个媒体文件命中的情况
+    rng = random.Random(20240501)
+    stems = ["IMG_1", "IMG_10", "img_1", "PXL_2020", "PXL_2020_01", LONG, LONG[:44], "a", "ab"]
+    exts = [".jpg", ".JPG", ".mp4", ".heic", ".png"]
+    for _ in range(30):
+        media_files, json_files = [], []
+        for folder in ("d1", "d2"):
+            for _ in range(rng.randint(1, 12)):
+                dup = rng.choice(["", "", "(1)", "(2)"])
+                media_files.append(Path(folder) / f"{rng.choice(stems)}{dup}{rng.choice(exts)}")
+            for _ in range(rng.randint(1, 12)):
+                stem, ext, dup = rng.choice(stems), rng.choice(exts), rng.choice(["", "", "(1)", "(2)"])
+                name = rng.choice([f"{stem}{ext}{dup}.json", f"{stem}{dup}.json",
+                                   f"{stem}{ext}.supplemental-metadata{dup}.json", f"{(stem + ext)[:46]}{dup}.json"])
+                json_files.append(Path(folder) / name)
+        rng.shuffle(media_files)
+        rng.shuffle(json_files)
+        media_files = list(dict.fromkeys(media_files))
+        json_files = list(dict.fromkeys(json_files))
+        for media_file, found, expected in legacy_and_index_results(media_files, json_files):
+            assert found == expected, (media_file, json_files)
+    capsys.readouterr()
@@ -0,0 +1,46 @@
+import shutil
+
+import google_takeout_metafix_v2_mt as metafix
+
+
+def snapshot(root):
+    # {相对路径: (内容, 修改时间)}
+    return {p.relative_to(root).as_posix(): (p.read_bytes(), p.stat().st_mtime_ns)
+            for p in sorted(root.rglob("*")) if p.is_file()}
+
+
+def contents(root):
+    return {path: data for path, (data, _) in snapshot(root).items()}
+
+
+def commands(fake_exiftool, root):
+    return sorted(tuple(arg.replace(str(root), "<root>") for arg in args) for args in fake_exiftool.commands)
+
+
+def test_plan_leaves_tree_unchanged_and_apply_matches_direct_run(tmp_path, takeout_tree, fake_exiftool, capsys):
+    planned = takeout_tree
+    direct = tmp_path / "direct"
+    shutil.copytree(planned, direct)
+    plan_file = tmp_path / "plan.jsonl"
+    config = metafix.RepairConfig(quiet=True)
+
+    before = snapshot(planned)
+    with metafix.TakeoutRepairer(planned, config) as repairer:
+        repairer.save_plan(plan_file)
+    # 演练不修改任何文件, 也不调用 ExifTool 写入
+    assert snapshot(planned) == before
+    assert fake_exiftool.commands == []
+
+    with metafix.TakeoutRepairer(planned, config) as repairer:
+        repairer.apply_plan(plan_file)
+    applied = commands(fake_exiftool, planned)
+    fake_exiftool.commands.clear()
+    with metafix.TakeoutRepairer(direct, config) as repairer:
+        repairer.run()
+    capsys.readouterr()
+
+    # 执行计划与直接运行得到相同的目录树和相同的 ExifTool 参数
+    assert contents(planned) == contents(direct)
+    assert applied and applied == commands(fake_exiftool, direct)
+    assert "unmatched/Album A/orphan.jpg" in contents(planned)
+    assert "Album A/wrong.png" in contents(planned)
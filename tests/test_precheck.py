@@ -0,0 +1,85 @@
+import json
+import os
+from datetime import datetime
+
+import google_takeout_metafix_v2_mt as metafix
+from conftest import JPG, sidecar
+
+TIMESTAMP = 1600000000
+GEO = (23.1, 120.5, 3.0)
+
+
+def existing(timestamp=TIMESTAMP, lat=23.1, lng=120.5, file_time=TIMESTAMP, **extra):
+    # exiftool -json -n 读出的一个文件
+    tz = metafix.setting("local_timezone")
+    info = {"DateTimeOriginal": metafix.format_exif_date(timestamp),
+            "GPSLatitude": abs(lat), "GPSLatitudeRef": "N" if lat >= 0 else "S",
+            "GPSLongitude": abs(lng), "GPSLongitudeRef": "E" if lng >= 0 else "W", "GPSAltitude": 3.0,
+            "FileModifyDate": datetime.fromtimestamp(file_time, tz).strftime("%Y:%m:%d %H:%M:%S%z")}
+    info.update(extra)
+    return info
+
+
+def test_identical_metadata_is_same(quiet_context):
+    assert metafix.compare_existing_metadata(existing(), TIMESTAMP, GEO) == "same"
+    # 南半球、西半球的坐标按 Ref 加上符号
+    assert metafix.compare_existing_metadata(existing(lat=-33.9, lng=-70.6), TIMESTAMP, (-33.9, -70.6, 3.0)) == "same"
+
+
+def test_date_match_with_gps_mismatch_differs(quiet_context):
+    assert metafix.compare_existing_metadata(existing(lat=23.2), TIMESTAMP, GEO) == "differs"
+    # 没有 GPS 的文件也需要写入
+    info = existing()
+    del info["GPSLatitude"], info["GPSLongitude"]
+    assert metafix.compare_existing_metadata(info, TIMESTAMP, GEO) == "differs"
+
+
+def test_date_mismatch_differs(quiet_context):
+    assert metafix.compare_existing_metadata(existing(timestamp=TIMESTAMP + 60), TIMESTAMP, GEO) == "differs"
+    assert metafix.compare_existing_metadata({}, TIMESTAMP, None) == "differs"
+
+
+def test_only_file_time_differs(quiet_context):
+    assert metafix.compare_existing_metadata(existing(file_time=TIMESTAMP + 3600), TIMESTAMP, GEO) == "times"
+    assert metafix.compare_existing_metadata(existing(FileModifyDate=None), TIMESTAMP, GEO) == "times"
+
+
+def test_video_gps_coordinates(quiet_context):
+    info = existing()
+    for key in ("GPSLatitude", "GPSLatitudeRef", "GPSLongitude", "GPSLongitudeRef", "GPSAltitude"):
+        del info[key]
+    info["GPSCoordinates"] = "23.1 120.5 3"
+    assert metafix.compare_existing_metadata(info, TIMESTAMP, GEO) == "same"
+
+
+class ReadPool:
+    # 代替 ExifToolPool: 对 -json 读取返回预先准备的结果
+    def __init__(self, items):
+        self.items = items
+        self.calls = []
+
+    def execute(self, args, timeout=None):
+        self.calls.append(args)
+        return True, json.dumps(self.items), ""
+
+
+def test_precheck_fixes_file_times_without_rewriting(tmp_path, quiet_context):
+    pairs = []
+    for name in ("same.jpg", "times.jpg", "gps.jpg"):
+        media_file, json_file = tmp_path / name, tmp_path / f"{name}.json"
+        media_file.write_bytes(JPG)
+        json_file.write_text(sidecar(name, TIMESTAMP))
+        pairs.append((media_file, json_file))
+    os.utime(pairs[1][0], (TIMESTAMP + 3600, TIMESTAMP + 3600))
+    pool = ReadPool([dict(existing(), SourceFile=str(pairs[0][0])),
+                     dict(existing(file_time=TIMESTAMP + 3600), SourceFile=str(pairs[1][0])),
+                     dict(existing(lat=0.0), SourceFile=str(pairs[2][0]))])
+    precheck = metafix.MetadataPrecheck(pool)
+    to_write, skipped = precheck.filter(pairs)
+    assert to_write == [pairs[2]]
+    assert skipped == pairs[:2]
+    assert precheck.skipped == 2
+    # 一次读取整组文件; 只有文件时间不同的文件直接改时间, 不交给 ExifTool 重写
+    assert len(pool.calls) == 1
+    assert os.stat(pairs[1][0]).st_mtime == TIMESTAMP
+    assert quiet_context.run_stats.counters["precheck.skipped"] == 2
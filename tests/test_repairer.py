@@ -0,0 +1,44 @@
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import google_takeout_metafix_v2_mt as metafix
+
+
+def test_repairer_open_failure_releases_instance(tmp_path, takeout_tree):
+    state = tmp_path / "state.db"
+    config = metafix.RepairConfig(state=str(state), quiet=True)
+    metafix.TakeoutRepairer(tmp_path, config).open().close()
+    repairer = metafix.TakeoutRepairer(takeout_tree, config)
+    with pytest.raises(ValueError):
+        repairer.open()
+    assert repairer.journal is None and repairer.unmatched is None
+    # 之后的实例不受影响
+    with metafix.TakeoutRepairer(takeout_tree, metafix.RepairConfig(quiet=True)) as other:
+        assert other.scan() is not None
+
+
+def test_concurrent_instances_keep_their_own_settings(tmp_path, takeout_tree, fake_exiftool, capsys):
+    tokyo = tmp_path / "tokyo"
+    shutil.copytree(takeout_tree, tokyo)
+    configs = {str(takeout_tree): metafix.RepairConfig(quiet=True, timezone="UTC"),
+               str(tokyo): metafix.RepairConfig(quiet=True, timezone="Asia/Tokyo")}
+
+    def run(root):
+        with metafix.TakeoutRepairer(root, configs[root]) as repairer:
+            repairer.run()
+            return repairer.run_stats.counters["write.ok"]
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        written = list(executor.map(run, configs))
+    capsys.readouterr()
+    # 两个实例同时运行, 各自按自己的时区写入拍摄时间, 统计也各自独立
+    assert written[0] == written[1] > 0
+    dates = {}
+    for args in fake_exiftool.commands:
+        if args[-1].endswith("IMG_0.jpg"):
+            root = str(tokyo) if args[-1].startswith(str(tokyo)) else str(takeout_tree)
+            dates.setdefault(root, set()).update(arg for arg in args if arg.startswith("-AllDates="))
+    assert dates == {str(takeout_tree): {"-AllDates=2020:09:13 12:26:40"},
+                     str(tokyo): {"-AllDates=2020:09:13 21:26:40"}}
@@ -0,0 +1,61 @@
+import pytest
+
+import google_takeout_metafix_v2_mt as metafix
+
+
+def ftyp(major, *compatible, minor=0):
+    # ISO BMFF 的 ftyp box: 大小、"ftyp"、主品牌、次版本、兼容品牌
+    body = major.encode("latin-1") + minor.to_bytes(4, "big") + b"".join(b.encode("latin-1") for b in compatible)
+    return (8 + len(body)).to_bytes(4, "big") + b"ftyp" + body
+
+
+@pytest.mark.parametrize("header, expected", [
+    (ftyp("heic", "mif1", "heic"), ".heic"),
+    (ftyp("heix", "mif1"), ".heic"),
+    (ftyp("mif1", "mif1", "miaf", "heic"), ".heic"),
+    (ftyp("msf1", "msf1", "hevc"), ".heic"),
+    (ftyp("qt  ", "qt  "), ".mov"),
+    # 兼容品牌里有 isom 的 MOV 不能被当作 MP4
+    (ftyp("qt  ", "qt  ", "isom"), ".mov"),
+    (ftyp("isom", "isom", "iso2", "avc1", "mp41"), ".mp4"),
+    (ftyp("mp42", "mp42", "isom"), ".mp4"),
+])
+def test_ftyp_brands(header, expected):
+    assert metafix.sniff_header(header + bytes(64)) == expected
+    assert metafix.sniff_header(memoryview(bytearray(header + bytes(64)))) == expected
+
+
+def test_mif1_without_heic_compatible_brand_is_not_heic():
+    # AVIF 等其他 HEIF 图片不应改成 .heic
+    assert metafix.isobmff_extension(ftyp("mif1", "mif1", "avif", "miaf")) is None
+
+
+def test_compatible_brands_stop_at_box_end():
+    # ftyp 之后紧跟的数据不算兼容品牌
+    header = ftyp("mif1", "mif1", "miaf") + (16).to_bytes(4, "big") + b"heic" + bytes(8)
+    assert metafix.isobmff_extension(header) is None
+
+
+def test_old_quicktime_atoms():
+    assert metafix.sniff_header((1024).to_bytes(4, "big") + b"moov" + bytes(64)) == ".mov"
+    assert metafix.sniff_header((8).to_bytes(4, "big") + b"wide" + bytes(64)) == ".mov"
+    # 大小不合理的 atom 不算
+    assert metafix.sniff_header((3).to_bytes(4, "big") + b"mdat" + bytes(64)) is None
+
+
+def test_truncated_headers():
+    heic = ftyp("heic", "mif1", "heic")
+    assert metafix.sniff_header(heic[:11]) is None
+    assert metafix.sniff_header(b"") is None
+    # 兼容品牌被截断时只看已读到的部分
+    assert metafix.isobmff_extension(ftyp("mif1", "mif1", "heic")[:22]) is None
+    assert metafix.isobmff_extension(ftyp("mif1", "heic")[:20]) == ".heic"
+
+
+def test_other_formats_and_files(tmp_path):
+    assert metafix.sniff_header(b"\xff\xd8\xff\xe0\x00\x10JFIF\x00" + bytes(64)) == ".jpg"
+    assert metafix.sniff_header(b"\x89PNG\r\n\x1a\n" + bytes(64)) == ".png"
+    assert metafix.sniff_header(b"plain text, not media") is None
+    media_file = tmp_path / "IMG_1.jpg"
+    media_file.write_bytes(ftyp("heic", "mif1", "heic") + bytes(20000))
+    assert metafix.sniff_media_type(media_file) == ".heic"
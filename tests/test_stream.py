@@ -0,0 +1,86 @@
+import shutil
+import threading
+
+import pytest
+
+import google_takeout_metafix_v2_mt as metafix
+from conftest import JPG, sidecar
+
+
+def ambiguous_tree(root):
+    # 每个媒体文件都有多个能匹配的 JSON (时间不同), 只有按扫描顺序取第一个才与批量模式一致
+    for folder in ("A", "B", "C"):
+        p = root / folder
+        p.mkdir(parents=True)
+        for i in range(4):
+            (p / f"IMG_{i}.jpg").write_bytes(JPG)
+            for n, suffix in enumerate(["", ".supplemental-metadata", ".suppl", ".supplemental-me", ".sup"]):
+                (p / f"IMG_{i}.jpg{suffix}.json").write_text(sidecar(f"IMG_{i}.jpg", 1600000000 + 10 * i + n))
+    return root
+
+
+def written_commands(fake_exiftool, root):
+    return sorted(tuple(arg.replace(str(root), "<root>") for arg in args) for args in fake_exiftool.commands)
+
+
+def test_stream_picks_the_same_json_as_batch(tmp_path, fake_exiftool, capsys):
+    batch_root = ambiguous_tree(tmp_path / "batch")
+    stream_root = tmp_path / "stream"
+    shutil.copytree(batch_root, stream_root)
+    config = metafix.RepairConfig(quiet=True, unmatched_manifest=str(tmp_path / "unmatched.jsonl"))
+    with metafix.TakeoutRepairer(batch_root, config) as repairer:
+        repairer.run()
+    batch = written_commands(fake_exiftool, batch_root)
+    fake_exiftool.commands.clear()
+    with metafix.TakeoutRepairer(stream_root, config) as repairer:
+        repairer.stream()
+    capsys.readouterr()
+    assert batch and written_commands(fake_exiftool, stream_root) == batch
+
+
+def run_with_timeout(function, seconds=30):
+    # 在线程中运行, 卡住时测试失败而不是一直等待
+    outcome = {}
+
+    def target():
+        try:
+            outcome["result"] = function()
+        except BaseException as e:
+            outcome["error"] = e
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(seconds)
+    assert not thread.is_alive(), "流式模式在阶段线程出错后卡住"
+    return outcome
+
+
+def many_directories(root, count=30):
+    for i in range(count):
+        p = root / f"D{i}"
+        p.mkdir(parents=True)
+        (p / "IMG_1.jpg").write_bytes(JPG)
+        (p / "IMG_1.jpg.json").write_text(sidecar("IMG_1.jpg", 1600000000 + i))
+    return root
+
+
+@pytest.mark.parametrize("stage", ["ext", "write"])
+def test_stream_stage_failure_is_raised(tmp_path, fake_exiftool, monkeypatch, capsys, stage):
+    root = many_directories(tmp_path / "root")
+
+    def boom(*args, **kwargs):
+        raise RuntimeError(f"{stage} failed")
+    if stage == "ext":
+        monkeypatch.setattr(metafix, "_ext_worker", boom)
+    else:
+        monkeypatch.setattr(metafix.AdaptiveScheduler, "run", boom)
+    # 队列只能放很少的目录, 阶段线程退出后上游若不被放开就会卡住
+    monkeypatch.setattr(metafix, "stream_queue_size", 1)
+    config = metafix.RepairConfig(quiet=True, unmatched_manifest=str(tmp_path / "unmatched.jsonl"))
+
+    def run():
+        with metafix.TakeoutRepairer(root, config) as repairer:
+            repairer.stream()
+    outcome = run_with_timeout(run)
+    capsys.readouterr()
+    assert isinstance(outcome.get("error"), RuntimeError)
+    assert str(outcome["error"]) == f"{stage} failed"
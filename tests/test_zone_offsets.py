@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import pytz
+
+import google_takeout_metafix_v2_mt as metafix
+
+# 夏令时、半小时偏移、南半球和历史上改过标准时间的时区
+ZONES = ["Europe/Berlin", "America/New_York", "Australia/Lord_Howe", "Asia/Kolkata", "Asia/Shanghai",
+         "Pacific/Apia", "America/Sao_Paulo", "UTC"]
+
+
+def expected(timestamp, tz):
+    return datetime.fromtimestamp(timestamp, tz).strftime("%Y:%m:%d %H:%M:%S")
+
+
+@pytest.mark.parametrize("name", ZONES)
+def test_matches_fromtimestamp_around_transitions(name):
+    tz = pytz.timezone(name)
+    zone = metafix.ZoneOffsets(tz)
+    epoch = datetime(1970, 1, 1)
+    transitions = [int((t - epoch).total_seconds()) for t in getattr(tz, "_utc_transition_times", [])
+                   if datetime(1971, 1, 1) <= t <= datetime(2037, 1, 1)]
+    for start in transitions:
+        for timestamp in (start - 3601, start - 1, start, start + 1, start + 3600):
+            assert zone.format(timestamp) == expected(timestamp, tz), timestamp
+
+
+@pytest.mark.parametrize("name", ZONES)
+def test_matches_fromtimestamp_on_spread_of_timestamps(name):
+    tz = pytz.timezone(name)
+    zone = metafix.ZoneOffsets(tz)
+    for timestamp in range(0, 2_100_000_000, 7_654_321):
+        assert zone.format(timestamp) == expected(timestamp, tz)
+    # 小数秒与 fromtimestamp 一样向下取整
+    assert zone.format(1_600_000_000.75) == expected(1_600_000_000.75, tz)
+
+
+def test_fixed_offset_and_non_pytz_zones():
+    fixed = pytz.FixedOffset(330)
+    assert metafix.ZoneOffsets(fixed).format(1_600_000_000) == expected(1_600_000_000, fixed)
+    # 不是 pytz 的 tzinfo 时直接使用 datetime
+    other = timezone(timedelta(hours=-3, minutes=-30))
+    zone = metafix.ZoneOffsets(other)
+    assert zone.starts is None
+    assert zone.format(1_600_000_000) == expected(1_600_000_000, other)
+
+
+def test_zone_offsets_is_cached_per_zone():
+    tz = pytz.timezone("Europe/Berlin")
+    assert metafix.zone_offsets(tz) is metafix.zone_offsets(tz)
+
+
+def test_gps_zone_checks_cell_centre(monkeypatch):
+    # 格子 (0, 0) 的四个角都在 UTC, 中心附近有一块 Asia/Tokyo 的飞地
+    def zone_name(lat, lng):
+        queries.append((lat, lng))
+        return "Asia/Tokyo" if abs(lat - 0.05) < 0.02 and abs(lng - 0.05) < 0.02 else "UTC"
+    queries = []
+    monkeypatch.setattr(metafix, "_gps_zone_name", zone_name)
+    monkeypatch.setattr(metafix, "_gps_zone_cells", {})
+    monkeypatch.setattr(metafix, "_gps_zone_points", {})
+    assert metafix.gps_zone((0.05, 0.05, 0.0)).zone == "Asia/Tokyo"
+    assert metafix.gps_zone((0.01, 0.01, 0.0)).zone == "UTC"
+    assert metafix._gps_zone_cells[(0, 0)] is metafix._mixed_cell
+
+    # 四个角和中心点都相同的格子整格只查询一次
+    queries.clear()
+    assert metafix.gps_zone((10.01, 20.01, 0.0)).zone == "UTC"
+    assert metafix.gps_zone((10.09, 20.08, 0.0)).zone == "UTC"
+    assert len(queries) == 5